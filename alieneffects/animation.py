@@ -0,0 +1,249 @@
+import logging
+import math
+import time
+from collections import deque
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.packets import PacketBatch
+
+KEYBOARD_ZONES = [
+    AC.Zones.LEFT_KEYBOARD,
+    AC.Zones.MIDDLE_LEFT_KEYBOARD,
+    AC.Zones.MIDDLE_RIGHT_KEYBOARD,
+    AC.Zones.RIGHT_KEYBOARD,
+]
+
+
+def lerpColor(color1, color2, fraction):
+    return tuple(int(round(a + (b - a) * fraction)) for a, b in zip(color1, color2))
+
+
+# Effects are callables mapping the time since start (seconds) to a {zone name: color} map
+class GradientEffect:
+    """Gradient from color1 to color2 and back across the zones, scrolling once per period seconds"""
+
+    def __init__(self, color1=(255, 0, 0), color2=(0, 0, 255), zones=KEYBOARD_ZONES, period=4.0):
+        self.color1 = color1
+        self.color2 = color2
+        self.zones = zones
+        self.period = period
+
+    def __call__(self, t):
+        phase = (t / self.period) % 1.0
+        colors = {}
+        for i, zone in enumerate(self.zones):
+            f = (i / len(self.zones) + phase) % 1.0
+            colors[zone] = lerpColor(self.color1, self.color2, 1.0 - abs(2.0 * f - 1.0))
+        return colors
+
+
+class WaveEffect:
+    """A band of color (width in zones) sweeping across the zones once per period seconds"""
+
+    def __init__(self, color=(0, 255, 255), background=(0, 0, 0), zones=KEYBOARD_ZONES, period=2.0, width=1.0):
+        self.color = color
+        self.background = background
+        self.zones = zones
+        self.period = period
+        self.width = width
+
+    def __call__(self, t):
+        n = len(self.zones)
+        position = ((t / self.period) % 1.0) * n
+        colors = {}
+        for i, zone in enumerate(self.zones):
+            distance = abs(i - position)
+            distance = min(distance, n - distance)
+            colors[zone] = lerpColor(self.background, self.color, max(0.0, 1.0 - distance / self.width))
+        return colors
+
+
+class BreathingEffect:
+    """All zones fading in and out of color once per period seconds"""
+
+    def __init__(self, color=(255, 255, 255), zones=tuple(AC.Zones.CODES.keys()), period=3.0):
+        self.color = color
+        self.zones = zones
+        self.period = period
+
+    def __call__(self, t):
+        f = (1.0 - math.cos(2.0 * math.pi * t / self.period)) / 2.0
+        color = lerpColor((0, 0, 0), self.color, f)
+        return {zone: color for zone in self.zones}
+
+
+EFFECTS = {
+    'GRADIENT': GradientEffect,
+    'WAVE': WaveEffect,
+    'BREATHING': BreathingEffect,
+}
+
+
+class FrameScheduler:
+    """Yields (frame index, scheduled time since start) at a fixed rate on the monotonic clock
+
+    Frames are scheduled at start + index / fps, so timing does not drift.
+    When the consumer falls behind, stale frames are dropped (and counted) instead of being queued,
+    the next frame yielded is the latest one that is due.
+    """
+
+    def __init__(self, fps, clock=time.monotonic, sleep=time.sleep):
+        self.fps = fps
+        self.period = 1.0 / fps
+        self.clock = clock
+        self.sleep = sleep
+        self.numDropped = 0
+
+    def frames(self, duration=None):
+        start = self.clock()
+        index = 0
+        while True:
+            due = start + index * self.period
+            now = self.clock()
+            if now < due:
+                self.sleep(due - now)
+            else:
+                late = int((now - due) / self.period)
+                if late > 0:
+                    self.numDropped += late
+                    index += late
+                    due = start + index * self.period
+            if duration is not None and due - start >= duration:
+                return
+            yield index, due - start
+            index += 1
+
+
+class AnimationStats:
+    def __init__(self, maxLatencySamples=10000):
+        self.numFrames = 0
+        self.numDropped = 0
+        self.numWrites = 0
+        # Resets of the lights after the first: sequence ids used up or a frame not sent
+        self.numRestarts = 0
+        self.elapsed = 0.0
+        # Process CPU time spent while running, to keep the overhead of long running effects in check
+        self.cpuTime = 0.0
+        # Send durations (seconds) of the most recent frames
+        self.latencies = deque(maxlen=maxLatencySamples)
+
+    @property
+    def fps(self):
+        return self.numFrames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def latencyPercentile(self, fraction):
+        if not self.latencies:
+            return None
+        samples = sorted(self.latencies)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def summary(self):
+        return {
+            'frames': self.numFrames,
+            'droppedFrames': self.numDropped,
+            'writes': self.numWrites,
+            'restarts': self.numRestarts,
+            'elapsed': self.elapsed,
+            'fps': self.fps,
+            'writesPerMinute': 60.0 * self.numWrites / self.elapsed if self.elapsed > 0 else 0.0,
+            'cpuOverhead': self.cpuTime / self.elapsed if self.elapsed > 0 else 0.0,
+            'latencyP50': self.latencyPercentile(0.5),
+            'latencyP90': self.latencyPercentile(0.9),
+            'latencyP99': self.latencyPercentile(0.99),
+        }
+
+
+class AlienwareAnimator:
+    """Renders an effect on the host and streams it to the controller
+
+    Each frame, only zones whose color changed are sent: zones changing to the same color share one
+    SET_COLOR + LOOP sequence (with OR'd zone codes), followed by a single EXECUTE.
+    A sequence ended by LOOP cannot be appended to, so every frame programs new sequence ids: EXECUTE assigns
+    them to their zones over the sequences of earlier frames. Once the maxSequences ids are used up, the lights
+    are reset and the next frame sends every zone again. Frames are sent as checked transactions, a frame that
+    did not get through also resets the lights, as the sequences the controller holds are then unknown.
+    """
+
+    def __init__(self, controller, effect, fps=30, maxSequences=256):
+        self.controller = controller
+        self.effect = effect
+        self.scheduler = FrameScheduler(fps)
+        self.stats = AnimationStats()
+        # Sequence ids are one byte
+        self.maxSequences = min(maxSequences, 256)
+        self._lastColors = {}
+        # Colors of the zones of the frame being sent, recorded in _lastColors once it got through
+        self._frameColors = {}
+        self._nextSequenceId = 0
+        self._batch = PacketBatch()
+
+    def restart(self):
+        """Resets the lights, all zones are sent again from the next frame"""
+        ac = self.controller
+        ac.reset(AC.Reset.CODES[AC.Reset.ALL_LIGHTS_ON])
+        ac.waitUntilControllerReady(AC.Commands.RESET)
+        self._lastColors = {}
+        self._nextSequenceId = 0
+
+    def makeFrame(self, colors):
+        """Builds the packets updating the zones whose color changed, returns the PacketBatch (empty if none)
+
+        Returns None if the sequence ids left are too few for the frame, restart first.
+        """
+        changed = {}
+        frameColors = self._frameColors
+        frameColors.clear()
+        for zone, color in colors.items():
+            if self._lastColors.get(zone) != color:
+                changed[color] = changed.get(color, 0) | AC.Zones.CODES[zone]
+                frameColors[zone] = color
+        if self._nextSequenceId + len(changed) > self.maxSequences:
+            return None
+
+        batch = self._batch
+        batch.clear()
+        for color, zoneCode in changed.items():
+            batch.addSetColorCmd(self._nextSequenceId, zoneCode, color)
+            batch.addLoopSequenceCmd()
+            self._nextSequenceId += 1
+        if len(batch) > 0:
+            batch.addExecuteCmd()
+        return batch
+
+    def run(self, duration=None):
+        """Runs for duration seconds (forever if None, until interrupted), returns AnimationStats"""
+        ac = self.controller
+        ac.driver.acquire()
+        self.restart()
+
+        start = time.monotonic()
+        cpuStart = time.process_time()
+        try:
+            for _, t in self.scheduler.frames(duration):
+                colors = self.effect(t)
+                batch = self.makeFrame(colors)
+                if batch is None:
+                    self.restart()
+                    self.stats.numRestarts += 1
+                    batch = self.makeFrame(colors)
+                self.stats.numFrames += 1
+                if len(batch) == 0:
+                    continue
+                sendStart = time.monotonic()
+                result = ac.sendTransaction(batch.packets())
+                self.stats.latencies.append(time.monotonic() - sendStart)
+                self.stats.numWrites += len(batch)
+                if result.ok:
+                    self._lastColors.update(self._frameColors)
+                else:
+                    logging.warning('Frame not sent (%s), resetting the lights', result.summary())
+                    self.restart()
+                    self.stats.numRestarts += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stats.elapsed = time.monotonic() - start
+            self.stats.cpuTime = time.process_time() - cpuStart
+            self.stats.numDropped = self.scheduler.numDropped
+        logging.info('Animation stats: {}'.format(self.stats.summary()))
+        return self.stats
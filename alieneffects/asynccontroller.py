@@ -0,0 +1,150 @@
+import asyncio
+import concurrent.futures
+import math
+import queue
+import threading
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.theme import AlienwareTheme
+from alieneffects.wait import ControllerNotReadyError
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, fn, timeout):
+        self.fn = fn
+        self.timeout = timeout
+        self.cancelled = threading.Event()
+        self.future = concurrent.futures.Future()
+
+    def checkCancelled(self):
+        if self.cancelled.is_set():
+            raise _Cancelled()
+
+
+class AsyncAlienwareController:
+    """asyncio front end of AlienwareController
+
+    All USB transfers are queued to a single worker thread which owns the synchronous controller,
+    so the event loop is never blocked and transfers never interleave.
+    Jobs queued back to back (ex. several send_commands without awaiting each) are pipelined by the worker.
+    Cancelling a coroutine drops its job if it has not started yet,
+    a batch being sent or a ready wait in progress stops at the next transfer.
+    An apply in progress is run to completion, stopping midway would leave the lights half programmed.
+    Timeouts are per transfer, in seconds.
+    """
+
+    def __init__(self, controller=None, transferTimeout=1.0):
+        self.controller = controller if controller is not None else AC()
+        self.transferTimeout = transferTimeout
+        self._queue = queue.Queue()
+        self._worker = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, excType, exc, tb):
+        await self.close()
+
+    async def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='alieneffects-usb', daemon=True)
+            self._worker.start()
+        await self._submit(lambda job: self.controller.driver.acquire())
+
+    async def close(self):
+        if self._worker is None:
+            return
+        try:
+            await self._submit(lambda job: self.controller.driver.release())
+        finally:
+            self._queue.put(None)
+            worker, self._worker = self._worker, None
+            await asyncio.get_running_loop().run_in_executor(None, worker.join)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if job.cancelled.is_set() or not job.future.set_running_or_notify_cancel():
+                continue
+            timeout = self.transferTimeout if job.timeout is None else job.timeout
+            # In ms, rounded up: pyusb waits forever with a timeout of 0
+            self.controller.driver.timeout = max(1, int(math.ceil(timeout * 1000)))
+            try:
+                result = job.fn(job)
+            except _Cancelled:
+                # A running future can not be cancelled, the awaiting side is already gone anyway
+                job.future.set_exception(concurrent.futures.CancelledError())
+            except BaseException as exc:
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(result)
+
+    async def _submit(self, fn, timeout=None):
+        if self._worker is None:
+            raise RuntimeError('AsyncAlienwareController is not started')
+        job = _Job(fn, timeout)
+        self._queue.put(job)
+        try:
+            return await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            job.cancelled.set()
+            raise
+
+    async def get_status(self, timeout=None):
+        """Returns True if the controller is ready
+
+        Raises ControllerNotReadyError if the status could not be read, ex. the read timed out.
+        """
+
+        def getStatus(job):
+            try:
+                return self.controller.getStatus()
+            except (TypeError, IndexError, OSError) as exc:
+                # No or an empty response read, as counted by the wait strategy
+                raise ControllerNotReadyError('Controller status could not be read: {}'.format(exc))
+
+        return await self._submit(getStatus, timeout)
+
+    async def wait_ready(self, reason=None, timeout=None):
+        """Waits with the controller's wait strategy, returns the number of polls"""
+
+        def waitReady(job):
+            def getStatus():
+                job.checkCancelled()
+                return self.controller.getStatus()
+
+            return self.controller.waitStrategy.wait(getStatus, reason)
+
+        return await self._submit(waitReady, timeout)
+
+    async def reset(self, resetCode, timeout=None):
+        await self._submit(lambda job: self.controller.reset(resetCode), timeout)
+
+    async def send_commands(self, cmds, timeout=None):
+        """Sends a batch of packets, returns the number of bytes written per packet (None for failed transfers)"""
+        cmds = list(cmds)
+
+        def sendCommands(job):
+            written = []
+            for cmd in cmds:
+                job.checkCancelled()
+                written.append(self.controller.driver.writePacket(cmd))
+            return written
+
+        return await self._submit(sendCommands, timeout)
+
+    async def apply(self, theme, coalesce=True, state=None, force=False, cache=None, timeout=None, optimize=False):
+        """Applies an AlienwareTheme (or a theme file path), returns True if it was applied"""
+        if not isinstance(theme, AlienwareTheme):
+            theme = await asyncio.get_running_loop().run_in_executor(None, AlienwareTheme, theme)
+        return await self._submit(
+            lambda job: theme.apply(self.controller, coalesce=coalesce, state=state, force=force, cache=cache,
+                                    optimize=optimize),
+            timeout)
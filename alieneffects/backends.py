@@ -0,0 +1,24 @@
+from alieneffects.emulator import EmulatedUSBDriver
+from alieneffects.usbdriver import AlienwareUSBDriver
+
+BACKENDS = {
+    'usb': AlienwareUSBDriver,
+    'emulator': EmulatedUSBDriver,
+}
+
+
+def makeDriver(backend='usb', **options):
+    """Makes a driver of the named backend, options are passed to its constructor"""
+    if backend not in BACKENDS:
+        raise RuntimeError('Unknown driver backend {}, known backends are {}'.format(backend, sorted(BACKENDS)))
+    return BACKENDS[backend](**options)
+
+
+def discoverDrivers(backend='usb', profiles=(), **options):
+    """Drivers of every controller of the named backend matching one of profiles, as a list of (profile, driver)
+
+    options are passed to the discover method of the backend.
+    """
+    if backend not in BACKENDS:
+        raise RuntimeError('Unknown driver backend {}, known backends are {}'.format(backend, sorted(BACKENDS)))
+    return BACKENDS[backend].discover(profiles, **options)
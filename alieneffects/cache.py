@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+from alieneffects import __version__
+from alieneffects.compiler import CompiledTheme
+from alieneffects.usbdriver import AlienwareUSBDriver
+
+DEFAULT_CACHE_DIRECTORY = os.path.expanduser('~/.alieneffects-13r3.cache')
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+
+class CompiledThemeCache:
+    """On-disk cache of compiled themes, one binary blob per theme
+
+    Blobs are keyed by the hash of the theme file contents, the tool version and the device profile,
+    so any of them changing simply misses.
+    Themes with random colors compile differently every time and must not be stored.
+
+    Blob layout (little endian):
+        header      : magic, tempo, duration, number of packets without coalescing, number of sequences,
+                      number of power states
+        sequences   : (zone code, number of packets) per sequence
+        power states: (power state code, number of packets) per power state slot
+        packets     : PACKET_LENGTH raw bytes per packet, sequence after sequence then power state after power state
+    """
+
+    MAGIC = b'AEC2'
+    HEADER = struct.Struct('<4sIIIII')
+    SEQUENCE = struct.Struct('<II')
+    SUFFIX = '.bin'
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, maxBytes=DEFAULT_MAX_BYTES,
+                 packetLength=AlienwareUSBDriver.PACKET_LENGTH):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.packetLength = packetLength
+        self.deviceProfile = '{:04x}:{:04x}'.format(AlienwareUSBDriver.VENDOR_ID, AlienwareUSBDriver.PRODUCT_ID)
+
+    def key(self, themeBytes, coalesce=True, optimize=False, profile=None):
+        """Key of a theme compiled for a DeviceProfile (see alieneffects.profiles), for the 13 R3 if None"""
+        h = hashlib.sha256(themeBytes)
+        deviceProfile = self.deviceProfile
+        if profile is not None:
+            # Editing the zones of a profile changes what themes compile to
+            deviceProfile = '{}{}'.format(profile.key, sorted(profile.zones.items()))
+        h.update('|{}|{}|{}|{}'.format(__version__, deviceProfile, self.packetLength, coalesce).encode('utf-8'))
+        if optimize:
+            h.update(b'|optimized')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def load(self, key):
+        """Returns the cached CompiledTheme whose packets are slices of a read only memory map, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                buffer = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            # Touch, so that eviction removes the least recently used blobs first
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            magic, tempo, duration, numPacketsUncoalesced, numSequences, numPowerStates = \
+                self.HEADER.unpack_from(buffer, 0)
+            if magic != self.MAGIC:
+                raise ValueError('Bad magic {}'.format(magic))
+            offset = self.HEADER.size
+            table = []
+            for _ in range(numSequences + numPowerStates):
+                table.append(self.SEQUENCE.unpack_from(buffer, offset))
+                offset += self.SEQUENCE.size
+            entries = []
+            n = self.packetLength
+            for code, numPackets in table:
+                packets = [buffer[offset + i * n:offset + (i + 1) * n] for i in range(numPackets)]
+                offset += numPackets * n
+                entries.append((code, packets))
+            sequences = entries[:numSequences]
+            powerStates = entries[numSequences:]
+            if offset != len(buffer):
+                raise ValueError('Size mismatch')
+        except (struct.error, ValueError) as exc:
+            logging.debug('Discarding corrupt cache blob {}: {}'.format(path, exc))
+            self._remove(path)
+            return None
+
+        return CompiledTheme(tempo, duration, sequences, numPacketsUncoalesced, powerStates)
+
+    def store(self, key, compiled):
+        """Stores a CompiledTheme, a theme whose header fields do not fit the blob layout is not stored"""
+        entries = compiled.sequences + compiled.powerStates
+        try:
+            # DURATION is not validated with the theme, ex. 2500.5 or a negative number
+            parts = [self.HEADER.pack(self.MAGIC, compiled.tempo, compiled.duration, compiled.numPacketsUncoalesced,
+                                      len(compiled.sequences), len(compiled.powerStates))]
+            for code, packets in entries:
+                parts.append(self.SEQUENCE.pack(code, len(packets)))
+        except struct.error as exc:
+            logging.debug('Not storing compiled theme in cache: {}'.format(exc))
+            return
+        for _, packets in entries:
+            for pkt in packets:
+                pkt = bytes(pkt)
+                if len(pkt) != self.packetLength:
+                    raise RuntimeError('Invalid packet length')
+                parts.append(pkt)
+        blob = b''.join(parts)
+
+        path = self._path(key)
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpPath, 'wb') as file:
+                file.write(blob)
+            os.replace(tmpPath, path)
+        except (IOError, OSError) as exc:
+            logging.debug('Could not store compiled theme in cache: {}'.format(exc))
+            self._remove(tmpPath)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used blobs until the cache fits in maxBytes"""
+        entries = []
+        try:
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.SUFFIX):
+                    continue
+                path = os.path.join(self.directory, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        except (IOError, OSError):
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        try:
+            names = os.listdir(self.directory)
+        except (IOError, OSError):
+            return
+        for name in names:
+            if name.endswith(self.SUFFIX):
+                self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except (IOError, OSError):
+            pass
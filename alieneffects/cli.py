@@ -0,0 +1,394 @@
+import argparse
+import json
+import logging
+import sys
+
+from alieneffects.animation import AlienwareAnimator, EFFECTS
+from alieneffects.backends import BACKENDS, discoverDrivers, makeDriver
+from alieneffects.cache import CompiledThemeCache
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.daemon import AlienwareDaemon, AlienwareDaemonClient, DaemonUnavailableError, DEFAULT_SOCKET_PATH
+from alieneffects.fanout import FanOutApplier
+from alieneffects.library import ThemeLibrary
+from alieneffects.lock import ControllerLock, LockTimeoutError, DEFAULT_LOCK_FILE
+from alieneffects.playlist import PlaylistPlayer
+from alieneffects.profiles import ProfileRegistry, DEFAULT_PROFILES_FILE
+from alieneffects.reactive import ReactiveEffect
+from alieneffects.state import ApplyState
+from alieneffects.stats import ApplyStats, writePrometheusTextfile
+from alieneffects.theme import AlienwareTheme
+from alieneffects.trace import TraceRecorder, TraceReplayer
+from alieneffects.usbdriver import DeviceNotFoundError
+from alieneffects.wait import ControllerNotReadyError, ReadyWaitStats, ReadyWaitStrategy, DEFAULT_STATS_FILE
+
+
+def makeParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--THEME_FILE', help='apply this theme')
+    parser.add_argument('--THEME', help='apply the theme with this name (file name without .json) from the themes '
+                                        'directory')
+    parser.add_argument('--LIST', action='store_true', help='list the themes of the themes directory')
+    parser.add_argument('--SEARCH', help='list the themes whose name, description or zones contain this')
+    parser.add_argument('--THEMES_DIRECTORY', help='themes directory, instead of the one of the config file '
+                                                   '(the daemon is then not asked for themes)')
+    parser.add_argument('--ANIMATE', choices=sorted(EFFECTS.keys()),
+                        help='render this animation on the host (uses the controller directly)')
+    parser.add_argument('--REACTIVE', action='store_true',
+                        help='color zones from system metrics following the REACTIVE rules of the theme '
+                             '(uses the controller directly)')
+    parser.add_argument('--PLAYLIST', nargs='+', metavar='THEME_FILE',
+                        help='show these themes in turn, each for its DURATION (uses the controller directly)')
+    parser.add_argument('--SHUFFLE', action='store_true', help='shuffle --PLAYLIST at every cycle')
+    parser.add_argument('--CYCLES', type=int, help='times to go through --PLAYLIST, forever if not given')
+    parser.add_argument('--FPS', type=float, default=30.0, help='target frame rate of --ANIMATE')
+    parser.add_argument('--DURATION', type=float,
+                        help='seconds to run --ANIMATE, --REACTIVE or --PLAYLIST for, forever if not given')
+    parser.add_argument('--RESET', choices=['ON', 'OFF'], help='reset all lights on or off')
+    parser.add_argument('--STATUS', action='store_true', help='print controller (and daemon) status')
+    parser.add_argument('--DAEMON', action='store_true', help='run the resident daemon holding the controller')
+    parser.add_argument('--SOCKET', default=DEFAULT_SOCKET_PATH, help='unix socket of the daemon')
+    parser.add_argument('--NO_COALESCE', action='store_true',
+                        help='send one sequence per zone instead of merging zones with identical sequences')
+    parser.add_argument('--OPTIMIZE', action='store_true',
+                        help='rewrite sequences to minimal equivalent ones before compiling')
+    parser.add_argument('--FORCE', action='store_true',
+                        help='apply even if the same packets were applied last time')
+    parser.add_argument('--NO_CACHE', action='store_true', help='do not use the compiled theme cache')
+    parser.add_argument('--DIRECT', action='store_true', help='do not use the daemon even if it is running')
+    parser.add_argument('--ALL_DEVICES', action='store_true',
+                        help='apply --THEME_FILE to every controller matching a device profile, concurrently '
+                             '(uses the controllers directly, every one is sent the theme)')
+    parser.add_argument('--PROFILES', default=DEFAULT_PROFILES_FILE,
+                        help='device profiles file, adding controller models to the built-in 13 R3 profile')
+    parser.add_argument('--LOCK_TIMEOUT', type=float, default=60.0,
+                        help='seconds to wait for other processes using the controller directly')
+    parser.add_argument('--DRIVER', choices=sorted(BACKENDS.keys()), default='usb',
+                        help='driver backend, emulator runs an in-process model of the controller (implies --DIRECT '
+                             'unless running the daemon)')
+    parser.add_argument('--STATS', choices=['json'],
+                        help='print the time of each phase and the transfers of the apply in this format')
+    parser.add_argument('--PROMETHEUS_TEXTFILE',
+                        help='write the stats of the apply to this file, for the node_exporter textfile collector')
+    parser.add_argument('--LOG_LEVEL', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
+    parser.add_argument('--TRACE', help='append every USB transfer to this binary trace file (implies --DIRECT '
+                                        'unless running the daemon)')
+    parser.add_argument('--REPLAY', help='send the writes of this trace file to the controller')
+    parser.add_argument('--REPLAY_SPEED', choices=['original', 'max'], default='original',
+                        help='replay at the pace of the trace, or as fast as possible')
+    return parser
+
+
+def _viaDaemon(args, client):
+    """Serve the request using the daemon, returns None if the daemon is not running"""
+    try:
+        if args.THEME_FILE:
+            return client.apply(args.THEME_FILE, coalesce=not args.NO_COALESCE, force=args.FORCE,
+                                cache=not args.NO_CACHE, optimize=args.OPTIMIZE)
+        elif args.RESET:
+            return client.reset(args.RESET == 'ON')
+        else:
+            return client.status()
+    except DaemonUnavailableError as exc:
+        logging.debug('Daemon not used: {}'.format(exc))
+        return None
+
+
+def _findThemes(args, query=None, name=None):
+    """Index entries of the themes matching query or name, from the daemon if it is running"""
+    if args.THEMES_DIRECTORY is None and not args.DIRECT and args.DRIVER == 'usb':
+        try:
+            response = AlienwareDaemonClient(args.SOCKET).themes(query, name)
+            if response.get('ok', False):
+                return response['themes']
+        except DaemonUnavailableError as exc:
+            logging.debug('Daemon not used: {}'.format(exc))
+    library = ThemeLibrary(args.THEMES_DIRECTORY).load()
+    library.rescan()
+    return library.select(query, name)
+
+
+def _formatThemeEntry(entry):
+    if 'error' in entry:
+        return '{:24s} {}'.format(entry['name'], entry['error'])
+    return '{:24s} tempo {:<5} {:6s} {} [{}]'.format(entry['name'], entry['tempo'],
+                                                    'random' if entry['random'] else '', entry['description'],
+                                                    ', '.join(entry['zones']))
+
+
+def _makeApplyState(args):
+    # What an emulated device shows must not be mistaken for what the real one shows
+    return ApplyState().load() if args.DRIVER == 'usb' else ApplyState(stateFile=None)
+
+
+def _makeWaitStrategy(args):
+    # BUSY durations of an emulated device are not those of the real one
+    return ReadyWaitStrategy(stats=ReadyWaitStats(statsFile=DEFAULT_STATS_FILE).load() if args.DRIVER == 'usb'
+                             else None)
+
+
+def _makeDriver(args):
+    driver = makeDriver(args.DRIVER)
+    if args.TRACE:
+        driver.tracer = TraceRecorder(args.TRACE)
+    return driver
+
+
+def _releaseDriver(driver):
+    driver.release()
+    if driver.tracer is not None:
+        driver.tracer.close()
+
+
+def _makeControllerLock(args):
+    return ControllerLock(DEFAULT_LOCK_FILE if args.DRIVER == 'usb' else None, timeout=args.LOCK_TIMEOUT)
+
+
+def _direct(args):
+    # Only the latest of concurrent requests to change the lights is applied, status requests are not skipped
+    try:
+        request = _makeControllerLock(args).acquire(coalesce=bool(args.THEME_FILE or args.RESET))
+    except LockTimeoutError as exc:
+        return {'ok': False, 'error': str(exc)}
+    with request:
+        if request.superseded:
+            response = {'ok': True}
+        else:
+            response = _directLocked(args)
+    response.update(request.report())
+    if request.coalesced:
+        logging.info('Applied in place of {} earlier requests, after waiting {:.3f}s for the controller'
+                     .format(request.coalesced, request.lockWait))
+    return response
+
+
+def _applyDirect(args, ac):
+    cache = None if args.NO_CACHE else CompiledThemeCache()
+    theme = AlienwareTheme(args.THEME_FILE)
+    stats = ApplyStats()
+    try:
+        ok = theme.apply(ac, coalesce=not args.NO_COALESCE, state=_makeApplyState(args), force=args.FORCE,
+                         cache=cache, stats=stats, optimize=args.OPTIMIZE)
+    finally:
+        # Released here rather than by the caller so that it is timed too
+        with stats.phase('release'):
+            ac.driver.release()
+    return {'ok': ok, 'stats': stats.summary()}
+
+
+def _directLocked(args):
+    ac = AC(waitStrategy=_makeWaitStrategy(args), driver=_makeDriver(args))
+    try:
+        if args.THEME_FILE:
+            return _applyDirect(args, ac)
+
+        ac.driver.acquire()
+        if args.RESET:
+            _makeApplyState(args).clear()
+            resetName = AC.Reset.ALL_LIGHTS_ON if args.RESET == 'ON' else AC.Reset.ALL_LIGHTS_OFF
+            ac.reset(AC.Reset.CODES[resetName])
+            ac.waitUntilControllerReady(AC.Commands.RESET)
+            return {'ok': True}
+        return {'ok': True, 'ready': ac.getStatus()}
+    except (ControllerNotReadyError, DeviceNotFoundError) as exc:
+        return {'ok': False, 'error': str(exc)}
+    finally:
+        _releaseDriver(ac.driver)
+        # Saved with the controller lock still held, so that concurrent requests do not overwrite each other
+        ac.waitStrategy.stats.save()
+
+
+def _applyAllDevices(args):
+    try:
+        request = _makeControllerLock(args).acquire()
+    except LockTimeoutError as exc:
+        logging.error(str(exc))
+        return 1
+    with request:
+        if request.superseded:
+            return 0
+        drivers = discoverDrivers(args.DRIVER, ProfileRegistry().load(args.PROFILES))
+        if not drivers:
+            logging.error('No controller matching a device profile found')
+            return 1
+        if args.DRIVER == 'usb':
+            # The 13 R3 may be reprogrammed, what it shows no longer matches the last apply
+            _makeApplyState(args).clear()
+        cache = None if args.NO_CACHE else CompiledThemeCache()
+        results = FanOutApplier(drivers, coalesce=not args.NO_COALESCE, optimize=args.OPTIMIZE,
+                                cache=cache).apply(AlienwareTheme(args.THEME_FILE))
+
+    for result in results:
+        logging.info('{} {}: {} in {:.3f}s'.format(result.profile.name, result.driver.deviceAddress,
+                                                 'ok' if result.ok else result.error, result.latency or 0.0))
+    if args.STATS == 'json':
+        print(json.dumps([result.summary() for result in results]))
+    if args.PROMETHEUS_TEXTFILE:
+        logging.warning('--PROMETHEUS_TEXTFILE is not written with --ALL_DEVICES')
+    return 0 if all(result.ok for result in results) else 1
+
+
+def _withControllerLock(args, run):
+    """Runs run(args) holding the controller lock, for modes driving the controller for a while
+
+    They are not coalesced: a later apply waits for them instead of making them skip.
+    """
+    try:
+        request = _makeControllerLock(args).acquire(coalesce=False)
+    except LockTimeoutError as exc:
+        logging.error(str(exc))
+        return 1
+    with request:
+        return run(args)
+
+
+def _replay(args):
+    driver = _makeDriver(args)
+    try:
+        driver.acquire()
+        # What the lights show no longer matches the last apply
+        _makeApplyState(args).clear()
+        stats = TraceReplayer(args.REPLAY).replay(driver, maxSpeed=args.REPLAY_SPEED == 'max')
+    except DeviceNotFoundError as exc:
+        logging.error(str(exc))
+        return 1
+    finally:
+        _releaseDriver(driver)
+    print(stats)
+    return 0
+
+
+def _animate(args):
+    ac = AC(driver=_makeDriver(args))
+    # What the lights show no longer matches the last apply
+    _makeApplyState(args).clear()
+    try:
+        stats = AlienwareAnimator(ac, EFFECTS[args.ANIMATE](), args.FPS).run(args.DURATION)
+    except (ControllerNotReadyError, DeviceNotFoundError) as exc:
+        logging.error(str(exc))
+        return 1
+    finally:
+        _releaseDriver(ac.driver)
+    print(stats.summary())
+    return 0
+
+
+def _playPlaylist(args):
+    cache = None if args.NO_CACHE else CompiledThemeCache()
+    ac = AC(driver=_makeDriver(args))
+    try:
+        try:
+            player = PlaylistPlayer(ac, args.PLAYLIST, shuffle=args.SHUFFLE, coalesce=not args.NO_COALESCE,
+                                    cache=cache, state=_makeApplyState(args), optimize=args.OPTIMIZE)
+        except RuntimeError as exc:
+            logging.error('Invalid playlist: {}'.format(exc))
+            return 1
+        stats = player.run(args.CYCLES, args.DURATION)
+    except (ControllerNotReadyError, DeviceNotFoundError) as exc:
+        logging.error(str(exc))
+        return 1
+    finally:
+        _releaseDriver(ac.driver)
+    print(stats.summary())
+    return 0
+
+
+def _react(args):
+    rules, rate = AlienwareTheme(args.THEME_FILE).validateReactive()
+    if not rules:
+        logging.error('No valid REACTIVE rules in {}'.format(args.THEME_FILE))
+        return 1
+    effect = ReactiveEffect(rules)
+    try:
+        ac = AC(driver=_makeDriver(args))
+        _makeApplyState(args).clear()
+        try:
+            stats = AlienwareAnimator(ac, effect, rate).run(args.DURATION)
+        finally:
+            _releaseDriver(ac.driver)
+    except (ControllerNotReadyError, DeviceNotFoundError) as exc:
+        logging.error(str(exc))
+        return 1
+    finally:
+        # The metrics files are kept open
+        effect.close()
+    print(stats.summary())
+    return 0
+
+
+def _reportStats(args, summary):
+    if summary is None:
+        return
+    if args.STATS == 'json':
+        print(json.dumps(summary))
+    if args.PROMETHEUS_TEXTFILE:
+        try:
+            writePrometheusTextfile(ApplyStats.fromSummary(summary), args.PROMETHEUS_TEXTFILE)
+        except (IOError, OSError) as exc:
+            logging.error('Could not write stats to {}: {}'.format(args.PROMETHEUS_TEXTFILE, exc))
+
+
+def main(argv=None):
+    parser = makeParser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=getattr(logging, args.LOG_LEVEL), stream=sys.stdout, )
+
+    if args.DAEMON:
+        driver = _makeDriver(args)
+        try:
+            AlienwareDaemon(args.SOCKET, driver=driver, themesDirectory=args.THEMES_DIRECTORY).serveForever()
+        finally:
+            if driver.tracer is not None:
+                driver.tracer.close()
+        return 0
+
+    if args.REPLAY:
+        return _withControllerLock(args, _replay)
+
+    if args.LIST or args.SEARCH is not None:
+        for entry in _findThemes(args, query=args.SEARCH):
+            print(_formatThemeEntry(entry))
+        return 0
+
+    if args.THEME:
+        themes = _findThemes(args, name=args.THEME)
+        if not themes:
+            logging.error('No theme named {}'.format(args.THEME))
+            return 1
+        args.THEME_FILE = themes[0]['path']
+
+    if args.ANIMATE:
+        return _withControllerLock(args, _animate)
+
+    if args.PLAYLIST:
+        return _withControllerLock(args, _playPlaylist)
+
+    if args.REACTIVE:
+        if not args.THEME_FILE:
+            print('Need a theme file with REACTIVE rules')
+            return 1
+        return _withControllerLock(args, _react)
+
+    if args.ALL_DEVICES:
+        if not args.THEME_FILE:
+            print('Need a theme file')
+            return 1
+        return _applyAllDevices(args)
+
+    if not (args.THEME_FILE or args.RESET or args.STATUS):
+        print('Need a theme file')
+        return 1
+
+    response = None
+    if not args.DIRECT and not args.TRACE and args.DRIVER == 'usb':
+        response = _viaDaemon(args, AlienwareDaemonClient(args.SOCKET))
+    if response is None:
+        response = _direct(args)
+
+    if args.STATUS:
+        print(response)
+    _reportStats(args, response.get('stats'))
+    if not response.get('ok', False):
+        logging.error(response.get('error', 'Request failed'))
+        return 1
+    return 0
@@ -0,0 +1,150 @@
+import logging
+from collections import OrderedDict
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.packets import PacketBatch
+
+
+def effectKey(effect):
+    """Hashable form of a validated effect, two effects with equal keys compile to the same packet"""
+    effectName = effect['EFFECT']
+    if effectName == AC.Commands.SET_COLOR or effectName == AC.Commands.BLINK_COLOR:
+        return effectName, tuple(effect['COLOR'])
+    elif effectName == AC.Commands.MORPH_COLOR:
+        return effectName, tuple(effect['COLOR1']), tuple(effect['COLOR2'])
+    elif effectName == AC.Commands.LOOP_SEQUENCE:
+        return effectName,
+    raise RuntimeError('Invalid effect code')
+
+
+def coalesceZones(zoneCodeSequenceMap):
+    """Groups zones having identical sequences
+
+    Returns an ordered map of OR'd zone codes to sequences, empty sequences are dropped.
+    Must be called after random colors are resolved (i.e. after validate), otherwise nothing would coalesce.
+    """
+    groups = OrderedDict()
+    for zoneCode, sequence in zoneCodeSequenceMap.items():
+        if len(sequence) == 0:
+            continue
+        key = tuple(effectKey(effect) for effect in sequence)
+        if key in groups:
+            zoneMask, _ = groups[key]
+            groups[key] = (zoneMask | zoneCode, sequence)
+        else:
+            groups[key] = (zoneCode, sequence)
+    return OrderedDict(groups.values())
+
+
+def addSequencePackets(batch, sequenceId, zoneCode, sequence, powerStateCode=None):
+    """Adds the packets of a validated sequence to a PacketBatch
+
+    With a powerStateCode, each packet is preceded by a SAVE_NEXT, so that it is saved in that power state slot.
+    """
+    for effect in sequence:
+        effectName = effect['EFFECT']
+        if powerStateCode is not None:
+            batch.addSaveNextCmd(powerStateCode)
+        if effectName == AC.Commands.SET_COLOR:
+            batch.addSetColorCmd(sequenceId, zoneCode, effect['COLOR'])
+        elif effectName == AC.Commands.BLINK_COLOR:
+            batch.addBlinkColorCmd(sequenceId, zoneCode, effect['COLOR'])
+        elif effectName == AC.Commands.MORPH_COLOR:
+            batch.addMorphColorCmd(sequenceId, zoneCode, effect['COLOR1'], effect['COLOR2'])
+        elif effectName == AC.Commands.LOOP_SEQUENCE:
+            batch.addLoopSequenceCmd()
+        else:
+            raise RuntimeError('Invalid effect code')
+
+
+class CompiledTheme:
+    """Packet stream of a theme
+
+    A tempo packet, one packet list per zone sequence, the packets of each power state slot followed by a SAVE
+    (if the theme has power states) and an execute packet.
+    """
+
+    def __init__(self, tempo, duration, sequences, numPacketsUncoalesced=None, powerStates=None):
+        self.tempo = tempo
+        self.duration = duration
+        # list of (zoneCode, packets)
+        self.sequences = sequences
+        # list of (powerStateCode, packets), packets alternate SAVE_NEXT and a sequence packet
+        self.powerStates = powerStates if powerStates is not None else []
+        self.numPacketsUncoalesced = numPacketsUncoalesced if numPacketsUncoalesced is not None else self.numPackets
+        self._framing = PacketBatch(3)
+        self._framing.addSetTempoCmd(tempo)
+        self._framing.addExecuteCmd()
+        self._framing.addSaveCmd()
+
+    @property
+    def commands(self):
+        commands = [self._framing.packet(0)]
+        for _, packets in self.sequences:
+            commands.extend(packets)
+        if self.powerStates:
+            for _, packets in self.powerStates:
+                commands.extend(packets)
+            commands.append(self._framing.packet(2))
+        commands.append(self._framing.packet(1))
+        return commands
+
+    @property
+    def numPackets(self):
+        numPackets = 2 + sum(len(packets) for _, packets in self.sequences)
+        if self.powerStates:
+            numPackets += 1 + sum(len(packets) for _, packets in self.powerStates)
+        return numPackets
+
+    def isEmpty(self):
+        return len(self.sequences) == 0 and len(self.powerStates) == 0
+
+
+def _groupZones(zoneCodeSequenceMap, coalesce):
+    if coalesce:
+        return coalesceZones(zoneCodeSequenceMap)
+    return OrderedDict((zoneCode, sequence) for zoneCode, sequence in zoneCodeSequenceMap.items() if len(sequence) > 0)
+
+
+def compileTheme(tempo, duration, zoneCodeSequenceMap, coalesce=True, powerStateZoneSequenceMaps=None):
+    """Compiles a validated zone sequence map to packets, coalescing zones with identical sequences if asked
+
+    powerStateZoneSequenceMaps maps power state codes to validated zone sequence maps to be saved in their slots,
+    so that the firmware switches to them by itself.
+    """
+    numPacketsUncoalesced = 2 + sum(len(sequence) for sequence in zoneCodeSequenceMap.values())
+    zoneCodeSequenceMap = _groupZones(zoneCodeSequenceMap, coalesce)
+    numPackets = sum(len(sequence) for sequence in zoneCodeSequenceMap.values())
+
+    powerStateGroups = []
+    for powerStateCode, powerStateZoneSequenceMap in (powerStateZoneSequenceMaps or {}).items():
+        groups = _groupZones(powerStateZoneSequenceMap, coalesce)
+        if len(groups) == 0:
+            continue
+        # SAVE_NEXT and the packet, per packet of the slot
+        numPacketsUncoalesced += 2 * sum(len(sequence) for sequence in powerStateZoneSequenceMap.values())
+        numPackets += 2 * sum(len(sequence) for sequence in groups.values())
+        powerStateGroups.append((powerStateCode, groups))
+    if powerStateGroups:
+        # SAVE
+        numPacketsUncoalesced += 1
+
+    # All sequence packets are built into one buffer
+    batch = PacketBatch(numPackets)
+    sequences = []
+    for sequenceId, (zoneCode, sequence) in enumerate(zoneCodeSequenceMap.items()):
+        start = len(batch)
+        addSequencePackets(batch, sequenceId, zoneCode, sequence)
+        sequences.append((zoneCode, batch.packets(start)))
+
+    powerStates = []
+    for powerStateCode, groups in powerStateGroups:
+        start = len(batch)
+        for sequenceId, (zoneCode, sequence) in enumerate(groups.items()):
+            addSequencePackets(batch, sequenceId, zoneCode, sequence, powerStateCode)
+        powerStates.append((powerStateCode, batch.packets(start)))
+
+    compiled = CompiledTheme(tempo, duration, sequences, numPacketsUncoalesced, powerStates)
+    logging.info('Theme compiled to {} sequences, {} power states, {} packets ({} packets without zone coalescing)'
+                 .format(len(sequences), len(powerStates), compiled.numPackets, compiled.numPacketsUncoalesced))
+    return compiled
@@ -1,6 +1,9 @@
 import logging
+import struct
 
+from alieneffects.transaction import BatchSender
 from alieneffects.usbdriver import AlienwareUSBDriver
+from alieneffects.wait import ReadyWaitStrategy
 
 
 class AlienwareController:
@@ -86,12 +89,15 @@ class AlienwareController:
             SET_TEMPO: 0xe
         }
 
+        # Sending these again leaves the controller in the same state as sending them once
+        RETRY_SAFE = (SET_TEMPO, EXECUTE, GET_STATUS, RESET, SAVE_NEXT, SAVE)
+
     class Status:
         BUSY = 0x11
         READY = 0x10
         UNKNOWN = 0x12
 
-    def __init__(self):
+    def __init__(self, waitStrategy=None, driver=None, batchSender=None):
         c = self.Commands.CODES
         self.commandParsers = {
             c[self.Commands.MORPH_COLOR]: self._parseCmdMorphColor,
@@ -105,49 +111,67 @@ class AlienwareController:
             c[self.Commands.SAVE]: self._parseCmdSave,
             c[self.Commands.SET_TEMPO]: self._parseCmdSetTempo,
         }
-        self.driver = AlienwareUSBDriver()
+        self.driver = driver if driver is not None else AlienwareUSBDriver()
+        self.waitStrategy = waitStrategy if waitStrategy is not None else ReadyWaitStrategy()
+        self.batchSender = batchSender if batchSender is not None else BatchSender(
+            retrySafeCodes=[c[command] for command in self.Commands.RETRY_SAFE])
+
+    # Packets are only formatted and described when debug logging is enabled, the checks are hoisted out of loops
+    def _logPacket(self, pkt):
+        logging.debug("writing command: %s", list(pkt))
+        logging.debug("description: %s", self.pktToString(pkt))
 
     def getStatus(self):
         pkt = self.makeGetStatusCmd()
-        logging.debug("writing command: {}".format(pkt))
-        logging.debug("description: {}".format(self.pktToString(pkt)))
+        isDebug = logging.root.isEnabledFor(logging.DEBUG)
+        if isDebug:
+            self._logPacket(pkt)
         self.driver.writePacket(pkt)
         response = self.driver.readPacket()
         isReady = response[0] == self.Status.READY
-        if isReady:
-            logging.debug('Pinged, STATUS_READY')
-        else:
-            logging.debug('Pinged, STATUS_BUSY')
+        if isDebug:
+            logging.debug('Pinged, STATUS_READY' if isReady else 'Pinged, STATUS_BUSY')
         return isReady
 
     def reset(self, resetCode):
         pkt = self.makeResetCmd(resetCode)
-        logging.debug("writing command: {}".format(pkt))
-        logging.debug("description: {}".format(self.pktToString(pkt)))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            self._logPacket(pkt)
         self.driver.writePacket(pkt)
 
-    def waitUntilControllerReady(self):
-        isReady = False
-        errCount = 0
-        while not isReady:
-            try:
-                isReady = self.getStatus()
-            except TypeError:
-                errCount += 1
-                logging.debug("No Status received yet... Num failed tries={}".format(errCount))
-
-            if errCount > 50:
-                logging.error("Controller status could not be retrieved. Is the device already in use?")
-                exit(-1)
+    def waitUntilControllerReady(self, reason=None):
+        """Waits using the wait strategy, reason (ex. Commands.RESET) is what made the controller busy
+
+        Raises ControllerNotReadyError if the controller does not become ready.
+        """
+        polls = self.waitStrategy.wait(self.getStatus, reason)
         logging.debug('Controller Ready')
+        return polls
 
     def sendCommands(self, cmds):
+        isDebug = logging.root.isEnabledFor(logging.DEBUG)
         for cmd in cmds:
-            logging.debug("writing command: {}".format(cmd))
-            logging.debug("description: {}".format(self.pktToString(cmd)))
+            if isDebug:
+                self._logPacket(cmd)
             self.driver.writePacket(cmd)
 
-    # Make command packet methods
+    def sendTransaction(self, cmds, restart=None):
+        """Sends cmds checking every transfer and retrying failures with the batch sender, returns a BatchResult
+
+        restart is called to get back to the start of cmds (ex. RESET and wait) when a failed packet cannot
+        be resent in place. Unlike sendCommands, failures are not only logged, check BatchResult.ok.
+        """
+        if logging.root.isEnabledFor(logging.DEBUG):
+            cmds = list(cmds)
+            for cmd in cmds:
+                self._logPacket(cmd)
+        return self.batchSender.send(self.driver, cmds, restart)
+
+    def sendBatch(self, batch):
+        """Sends all packets of a PacketBatch, as zero copy slices of its buffer"""
+        self.sendCommands(batch.packets())
+
+    # Validate command packet fields methods
     @staticmethod
     def _validateColor(color):
         for band in color:
@@ -174,115 +198,141 @@ class AlienwareController:
         if not (isinstance(powerStateCode, int) and powerStateCode in cls.PowerStates.CODES.values()):
             raise RuntimeError('Invalid power state')
 
+    # Pack command packet methods
+    # Each command has a fixed layout template of PACKET_LENGTH bytes (unused bytes are zero)
+    #   byte 0 is always 0x02, byte 1 is the command code
+    #   zone codes are 24 bit big endian, packed as a high byte and a 16 bit word
+    PACKET_LENGTH = 12
+    _PLAIN_TEMPLATE = struct.Struct('>BB10x')
+    _BYTE_TEMPLATE = struct.Struct('>BBB9x')
+    _TEMPO_TEMPLATE = struct.Struct('>BBH8x')
+    _COLOR_TEMPLATE = struct.Struct('>BBBBH3B3x')
+    _MORPH_TEMPLATE = struct.Struct('>BBBBH6B')
+
     @classmethod
-    def makeGetStatusCmd(cls):
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.GET_STATUS], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        return pkt
+    def packGetStatusCmd(cls, buffer, offset):
+        cls._PLAIN_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.GET_STATUS])
 
     @classmethod
-    def makeResetCmd(cls, resetCode):
+    def packResetCmd(cls, buffer, offset, resetCode):
         cls._validateResetCode(resetCode)
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.RESET], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        pkt[2] = resetCode & 0xff
-        return pkt
+        cls._BYTE_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.RESET], resetCode & 0xff)
 
     @classmethod
-    def makeMorphColorCmd(cls, sequence, zoneCode, color1, color2):
+    def packMorphColorCmd(cls, buffer, offset, sequence, zoneCode, color1, color2):
         cls._validateZoneCode(zoneCode)
         cls._validateColor(color1)
         cls._validateColor(color2)
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.MORPH_COLOR], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        pkt[2] = sequence & 0xff
-        pkt[3:6] = [(zoneCode & 0xff0000) >> 16, (zoneCode & 0xff00) >> 8, zoneCode & 0xff]
         (red1, green1, blue1) = color1
         (red2, green2, blue2) = color2
-        pkt[6:12] = [red1, green1, blue1, red2, green2, blue2]
-        return pkt
+        cls._MORPH_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.MORPH_COLOR],
+                                      sequence & 0xff, (zoneCode & 0xff0000) >> 16, zoneCode & 0xffff,
+                                      red1, green1, blue1, red2, green2, blue2)
 
     @classmethod
-    def makeBlinkColorCmd(cls, sequence, zoneCode, color):
+    def packBlinkColorCmd(cls, buffer, offset, sequence, zoneCode, color):
         cls._validateZoneCode(zoneCode)
         cls._validateColor(color)
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.BLINK_COLOR], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        pkt[2] = sequence & 0xff
-        pkt[3:6] = [(zoneCode & 0xff0000) >> 16, (zoneCode & 0xff00) >> 8, zoneCode & 0xff]
-        pkt[6:9] = color
-        return pkt
+        (red, green, blue) = color
+        cls._COLOR_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.BLINK_COLOR],
+                                      sequence & 0xff, (zoneCode & 0xff0000) >> 16, zoneCode & 0xffff,
+                                      red, green, blue)
 
     @classmethod
-    def makeSetColorCmd(cls, sequence, zoneCode, color):
+    def packSetColorCmd(cls, buffer, offset, sequence, zoneCode, color):
         cls._validateZoneCode(zoneCode)
         cls._validateColor(color)
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.SET_COLOR], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        pkt[2] = sequence & 0xff
-        pkt[3:6] = [(zoneCode & 0xff0000) >> 16, (zoneCode & 0xff00) >> 8, zoneCode & 0xff]
-        pkt[6:9] = color
-        return pkt
+        (red, green, blue) = color
+        cls._COLOR_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.SET_COLOR],
+                                      sequence & 0xff, (zoneCode & 0xff0000) >> 16, zoneCode & 0xffff,
+                                      red, green, blue)
+
+    @classmethod
+    def packLoopSequenceCmd(cls, buffer, offset):
+        cls._PLAIN_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.LOOP_SEQUENCE])
+
+    @classmethod
+    def packSetTempoCmd(cls, buffer, offset, tempo):
+        cls._validateTempo(tempo)
+        cls._TEMPO_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.SET_TEMPO], tempo & 0xffff)
+
+    @classmethod
+    def packExecuteCmd(cls, buffer, offset):
+        cls._PLAIN_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.EXECUTE])
+
+    @classmethod
+    def packSaveNextCmd(cls, buffer, offset, powerStateCode):
+        cls._validatePowerStateCode(powerStateCode)
+        cls._BYTE_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.SAVE_NEXT],
+                                     powerStateCode & 0xff)
+
+    @classmethod
+    def packSaveCmd(cls, buffer, offset):
+        cls._PLAIN_TEMPLATE.pack_into(buffer, offset, 0x02, cls.Commands.CODES[cls.Commands.SAVE])
+
+    # Make command packet methods
+    # Thin wrappers over the pack methods returning a packet as a list
+    @classmethod
+    def _makeCmd(cls, packMethod, *args):
+        pkt = bytearray(cls.PACKET_LENGTH)
+        packMethod(pkt, 0, *args)
+        return list(pkt)
+
+    @classmethod
+    def makeGetStatusCmd(cls):
+        return cls._makeCmd(cls.packGetStatusCmd)
+
+    @classmethod
+    def makeResetCmd(cls, resetCode):
+        return cls._makeCmd(cls.packResetCmd, resetCode)
+
+    @classmethod
+    def makeMorphColorCmd(cls, sequence, zoneCode, color1, color2):
+        return cls._makeCmd(cls.packMorphColorCmd, sequence, zoneCode, color1, color2)
+
+    @classmethod
+    def makeBlinkColorCmd(cls, sequence, zoneCode, color):
+        return cls._makeCmd(cls.packBlinkColorCmd, sequence, zoneCode, color)
+
+    @classmethod
+    def makeSetColorCmd(cls, sequence, zoneCode, color):
+        return cls._makeCmd(cls.packSetColorCmd, sequence, zoneCode, color)
 
     @classmethod
     def makeLoopSequenceCmd(cls):
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.LOOP_SEQUENCE], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        return pkt
+        return cls._makeCmd(cls.packLoopSequenceCmd)
 
     @classmethod
     def makeSetTempoCmd(cls, tempo):
-        cls._validateTempo(tempo)
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.SET_TEMPO], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        pkt[2:4] = [(tempo & 0xff00) >> 8, tempo & 0xff]
-        return pkt
+        return cls._makeCmd(cls.packSetTempoCmd, tempo)
 
     @classmethod
     def makeExecuteCmd(cls):
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.EXECUTE], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        return pkt
+        return cls._makeCmd(cls.packExecuteCmd)
 
     @classmethod
     def makeSaveNextCmd(cls, powerStateCode):
-        cls._validatePowerStateCode(powerStateCode)
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.SAVE_NEXT], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        pkt[2] = powerStateCode & 0xff
-        return pkt
+        return cls._makeCmd(cls.packSaveNextCmd, powerStateCode)
 
     @classmethod
     def makeSaveCmd(cls):
-        pkt = [0x02, cls.Commands.CODES[cls.Commands.SAVE], 0,
-               0, 0, 0,
-               0, 0, 0,
-               0, 0, 0]
-        return pkt
+        return cls._makeCmd(cls.packSaveCmd)
 
     # Describe command packet methods
+    # Zone mask -> description, a packet stream only uses a handful of distinct masks
+    _zoneNames = {}
+
     def getZoneName(self, pkt):
         zonesMask = (pkt[0] << 16) + (pkt[1] << 8) + pkt[2]
+        zoneName = self._zoneNames.get(zonesMask)
+        if zoneName is None:
+            zoneName = self._zoneNames[zonesMask] = self._describeZoneMask(zonesMask)
+        return zoneName
+
+    @classmethod
+    def _describeZoneMask(cls, zonesMask):
         zoneNames = []
-        for name, code in self.Zones.CODES.items():
+        for name, code in cls.Zones.CODES.items():
             if zonesMask & code:
                 zoneNames.append(name)
                 zonesMask &= ~code
@@ -291,7 +341,7 @@ class AlienwareController:
         return ', '.join(zoneNames)
 
     def getPowerStateName(self, powerStateCode):
-        for name, code in self.PowerStates.CODES:
+        for name, code in self.PowerStates.CODES.items():
             if code == powerStateCode:
                 return name
         return "UNKNOWN_POWER_STATE_CODE"
@@ -303,11 +353,7 @@ class AlienwareController:
         return "UNKNOWN_RESET_CODE"
 
     def pktToString(self, pkt):
-        cmd = pkt[1]
-        if cmd in list(self.commandParsers.keys()):
-            return self.commandParsers[cmd](pkt)
-        else:
-            return self._parseCmdUnknown(pkt)
+        return self.commandParsers.get(pkt[1], self._parseCmdUnknown)(pkt)
 
     @staticmethod
     def _unpackColorPair(pkt):
@@ -378,4 +424,4 @@ class AlienwareController:
         return "SET_TEMPO: {} ms".format((pkt[2] << 8) + pkt[3])
 
     def _parseCmdUnknown(self, pkt):
-        return "UNKNOWN COMMAND : {} IN PACKET {}".format(pkt[1], pkt)
+        return "UNKNOWN COMMAND : {} IN PACKET {}".format(pkt[1], list(pkt))
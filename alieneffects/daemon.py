@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+
+from alieneffects.cache import CompiledThemeCache
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.library import InotifyWatcher, ThemeLibrary
+from alieneffects.state import ApplyState
+from alieneffects.stats import ApplyStats
+from alieneffects import usbdriver
+from alieneffects.theme import AlienwareTheme
+from alieneffects.transaction import TransferError
+from alieneffects.usbdriver import AlienwareUSBDriver, DeviceNotFoundError
+from alieneffects.wait import ControllerNotReadyError, ReadyWaitStats, ReadyWaitStrategy, DEFAULT_STATS_FILE
+
+DEFAULT_SOCKET_PATH = '/run/alieneffects-13r3.sock'
+
+
+class BadRequestError(RuntimeError):
+    """Raised by request handlers for a request the client got wrong, the controller is kept"""
+    pass
+
+
+class DaemonUnavailableError(RuntimeError):
+    """Raised by the client when no daemon is listening on the socket, or when it does not answer"""
+    pass
+
+
+def _sendMessage(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def _recvMessage(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+class AlienwareDaemon:
+    """Keeps the USB controller claimed and serves apply/reset/status/themes requests over a unix socket
+
+    Requests and responses are single line json objects.
+    Requests are served one at a time, which also serializes access to the controller.
+    A client has connectionTimeout seconds to send its request, so that a stuck one does not block the others.
+    The themes index is kept up to date with inotify where available.
+    """
+
+    # Commands which do not use the controller
+    LIBRARY_COMMANDS = ('themes',)
+
+    def __init__(self, socketPath=DEFAULT_SOCKET_PATH, socketMode=0o660, driver=None, themesDirectory=None,
+                 connectionTimeout=5.0):
+        self.socketPath = socketPath
+        self.socketMode = socketMode
+        self.connectionTimeout = connectionTimeout
+        # The state and BUSY durations of an emulated device are not persisted, see cli
+        isUsb = driver is None or type(driver) is AlienwareUSBDriver
+        self.controller = AC(waitStrategy=ReadyWaitStrategy(stats=ReadyWaitStats(statsFile=DEFAULT_STATS_FILE).load()
+                                                            if isUsb else None), driver=driver)
+        self.applyState = ApplyState().load() if isUsb else ApplyState(stateFile=None)
+        self.cache = CompiledThemeCache()
+        self.lastThemeFile = None
+        self.numRequests = 0
+        self.library = ThemeLibrary(themesDirectory).load()
+        self.watcher = None
+        self.handlers = {
+            'apply': self._handleApply,
+            'reset': self._handleReset,
+            'status': self._handleStatus,
+            'themes': self._handleThemes,
+        }
+
+    def serveForever(self):
+        # SIGTERM (ex. from systemd) should cleanup just like Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.socketPath)
+            os.chmod(self.socketPath, self.socketMode)
+            server.listen(8)
+            try:
+                self.controller.driver.acquire()
+            except DeviceNotFoundError as exc:
+                # Requests retry acquiring, ex. for a daemon started before the device is enumerated
+                logging.warning(str(exc))
+            try:
+                self.watcher = InotifyWatcher(self.library.themesDirectory)
+            except OSError as exc:
+                logging.warning('Not watching themes directory, the index is rescanned per request: {}'.format(exc))
+            self.library.rescan()
+            logging.info('Daemon listening on {}'.format(self.socketPath))
+            while True:
+                readable, _, _ = select.select([server] + ([self.watcher] if self.watcher else []), [], [])
+                if self.watcher in readable:
+                    self.library.update(self.watcher.readNames())
+                if server in readable:
+                    conn, _ = server.accept()
+                    conn.settimeout(self.connectionTimeout)
+                    with conn:
+                        self._serve(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if self.watcher is not None:
+                self.watcher.close()
+                self.watcher = None
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            self.controller.driver.release()
+            self.controller.waitStrategy.stats.save()
+            logging.info('Daemon stopped')
+
+    def _serve(self, conn):
+        try:
+            request = _recvMessage(conn)
+        except (OSError, ValueError) as exc:
+            logging.error('Bad request: %s', exc)
+            return
+        if request is None:
+            return
+        response = self.handle(request)
+        try:
+            _sendMessage(conn, response)
+        except OSError as exc:
+            logging.error('Could not send response: %s', exc)
+
+    def handle(self, request):
+        """Handle one request dict and return the response dict
+
+        Only failures talking to the controller release it, a bad request is reported as is.
+        """
+        self.numRequests += 1
+        command = request.get('command', '') if isinstance(request, dict) else ''
+        handler = self.handlers.get(command)
+        if handler is None:
+            return {'ok': False, 'error': 'Unknown command {}'.format(command)}
+        try:
+            if command not in self.LIBRARY_COMMANDS:
+                # No-op when still held, re-acquires after an earlier failure released the device
+                self.controller.driver.acquire()
+            return handler(request)
+        except BadRequestError as exc:
+            logging.warning('Bad %s request: %s', command, exc)
+            return {'ok': False, 'error': str(exc)}
+        except (usbdriver.USBError, TransferError, ControllerNotReadyError, DeviceNotFoundError) as exc:
+            logging.error('Controller failure while handling %s', command, exc_info=True)
+            # The device may have been unplugged or reset, so take it afresh on the next request
+            self.controller.driver.release()
+            return {'ok': False, 'error': str(exc)}
+        except Exception as exc:
+            logging.error('Exception occurred while handling %s', command, exc_info=True)
+            return {'ok': False, 'error': str(exc)}
+
+    def _handleApply(self, request):
+        themeFile = request.get('themeFile')
+        if not isinstance(themeFile, str):
+            raise BadRequestError('Missing themeFile')
+        try:
+            theme = AlienwareTheme(themeFile)
+        except (IOError, OSError) as exc:
+            raise BadRequestError('Could not read theme file {}: {}'.format(themeFile, exc))
+        stats = ApplyStats()
+        if not theme.apply(self.controller, coalesce=request.get('coalesce', True), state=self.applyState,
+                           force=request.get('force', False),
+                           cache=self.cache if request.get('cache', True) else None, stats=stats,
+                           optimize=request.get('optimize', False)):
+            if 'acquire' in stats.phases:
+                # Failed talking to the controller rather than compiling the theme
+                self.controller.driver.release()
+            return {'ok': False, 'error': 'Could not apply theme {}'.format(themeFile), 'stats': stats.summary()}
+        self.lastThemeFile = themeFile
+        return {'ok': True, 'stats': stats.summary()}
+
+    def _handleReset(self, request):
+        if request.get('lightsOn', True):
+            resetCode = AC.Reset.CODES[AC.Reset.ALL_LIGHTS_ON]
+        else:
+            resetCode = AC.Reset.CODES[AC.Reset.ALL_LIGHTS_OFF]
+        self.applyState.clear()
+        self.controller.reset(resetCode)
+        self.controller.waitUntilControllerReady(AC.Commands.RESET)
+        self.lastThemeFile = None
+        return {'ok': True}
+
+    def _handleStatus(self, request):
+        return {
+            'ok': True,
+            'ready': self.controller.getStatus(),
+            'lastThemeFile': self.lastThemeFile,
+            'numRequests': self.numRequests,
+            'readyWaits': self.controller.waitStrategy.stats.summary(),
+            'acquireTimings': self.controller.driver.acquireTimings,
+            'pid': os.getpid(),
+        }
+
+    def _handleThemes(self, request):
+        if self.watcher is None:
+            self.library.rescan()
+        return {'ok': True, 'themes': self.library.select(request.get('query'), request.get('name'))}
+
+
+class AlienwareDaemonClient:
+    """Talks to a running AlienwareDaemon"""
+
+    def __init__(self, socketPath=DEFAULT_SOCKET_PATH, timeout=30.0):
+        self.socketPath = socketPath
+        self.timeout = timeout
+
+    def isRunning(self):
+        try:
+            self.request({'command': 'status'})
+            return True
+        except DaemonUnavailableError:
+            return False
+
+    def request(self, message):
+        """Send a request and return the response
+
+        Raises DaemonUnavailableError if no daemon is listening, or if it does not answer within timeout seconds.
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        try:
+            try:
+                conn.connect(self.socketPath)
+            except OSError as exc:
+                raise DaemonUnavailableError('No daemon at {}: {}'.format(self.socketPath, exc))
+            try:
+                _sendMessage(conn, message)
+                response = _recvMessage(conn)
+            except (OSError, ValueError) as exc:
+                # ex. socket.timeout, ConnectionResetError, or a response cut short
+                raise DaemonUnavailableError('No response from daemon at {}: {}'.format(self.socketPath, exc))
+        finally:
+            conn.close()
+        if response is None:
+            raise DaemonUnavailableError('Daemon at {} closed the connection'.format(self.socketPath))
+        return response
+
+    def apply(self, themeFile, coalesce=True, force=False, cache=True, optimize=False):
+        return self.request({'command': 'apply', 'themeFile': os.path.abspath(themeFile), 'coalesce': coalesce,
+                             'force': force, 'cache': cache, 'optimize': optimize})
+
+    def reset(self, lightsOn=True):
+        return self.request({'command': 'reset', 'lightsOn': lightsOn})
+
+    def status(self):
+        return self.request({'command': 'status'})
+
+    def themes(self, query=None, name=None):
+        return self.request({'command': 'themes', 'query': query, 'name': name})
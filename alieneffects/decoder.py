@@ -0,0 +1,503 @@
+"""Decoder of captured controller traffic, for protocol analysis
+
+Reads usbmon text captures (cat /sys/kernel/debug/usb/usbmon/<bus>u), pcap and pcapng captures of usbmon
+(ex. from Wireshark) and trace files of alieneffects.trace, keeps the control transfers of the controller
+and decodes them to records, written as json lines or csv:
+    python -m alieneffects.decoder capture.pcapng --FORMAT csv --OUTPUT capture.csv
+Command, zone, power state, reset and status codes missing from AlienwareController are reported at the end.
+"""
+import argparse
+import csv
+import io
+import json
+import struct
+import sys
+from collections import Counter
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.trace import TraceRecord, TraceRecorder, readTrace
+from alieneffects.usbdriver import AlienwareUSBDriver as Driver
+
+FIELDS = ('index', 'timestamp', 'bus', 'device', 'direction', 'command', 'name', 'sequence', 'zoneMask', 'zones',
+          'color1', 'color2', 'tempo', 'argument', 'status', 'raw')
+
+# Lookup tables, indexed by byte value (or zone mask), so that decoding a packet does no searching
+COMMAND_NAMES = [None] * 256
+for _name, _code in AC.Commands.CODES.items():
+    COMMAND_NAMES[_code] = _name
+POWER_STATE_NAMES = [None] * 256
+for _name, _code in AC.PowerStates.CODES.items():
+    POWER_STATE_NAMES[_code] = _name
+RESET_NAMES = [None] * 256
+for _name, _code in AC.Reset.CODES.items():
+    RESET_NAMES[_code] = _name
+STATUS_NAMES = [None] * 256
+STATUS_NAMES[AC.Status.READY] = 'READY'
+STATUS_NAMES[AC.Status.BUSY] = 'BUSY'
+STATUS_NAMES[AC.Status.UNKNOWN] = 'UNKNOWN'
+
+KNOWN_ZONE_BITS = 0
+for _code in AC.Zones.CODES.values():
+    KNOWN_ZONE_BITS |= _code
+# Every combination of known zones -> '|' delimited names, as in theme files
+ZONE_NAMES = [None] * (KNOWN_ZONE_BITS + 1)
+for _mask in range(KNOWN_ZONE_BITS + 1):
+    if _mask & ~KNOWN_ZONE_BITS == 0:
+        ZONE_NAMES[_mask] = '|'.join(name for name, code in sorted(AC.Zones.CODES.items(), key=lambda item: item[1])
+                                     if _mask & code)
+COLORS = ['{:02x}'.format(i) for i in range(256)]
+
+OUT, IN = 'OUT', 'IN'
+WRITE_SETUP = (Driver.OUT_BM_REQUEST_TYPE, Driver.OUT_B_REQUEST, Driver.OUT_W_VALUE)
+READ_SETUP = (Driver.IN_BM_REQUEST_TYPE, Driver.IN_B_REQUEST, Driver.IN_W_VALUE)
+# GET_DESCRIPTOR(DEVICE), its response tells the vendor and product of a bus address
+DESCRIPTOR_SETUP = (0x80, 0x06, 0x0100)
+
+
+class UnknownCodes:
+    """Counts of codes which are not known to AlienwareController, with the first packet of each"""
+
+    def __init__(self):
+        self.counts = {'command': Counter(), 'zoneBits': Counter(), 'powerState': Counter(), 'reset': Counter(),
+                       'status': Counter()}
+        self.examples = {}
+
+    def add(self, kind, code, raw):
+        self.counts[kind][code] += 1
+        self.examples.setdefault((kind, code), raw)
+
+    def summary(self):
+        return {
+            kind: [{'code': hex(code), 'count': count, 'example': self.examples[(kind, code)]}
+                   for code, count in counts.most_common()]
+            for kind, counts in self.counts.items() if counts
+        }
+
+
+def _color(pkt, offset):
+    return '#' + COLORS[pkt[offset]] + COLORS[pkt[offset + 1]] + COLORS[pkt[offset + 2]]
+
+
+def _decodeColors(pkt, record, unknown, raw, numColors):
+    zoneMask = (pkt[3] << 16) | (pkt[4] << 8) | pkt[5]
+    record['sequence'] = pkt[2]
+    record['zoneMask'] = zoneMask
+    if zoneMask <= KNOWN_ZONE_BITS and ZONE_NAMES[zoneMask] is not None:
+        record['zones'] = ZONE_NAMES[zoneMask]
+    else:
+        unknownBits = zoneMask & ~KNOWN_ZONE_BITS
+        bit = 1
+        while bit <= unknownBits:
+            if unknownBits & bit:
+                unknown.add('zoneBits', bit, raw)
+            bit <<= 1
+        zones = ZONE_NAMES[zoneMask & KNOWN_ZONE_BITS]
+        record['zones'] = zones + '|' + hex(unknownBits) if zones else hex(unknownBits)
+    record['color1'] = _color(pkt, 6)
+    if numColors == 2:
+        record['color2'] = _color(pkt, 9)
+
+
+def _decodeArgument(pkt, record, unknown, raw, names, kind):
+    name = names[pkt[2]]
+    if name is None:
+        unknown.add(kind, pkt[2], raw)
+        name = hex(pkt[2])
+    record['argument'] = name
+
+
+def _makeDecoders():
+    def decodeMorphColor(pkt, record, unknown, raw):
+        _decodeColors(pkt, record, unknown, raw, 2)
+
+    def decodeColor(pkt, record, unknown, raw):
+        _decodeColors(pkt, record, unknown, raw, 1)
+
+    def decodeReset(pkt, record, unknown, raw):
+        _decodeArgument(pkt, record, unknown, raw, RESET_NAMES, 'reset')
+
+    def decodeSaveNext(pkt, record, unknown, raw):
+        _decodeArgument(pkt, record, unknown, raw, POWER_STATE_NAMES, 'powerState')
+
+    def decodeTempo(pkt, record, unknown, raw):
+        record['tempo'] = (pkt[2] << 8) | pkt[3]
+
+    c = AC.Commands.CODES
+    decoders = [None] * 256
+    decoders[c[AC.Commands.MORPH_COLOR]] = decodeMorphColor
+    decoders[c[AC.Commands.BLINK_COLOR]] = decodeColor
+    decoders[c[AC.Commands.SET_COLOR]] = decodeColor
+    decoders[c[AC.Commands.RESET]] = decodeReset
+    decoders[c[AC.Commands.SAVE_NEXT]] = decodeSaveNext
+    decoders[c[AC.Commands.SET_TEMPO]] = decodeTempo
+    return decoders
+
+
+DECODERS = _makeDecoders()
+
+
+def decodePacket(pkt, direction=OUT, unknown=None):
+    """Record of one packet (bytes), written to the controller or, with direction IN, read from it
+
+    Records are dicts with the FIELDS which apply to the packet.
+    """
+    raw = pkt.hex()
+    record = {'direction': direction, 'raw': raw}
+    if len(pkt) < 2:
+        return record
+    if unknown is None:
+        unknown = UnknownCodes()
+    if direction == IN:
+        status = STATUS_NAMES[pkt[0]]
+        if status is None:
+            unknown.add('status', pkt[0], raw)
+            status = hex(pkt[0])
+        record['status'] = status
+        return record
+
+    cmd = pkt[1]
+    record['command'] = cmd
+    name = COMMAND_NAMES[cmd]
+    if name is None:
+        unknown.add('command', cmd, raw)
+        record['name'] = 'UNKNOWN'
+        return record
+    record['name'] = name
+    decoder = DECODERS[cmd]
+    if decoder is not None and len(pkt) >= 12:
+        decoder(pkt, record, unknown, raw)
+    return record
+
+
+# Capture readers, each yields (timestamp, bus, device, eventType, urbId, setup, data)
+# with setup a (bmRequestType, bRequest, wValue) tuple or None and data bytes
+
+# usbmon text setup words -> setup tuple, of the only requests controllerPackets looks at
+_USBMON_SETUPS = {
+    '{:02x} {:02x} {:04x}'.format(*setup): setup for setup in (WRITE_SETUP, READ_SETUP, DESCRIPTOR_SETUP)
+}
+
+
+def _readUsbmonText(path):
+    """usbmon text format 1u, see Documentation/usb/usbmon.rst of the kernel
+
+    Setups other than those of _USBMON_SETUPS are reported as None, and data only for events which may need it.
+    """
+    setups = _USBMON_SETUPS
+    # address -> (bus, device)
+    devices = {}
+    with open(path) as file:
+        for line in file:
+            # tag, timestamp, event type, address (ex. Co:1:005:0) and the rest
+            words = line.split(' ', 4)
+            if len(words) < 5 or words[3][0] != 'C':
+                continue
+            address = words[3]
+            eventType = words[2]
+            rest = words[4]
+            if eventType == 'S':
+                if rest[0] != 's':
+                    continue
+                setup = setups.get(rest[2:12])
+                if setup is None:
+                    continue
+            elif eventType == 'C' and address[1] == 'i':
+                setup = None
+            else:
+                # Completions of writes carry no data
+                continue
+            data = b''
+            equals = rest.find('=')
+            if equals >= 0:
+                data = bytes.fromhex(rest[equals + 1:].strip())
+            busDevice = devices.get(address)
+            if busDevice is None:
+                _, bus, device, _ = address.split(':')
+                busDevice = devices[address] = (int(bus), int(device))
+            yield int(words[1]) / 1e6, busDevice[0], busDevice[1], eventType, words[0], setup, data
+
+
+_USB_HEADER = struct.Struct('<QBBBBHbbqiiII8s')
+_SETUP = struct.Struct('<BBH')
+# usbmon header sizes of LINKTYPE_USB_LINUX and LINKTYPE_USB_LINUX_MMAPPED
+_USB_HEADER_SIZES = {189: 48, 220: 64}
+
+
+def _usbEvent(timestamp, frame, headerSize):
+    urbId, eventType, transferType, _, device, bus, flagSetup, _, _, _, _, _, _, setup = \
+        _USB_HEADER.unpack_from(frame, 0)
+    if transferType != 2:
+        return None
+    return (timestamp, bus, device, chr(eventType), urbId,
+            _SETUP.unpack_from(setup, 0) if flagSetup == 0 else None, frame[headerSize:])
+
+
+def _readPcap(path):
+    with open(path, 'rb') as file:
+        header = file.read(24)
+        magic = struct.unpack_from('<I', header, 0)[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            order = '<'
+        else:
+            order = '>'
+            magic = struct.unpack_from('>I', header, 0)[0]
+        resolution = 1e9 if magic == 0xa1b23c4d else 1e6
+        linkType = struct.unpack_from(order + 'I', header, 20)[0] & 0xffff
+        headerSize = _USB_HEADER_SIZES.get(linkType)
+        if headerSize is None:
+            raise RuntimeError('{} is not a usbmon capture (link type {})'.format(path, linkType))
+        record = struct.Struct(order + 'IIII')
+        while True:
+            recordHeader = file.read(record.size)
+            if len(recordHeader) < record.size:
+                return
+            seconds, fraction, length, _ = record.unpack(recordHeader)
+            frame = file.read(length)
+            if len(frame) < headerSize:
+                return
+            event = _usbEvent(seconds + fraction / resolution, frame, headerSize)
+            if event is not None:
+                yield event
+
+
+def _readPcapng(path):
+    with open(path, 'rb') as file:
+        order = '<'
+        # per interface: (usbmon header size, timestamp units per second)
+        interfaces = []
+        while True:
+            blockHeader = file.read(8)
+            if len(blockHeader) < 8:
+                return
+            blockType = struct.unpack_from(order + 'I', blockHeader, 0)[0]
+            if blockType == 0x0a0d0d0a:
+                body = file.read(4)
+                order = '<' if struct.unpack_from('<I', body, 0)[0] == 0x1a2b3c4d else '>'
+                blockLength = struct.unpack_from(order + 'I', blockHeader, 4)[0]
+                file.read(blockLength - 12)
+                interfaces = []
+                continue
+            blockLength = struct.unpack_from(order + 'I', blockHeader, 4)[0]
+            body = file.read(blockLength - 8)
+            if blockType == 1:
+                linkType = struct.unpack_from(order + 'H', body, 0)[0]
+                resolution = 1e6
+                offset = 8
+                while offset + 4 <= len(body) - 4:
+                    code, length = struct.unpack_from(order + 'HH', body, offset)
+                    if code == 0:
+                        break
+                    if code == 9 and length == 1:
+                        value = body[offset + 4]
+                        resolution = 2.0 ** (value & 0x7f) if value & 0x80 else 10.0 ** value
+                    offset += 4 + (length + 3) // 4 * 4
+                interfaces.append((_USB_HEADER_SIZES.get(linkType), resolution))
+            elif blockType == 6:
+                interfaceId, high, low, length, _ = struct.unpack_from(order + 'IIIII', body, 0)
+                headerSize, resolution = interfaces[interfaceId]
+                if headerSize is None or length < headerSize:
+                    continue
+                event = _usbEvent(((high << 32) | low) / resolution, body[20:20 + length], headerSize)
+                if event is not None:
+                    yield event
+
+
+def _readTraceFile(path):
+    for i, (timestamp, kind, data) in enumerate(readTrace(path)):
+        if kind == TraceRecord.WRITE:
+            yield timestamp, None, None, 'S', i, WRITE_SETUP, data
+        elif kind == TraceRecord.READ:
+            yield timestamp, None, None, 'S', i, READ_SETUP, b''
+            yield timestamp, None, None, 'C', i, None, data
+
+
+def readCapture(path):
+    """Events of a capture, whose format is told by its first bytes"""
+    with open(path, 'rb') as file:
+        magic = file.read(8)
+    if magic[:4] == b'\x0a\x0d\x0d\x0a':
+        return _readPcapng(path)
+    if magic[:4] in (b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\xc3\xd4', b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+        return _readPcap(path)
+    if magic == TraceRecorder.MAGIC:
+        return _readTraceFile(path)
+    return _readUsbmonText(path)
+
+
+def controllerPackets(events, device=None):
+    """Packets written to and read from the controller: (timestamp, bus, device, direction, data)
+
+    device is a (bus, device number) pair to keep. Without it, transfers are kept if the vendor and product
+    of their device, as seen in a device descriptor of the capture, are the controller's, or, for devices whose
+    descriptor was not captured, if their setup is the controller's.
+    """
+    identities = {}
+    pending = {}
+    controller = (Driver.VENDOR_ID, Driver.PRODUCT_ID)
+    for timestamp, bus, dev, eventType, urbId, setup, data in events:
+        if device is not None and (bus, dev) != device:
+            continue
+        if eventType == 'S':
+            if setup == WRITE_SETUP:
+                if data and identities.get((bus, dev), controller) == controller:
+                    yield timestamp, bus, dev, OUT, data
+            elif setup == READ_SETUP or setup == DESCRIPTOR_SETUP:
+                pending[urbId] = setup
+        elif eventType == 'C':
+            setup = pending.pop(urbId, None)
+            if setup == READ_SETUP:
+                if data and identities.get((bus, dev), controller) == controller:
+                    yield timestamp, bus, dev, IN, data
+            elif setup == DESCRIPTOR_SETUP and len(data) >= 12:
+                identities[(bus, dev)] = struct.unpack_from('<HH', data, 8)
+
+
+class PacketDecoder:
+    """decodePacket through a bounded memo, so that identical packets (ex. status polls, themes sent again)
+    are decoded only once, and so are their unknown codes found
+    """
+
+    def __init__(self, unknown=None, maxEntries=1 << 16):
+        self.unknown = unknown if unknown is not None else UnknownCodes()
+        self.maxEntries = maxEntries
+        # (direction, packet) -> (record, unknown codes (kind, code) found in it)
+        self._memo = {}
+
+    def decode(self, data, direction=OUT):
+        """Record of a packet, shared by identical packets so it must not be modified"""
+        key = (direction, bytes(data))
+        entry = self._memo.get(key)
+        if entry is None:
+            found = _FoundCodes()
+            entry = (decodePacket(key[1], direction, found), found.codes)
+            if len(self._memo) < self.maxEntries:
+                self._memo[key] = entry
+        record, codes = entry
+        for kind, code in codes:
+            self.unknown.add(kind, code, record['raw'])
+        return record
+
+
+class _FoundCodes:
+    def __init__(self):
+        self.codes = []
+
+    def add(self, kind, code, raw):
+        self.codes.append((kind, code))
+
+
+def decodeCapture(path, device=None, unknown=None):
+    """Records of the controller packets of a capture, see decodePacket
+
+    Also carry the index of the packet in the capture, its timestamp in seconds and its bus and device number.
+    """
+    decoder = PacketDecoder(unknown)
+    index = 0
+    for timestamp, bus, dev, direction, data in controllerPackets(readCapture(path), device):
+        record = dict(decoder.decode(data, direction))
+        record['index'] = index
+        record['timestamp'] = timestamp
+        record['bus'] = bus
+        record['device'] = dev
+        index += 1
+        yield record
+
+
+# Writers of records, split into the fields of the event (index, timestamp, bus, device)
+# and those of the packet, which are formatted once per distinct packet
+
+class JsonLinesWriter:
+    def __init__(self, output, maxEntries=1 << 16):
+        self.output = output
+        self.maxEntries = maxEntries
+        self._encode = json.JSONEncoder(separators=(',', ':')).encode
+        self._tails = {}
+
+    def writeHeader(self):
+        pass
+
+    def write(self, index, timestamp, bus, device, record):
+        key = (record['direction'], record['raw'])
+        tail = self._tails.get(key)
+        if tail is None:
+            # Without the opening brace
+            tail = self._encode(record)[1:]
+            if len(self._tails) < self.maxEntries:
+                self._tails[key] = tail
+        self.output.write('{"index":%d,"timestamp":%r,"bus":%s,"device":%s,%s\n'
+                          % (index, timestamp, 'null' if bus is None else bus, 'null' if device is None else device,
+                             tail))
+
+
+class CsvWriter:
+    def __init__(self, output, maxEntries=1 << 16):
+        self.output = output
+        self.maxEntries = maxEntries
+        self._tails = {}
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def _format(self, row):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(row)
+        return self._buffer.getvalue()
+
+    def writeHeader(self):
+        self.output.write(self._format(FIELDS))
+
+    def write(self, index, timestamp, bus, device, record):
+        key = (record['direction'], record['raw'])
+        tail = self._tails.get(key)
+        if tail is None:
+            # Quoted as needed, with the line terminator
+            tail = self._format([record.get(field) for field in FIELDS[4:]])
+            if len(self._tails) < self.maxEntries:
+                self._tails[key] = tail
+        self.output.write('%d,%r,%s,%s,%s' % (index, timestamp, '' if bus is None else bus,
+                                              '' if device is None else device, tail))
+
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Decode the controller packets of a usbmon, pcap, pcapng or trace '
+                                                 'capture')
+    parser.add_argument('CAPTURE')
+    parser.add_argument('--FORMAT', choices=sorted(WRITERS.keys()), default='jsonl')
+    parser.add_argument('--OUTPUT', help='write records here instead of stdout')
+    parser.add_argument('--DEVICE', help='bus:device number to decode, instead of finding the controller')
+    parser.add_argument('--REPORT', help='write the unknown codes report (json) here instead of stderr')
+    args = parser.parse_args(argv)
+
+    device = tuple(int(part) for part in args.DEVICE.split(':')) if args.DEVICE else None
+    decoder = PacketDecoder()
+    output = open(args.OUTPUT, 'w', newline='') if args.OUTPUT else sys.stdout
+    numRecords = 0
+    try:
+        writer = WRITERS[args.FORMAT](output)
+        writer.writeHeader()
+        decode = decoder.decode
+        write = writer.write
+        for timestamp, bus, dev, direction, data in controllerPackets(readCapture(args.CAPTURE), device):
+            write(numRecords, timestamp, bus, dev, decode(data, direction))
+            numRecords += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    report = {'records': numRecords, 'unknown': decoder.unknown.summary()}
+    if args.REPORT:
+        with open(args.REPORT, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import logging
+import random
+import time
+
+from alieneffects import usbdriver
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.usbdriver import AlienwareUSBDriver
+
+
+class EmulatedZoneState:
+    """What a zone is programmed to show: the effects of its sequence and whether they loop"""
+
+    def __init__(self, sequenceId, effects, looped):
+        self.sequenceId = sequenceId
+        self.effects = effects
+        self.looped = looped
+
+    def __repr__(self):
+        return 'EmulatedZoneState(sequenceId={}, effects={}, looped={})'.format(self.sequenceId, self.effects,
+                                                                                self.looped)
+
+
+class EmulatedAlienwareDevice:
+    """In-process model of the 13 R3 lighting controller, standing in for the pyusb device
+
+    Decodes the packets documented in the README and tracks their effect:
+        RESET clears all sequences and makes the controller BUSY for resetLatency seconds,
+        SET/BLINK/MORPH append an effect (a tuple as in compiler.effectKey) to their sequence,
+        LOOP marks the latest sequence mentioned before it as looping, later effects of that sequence are ignored,
+        EXECUTE assigns each sequence to its zones and makes the controller BUSY for executeLatency seconds,
+        SAVE_NEXT records the next packet into a power state slot instead of running it, SAVE persists the slots.
+    Status reads answer READY or BUSY accordingly.
+    Transfers can be made to fail: a write raises USBError with probability writeFailureRate,
+    writes and reads are cut short with probability shortWriteRate and shortReadRate.
+    pyusb is not needed, without it the USBError raised is the OSError the driver catches until pyusb is loaded.
+    """
+
+    bus = 1
+    address = 1
+    idVendor = AlienwareUSBDriver.VENDOR_ID
+    idProduct = AlienwareUSBDriver.PRODUCT_ID
+
+    def __init__(self, resetLatency=0.0, executeLatency=0.0, writeFailureRate=0.0, shortWriteRate=0.0,
+                 shortReadRate=0.0, seed=None, packetLength=AlienwareUSBDriver.PACKET_LENGTH):
+        self.packetLength = packetLength
+        self.resetLatency = resetLatency
+        self.executeLatency = executeLatency
+        self.writeFailureRate = writeFailureRate
+        self.shortWriteRate = shortWriteRate
+        self.shortReadRate = shortReadRate
+        self._random = random.Random(seed)
+
+        self.busyUntil = 0.0
+        self.tempo = None
+        self.lightsOn = True
+        # sequence id -> [zone code, effects, looped]
+        self.sequences = {}
+        self._lastSequenceId = None
+        # zone code (one hot) -> EmulatedZoneState
+        self.zones = {}
+        self._saveNextState = None
+        self.pendingSlots = {}
+        self.savedSlots = {}
+
+        self.numWrites = 0
+        self.numReads = 0
+        self.numFailures = 0
+        self.commandCounts = {}
+
+    # pyusb device API used by AlienwareUSBDriver
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def attach_kernel_driver(self, interface):
+        pass
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def set_configuration(self):
+        pass
+
+    def get_active_configuration(self):
+        return self
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if bmRequestType == AlienwareUSBDriver.OUT_BM_REQUEST_TYPE:
+            return self._write(bytes(data_or_wLength))
+        elif bmRequestType == AlienwareUSBDriver.IN_BM_REQUEST_TYPE:
+            return self._read(data_or_wLength)
+        raise usbdriver.USBError('Unsupported request type {}'.format(hex(bmRequestType)))
+
+    def isBusy(self):
+        return time.monotonic() < self.busyUntil
+
+    def _write(self, pkt):
+        self.numWrites += 1
+        if self._random.random() < self.writeFailureRate:
+            self.numFailures += 1
+            raise usbdriver.USBError('Emulated write failure')
+        if self._random.random() < self.shortWriteRate:
+            self.numFailures += 1
+            return self._random.randrange(len(pkt))
+        if len(pkt) != self.packetLength or pkt[0] != 0x02:
+            logging.debug('Emulator ignoring malformed packet %s', pkt)
+            return len(pkt)
+        self._handle(pkt)
+        return len(pkt)
+
+    def _read(self, length):
+        self.numReads += 1
+        response = [0] * length
+        response[0] = AC.Status.BUSY if self.isBusy() else AC.Status.READY
+        if self._random.random() < self.shortReadRate:
+            self.numFailures += 1
+            return response[:self._random.randrange(length)]
+        return response
+
+    def _handle(self, pkt):
+        c = AC.Commands.CODES
+        cmd = pkt[1]
+        self.commandCounts[cmd] = self.commandCounts.get(cmd, 0) + 1
+
+        if self._saveNextState is not None and cmd not in (c[AC.Commands.SAVE_NEXT], c[AC.Commands.SAVE]):
+            self.pendingSlots.setdefault(self._saveNextState, []).append(pkt)
+            self._saveNextState = None
+            return
+
+        if cmd == c[AC.Commands.RESET]:
+            self.sequences = {}
+            self._lastSequenceId = None
+            self.zones = {}
+            self.lightsOn = pkt[2] == AC.Reset.CODES[AC.Reset.ALL_LIGHTS_ON]
+            self.busyUntil = time.monotonic() + self.resetLatency
+        elif cmd == c[AC.Commands.SET_TEMPO]:
+            self.tempo = (pkt[2] << 8) + pkt[3]
+        elif cmd in (c[AC.Commands.SET_COLOR], c[AC.Commands.BLINK_COLOR], c[AC.Commands.MORPH_COLOR]):
+            sequenceId = pkt[2]
+            zoneCode = (pkt[3] << 16) + (pkt[4] << 8) + pkt[5]
+            if cmd == c[AC.Commands.SET_COLOR]:
+                effect = (AC.Commands.SET_COLOR, tuple(pkt[6:9]))
+            elif cmd == c[AC.Commands.BLINK_COLOR]:
+                effect = (AC.Commands.BLINK_COLOR, tuple(pkt[6:9]))
+            else:
+                effect = (AC.Commands.MORPH_COLOR, tuple(pkt[6:9]), tuple(pkt[9:12]))
+            sequence = self.sequences.setdefault(sequenceId, [0, [], False])
+            sequence[0] |= zoneCode
+            # Effects after the LOOP of their sequence are never played
+            if not sequence[2]:
+                sequence[1].append(effect)
+            self._lastSequenceId = sequenceId
+        elif cmd == c[AC.Commands.LOOP_SEQUENCE]:
+            if self._lastSequenceId is not None:
+                self.sequences[self._lastSequenceId][2] = True
+        elif cmd == c[AC.Commands.EXECUTE]:
+            for sequenceId, (zoneCode, effects, looped) in self.sequences.items():
+                bit = 1
+                while bit <= zoneCode:
+                    if zoneCode & bit:
+                        self.zones[bit] = EmulatedZoneState(sequenceId, list(effects), looped)
+                    bit <<= 1
+            self.busyUntil = time.monotonic() + self.executeLatency
+        elif cmd == c[AC.Commands.SAVE_NEXT]:
+            self._saveNextState = pkt[2]
+        elif cmd == c[AC.Commands.SAVE]:
+            for powerStateCode, packets in self.pendingSlots.items():
+                self.savedSlots[powerStateCode] = list(packets)
+            self.pendingSlots = {}
+        elif cmd == c[AC.Commands.GET_STATUS]:
+            pass
+        else:
+            logging.debug('Emulator ignoring unknown command %s', cmd)
+
+    def zoneState(self, zoneName):
+        """The EmulatedZoneState of a zone (by name), None if nothing is programmed on it"""
+        return self.zones.get(AC.Zones.CODES[zoneName])
+
+
+class EmulatedUSBDriver(AlienwareUSBDriver):
+    """AlienwareUSBDriver backed by an EmulatedAlienwareDevice instead of the USB bus"""
+
+    def __init__(self, device=None, vendorId=AlienwareUSBDriver.VENDOR_ID, productId=AlienwareUSBDriver.PRODUCT_ID,
+                 packetLength=AlienwareUSBDriver.PACKET_LENGTH, **deviceOptions):
+        super().__init__(vendorId=vendorId, productId=productId, packetLength=packetLength)
+        self.device = device if device is not None else EmulatedAlienwareDevice(packetLength=packetLength,
+                                                                                **deviceOptions)
+
+    @classmethod
+    def discover(cls, profiles, devicesPerProfile=1, **deviceOptions):
+        """Drivers of devicesPerProfile emulated controllers per profile, as AlienwareUSBDriver.discover"""
+        found = []
+        for profile in profiles:
+            for _ in range(devicesPerProfile):
+                device = EmulatedAlienwareDevice(packetLength=profile.packetLength, **deviceOptions)
+                device.idVendor = profile.vendorId
+                device.idProduct = profile.productId
+                # Distinct addresses, as on a real bus
+                device.address = len(found) + 1
+                found.append((profile, cls(device, profile.vendorId, profile.productId, profile.packetLength)))
+        return found
+
+    @property
+    def deviceAddress(self):
+        return '{}:{}'.format(self.device.bus, self.device.address)
+
+    def acquire(self):
+        if self._control_taken:
+            return
+        self._device = self.device
+        self._control_taken = True
+        logging.debug("Emulated device acquired")
+
+    def release(self):
+        if not self._control_taken:
+            return
+        self._control_taken = False
+        logging.debug("Emulated device released")
@@ -0,0 +1,117 @@
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.stats import ApplyStats
+from alieneffects.theme import sendCompiledTheme
+
+
+class DeviceApplyResult:
+    """How applying a theme went on one controller of a fan-out"""
+
+    def __init__(self, profile, driver):
+        self.profile = profile
+        self.driver = driver
+        self.ok = False
+        self.error = None
+        # Seconds from the start of the fan-out to this controller executing the theme
+        self.latency = None
+        self.stats = ApplyStats()
+
+    def summary(self):
+        return {
+            'profile': self.profile.name,
+            'device': self.driver.deviceAddress,
+            'ok': self.ok,
+            'error': self.error,
+            'latency': self.latency,
+            'stats': self.stats.summary(),
+        }
+
+
+class FanOutApplier:
+    """Applies a theme to several controllers at once, ex. every one found by backends.discoverDrivers
+
+    The theme is compiled once per device profile, then each controller is acquired, reset and sent its packets
+    by a thread of a pool, so that their transfers and ready waits overlap.
+    Unlike AlienwareTheme.apply, the apply state of the single controller is not used: every controller is sent
+    the theme.
+    """
+
+    def __init__(self, drivers, coalesce=True, optimize=False, cache=None, maxWorkers=None):
+        # list of (DeviceProfile, driver)
+        self.drivers = drivers
+        self.coalesce = coalesce
+        self.optimize = optimize
+        self.cache = cache
+        self.maxWorkers = maxWorkers
+
+    def _compile(self, theme):
+        """profile name -> (CompiledTheme or None, error)"""
+        compiled = OrderedDict()
+        # Decided before any compile: validating fills the random colors in, the theme would look deterministic
+        # to the next profile and be cached. Every profile then shows the same random colors.
+        cache = None if theme.isRandom() else self.cache
+        for profile, _ in self.drivers:
+            if profile.name in compiled:
+                continue
+            try:
+                compiled[profile.name] = (theme.compile(self.coalesce, cache, optimize=self.optimize,
+                                                        profile=profile), None)
+            except (RuntimeError, ValueError, TypeError, KeyError, AttributeError) as exc:
+                logging.error('Could not compile the theme for {}: {}'.format(profile.name, exc))
+                compiled[profile.name] = (None, str(exc))
+        return compiled
+
+    @staticmethod
+    def _applyCompiled(result, compiled, start):
+        stats = result.stats
+        stats.numPackets = compiled.numPackets
+        ac = AC(driver=result.driver)
+        counters = ac.driver.counters.snapshot()
+        try:
+            with stats.phase('acquire'):
+                ac.driver.acquire()
+            sendCompiledTheme(ac, compiled, stats)
+            result.ok = True
+        except Exception as exc:
+            # ex. DeviceNotFoundError, TransferError, ControllerNotReadyError: the other controllers carry on
+            logging.error('Could not apply to {} {}: {}'.format(result.profile.name, result.driver.deviceAddress, exc))
+            result.error = str(exc)
+        finally:
+            result.latency = time.perf_counter() - start
+            with stats.phase('release'):
+                ac.driver.release()
+            stats.transfers = ac.driver.counters.since(counters)
+            stats.ok = result.ok
+        return result
+
+    def apply(self, theme):
+        """Applies an AlienwareTheme to every controller, returns their DeviceApplyResults"""
+        start = time.perf_counter()
+        compiled = self._compile(theme)
+        results = []
+        jobs = []
+        for profile, driver in self.drivers:
+            result = DeviceApplyResult(profile, driver)
+            results.append(result)
+            compiledTheme, error = compiled[profile.name]
+            if compiledTheme is None:
+                result.error = error
+            elif compiledTheme.isEmpty():
+                result.ok = True
+            else:
+                jobs.append((result, compiledTheme))
+
+        if jobs:
+            with ThreadPoolExecutor(max_workers=self.maxWorkers or len(jobs)) as executor:
+                futures = [executor.submit(self._applyCompiled, result, compiledTheme, start)
+                           for result, compiledTheme in jobs]
+                # Results are filled in place, this only raises what _applyCompiled does not expect
+                for future in futures:
+                    future.result()
+        logging.info('Applied to {} of {} controllers in {:.3f}s'.format(sum(result.ok for result in results),
+                                                                         len(results), time.perf_counter() - start))
+        return results
@@ -0,0 +1,210 @@
+"""Procedural themes, generated in families for A/B tests
+
+    alieneffects-13r3 generate <family> --COUNT <n> [--SEED <seed>] [--FORMAT json|jsonl|packets] --OUTPUT <path>
+
+Families:
+    sweep       all zones in one color, variants evenly spaced around the hue circle
+    gradient    a gradient across the keyboard zones, between random end colors
+    palette     the keyboard zones cycling through a random palette, each zone one color ahead of its left neighbour
+    morph       a looping chain of morphs between random end colors, one step ahead per keyboard zone (a wave)
+    random      random effects on every zone
+
+Variants are yielded one at a time, as validated zone sequence maps which compile without a JSON round trip.
+Random colors of a variant are drawn in one call to the seeded generator, the same seed gives the same family.
+"""
+import colorsys
+import json
+import logging
+import os
+import random
+from collections import OrderedDict
+
+from alieneffects.compiler import compileTheme
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.optimizer import optimizeTheme
+
+# Left to right, as on the laptop
+KEYBOARD_ZONES = [AC.Zones.LEFT_KEYBOARD, AC.Zones.MIDDLE_LEFT_KEYBOARD, AC.Zones.MIDDLE_RIGHT_KEYBOARD,
+                  AC.Zones.RIGHT_KEYBOARD]
+COLOR_SPACES = ('rgb', 'hsv')
+LOOP = {'EFFECT': AC.Commands.LOOP_SEQUENCE}
+
+
+def randomColors(rng, numColors):
+    """numColors random colors from one draw of rng (a random.Random)"""
+    data = rng.getrandbits(24 * numColors).to_bytes(3 * numColors, 'little') if numColors else b''
+    return [list(data[i:i + 3]) for i in range(0, len(data), 3)]
+
+
+def hsvColor(hue, saturation=1.0, value=1.0):
+    return [int(round(channel * 255)) for channel in colorsys.hsv_to_rgb(hue % 1.0, saturation, value)]
+
+
+def interpolateColors(color1, color2, numColors, space='rgb'):
+    """numColors colors from color1 to color2 (both included), evenly spaced in the rgb or hsv color space
+
+    In hsv the hue goes the short way around the circle.
+    """
+    if numColors == 1:
+        return [list(color1)]
+    fractions = [i / (numColors - 1) for i in range(numColors)]
+    if space == 'rgb':
+        (r1, g1, b1), (r2, g2, b2) = color1, color2
+        dr, dg, db = r2 - r1, g2 - g1, b2 - b1
+        return [[int(round(r1 + dr * f)), int(round(g1 + dg * f)), int(round(b1 + db * f))] for f in fractions]
+    if space == 'hsv':
+        h1, s1, v1 = colorsys.rgb_to_hsv(*(channel / 255 for channel in color1))
+        h2, s2, v2 = colorsys.rgb_to_hsv(*(channel / 255 for channel in color2))
+        dh = (h2 - h1 + 0.5) % 1.0 - 0.5
+        ds, dv = s2 - s1, v2 - v1
+        return [hsvColor(h1 + dh * f, s1 + ds * f, v1 + dv * f) for f in fractions]
+    raise RuntimeError('Unknown color space {}'.format(space))
+
+
+class GeneratedTheme:
+    """A theme of a family, its ZONES as a validated zone sequence map"""
+
+    def __init__(self, name, tempo, duration, zoneCodeSequenceMap, description=''):
+        self.name = name
+        self.tempo = tempo
+        self.duration = duration
+        self.zoneCodeSequenceMap = zoneCodeSequenceMap
+        self.description = description
+
+    @classmethod
+    def fromZoneNames(cls, name, tempo, duration, zoneSequences, description=''):
+        """From a map of zone names to sequences, zones not in it are left empty"""
+        return cls(name, tempo, duration,
+                   OrderedDict((zoneCode, zoneSequences.get(zoneName, []))
+                               for zoneName, zoneCode in AC.Zones.CODES.items()), description)
+
+    def toJson(self):
+        """The theme file contents, as a dict"""
+        zones = OrderedDict()
+        for zoneName, zoneCode in AC.Zones.CODES.items():
+            sequence = self.zoneCodeSequenceMap.get(zoneCode)
+            if sequence:
+                zones[zoneName] = sequence
+        return OrderedDict([('DESCRIPTION', self.description), ('TEMPO', self.tempo), ('DURATION', self.duration),
+                            ('ZONES', zones)])
+
+    def compile(self, coalesce=True, optimize=False):
+        zoneCodeSequenceMap = self.zoneCodeSequenceMap
+        if optimize:
+            zoneCodeSequenceMap, _ = optimizeTheme(zoneCodeSequenceMap, {})
+        return compileTheme(self.tempo, self.duration, zoneCodeSequenceMap, coalesce)
+
+
+class ThemeGenerator:
+    """Generates families of themes, see the module docstring
+
+    Each family method yields count GeneratedThemes. space is the color space gradients are interpolated in,
+    zones the zones the keyboard families spread over (left to right).
+    """
+
+    def __init__(self, seed=None, space='rgb', tempo=200, duration=10000, zones=None):
+        if space not in COLOR_SPACES:
+            raise RuntimeError('Unknown color space {}'.format(space))
+        self.rng = random.Random(seed)
+        self.space = space
+        self.tempo = tempo
+        self.duration = duration
+        self.zones = zones if zones is not None else KEYBOARD_ZONES
+
+    def _theme(self, family, i, zoneSequences):
+        return GeneratedTheme.fromZoneNames('{}-{:05d}'.format(family, i), self.tempo, self.duration, zoneSequences,
+                                            'generated: {} {}'.format(family, i))
+
+    def sweep(self, count):
+        for i in range(count):
+            color = hsvColor(i / count)
+            yield self._theme('sweep', i, {zoneName: [{'EFFECT': AC.Commands.SET_COLOR, 'COLOR': color}, LOOP]
+                                           for zoneName in AC.Zones.CODES})
+
+    def gradient(self, count):
+        for i in range(count):
+            colors = interpolateColors(*randomColors(self.rng, 2), numColors=len(self.zones), space=self.space)
+            yield self._theme('gradient', i, {zoneName: [{'EFFECT': AC.Commands.SET_COLOR, 'COLOR': color}, LOOP]
+                                              for zoneName, color in zip(self.zones, colors)})
+
+    def palette(self, count, steps=4):
+        for i in range(count):
+            colors = randomColors(self.rng, steps)
+            yield self._theme('palette', i, {
+                zoneName: [{'EFFECT': AC.Commands.SET_COLOR, 'COLOR': colors[(offset + j) % steps]}
+                           for j in range(steps)] + [LOOP]
+                for offset, zoneName in enumerate(self.zones)})
+
+    def morph(self, count, steps=4):
+        for i in range(count):
+            # There and back, so that the loop is seamless
+            colors = interpolateColors(*randomColors(self.rng, 2), numColors=steps, space=self.space)
+            colors += colors[-2:0:-1]
+            morphs = [{'EFFECT': AC.Commands.MORPH_COLOR, 'COLOR1': colors[j], 'COLOR2': colors[(j + 1) % len(colors)]}
+                      for j in range(len(colors))]
+            yield self._theme('morph', i, {zoneName: morphs[offset % len(morphs):] + morphs[:offset % len(morphs)]
+                                           + [LOOP] for offset, zoneName in enumerate(self.zones)})
+
+    def random(self, count, steps=4):
+        effectNames = [AC.Commands.SET_COLOR, AC.Commands.BLINK_COLOR, AC.Commands.MORPH_COLOR]
+        zoneNames = list(AC.Zones.CODES)
+        for i in range(count):
+            colors = iter(randomColors(self.rng, 2 * steps * len(zoneNames)))
+            zoneSequences = {}
+            for zoneName in zoneNames:
+                sequence = []
+                for effectName in self.rng.choices(effectNames, k=steps):
+                    if effectName == AC.Commands.MORPH_COLOR:
+                        sequence.append({'EFFECT': effectName, 'COLOR1': next(colors), 'COLOR2': next(colors)})
+                    else:
+                        sequence.append({'EFFECT': effectName, 'COLOR': next(colors)})
+                zoneSequences[zoneName] = sequence + [LOOP]
+            yield self._theme('random', i, zoneSequences)
+
+    def family(self, name, count, steps=4):
+        """The themes of a family by name, steps is the number of colors of palette, morph and random sequences"""
+        if not (isinstance(count, int) and count >= 0):
+            raise RuntimeError('Invalid theme count {}'.format(count))
+        if not (isinstance(steps, int) and steps >= 1):
+            raise RuntimeError('Invalid number of steps {}, at least 1 is needed'.format(steps))
+        if name == 'sweep':
+            return self.sweep(count)
+        if name == 'gradient':
+            return self.gradient(count)
+        if name in ('palette', 'morph', 'random'):
+            return getattr(self, name)(count, steps)
+        raise RuntimeError('Unknown theme family {}'.format(name))
+
+
+FAMILIES = ('sweep', 'gradient', 'palette', 'morph', 'random')
+FORMATS = ('json', 'jsonl', 'packets')
+
+
+def writeThemes(themes, output, fmt='json', coalesce=True, optimize=False):
+    """Streams themes to output as they are generated, returns how many were written
+
+    json writes a theme file per theme into the output directory, packets their compiled packets (raw bytes,
+    as compile --DRY_RUN --OUTPUT), jsonl one theme per line into the output file.
+    """
+    if fmt not in FORMATS:
+        raise RuntimeError('Unknown output format {}'.format(fmt))
+    numThemes = 0
+    if fmt == 'jsonl':
+        with open(output, 'w') as file:
+            for theme in themes:
+                file.write(json.dumps(theme.toJson()) + '\n')
+                numThemes += 1
+        return numThemes
+
+    os.makedirs(output, exist_ok=True)
+    for theme in themes:
+        if fmt == 'json':
+            with open(os.path.join(output, theme.name + '.json'), 'w') as file:
+                json.dump(theme.toJson(), file, indent=2)
+        else:
+            with open(os.path.join(output, theme.name + '.bin'), 'wb') as file:
+                for pkt in theme.compile(coalesce, optimize).commands:
+                    file.write(bytes(pkt))
+        numThemes += 1
+    logging.debug('Wrote %s themes to %s', numThemes, output)
+    return numThemes
@@ -0,0 +1,238 @@
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import os
+import struct
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.profiles import DEFAULT_PROFILES_FILE
+from alieneffects.theme import AlienwareTheme
+
+CONFIG_FILE = os.path.expanduser('~/.alieneffects-13r3.json')
+# Outside of the home directory, the default themes directory, so that saving it does not change what is indexed
+DEFAULT_INDEX_FILE = os.path.expanduser('~/.cache/alieneffects-13r3/index.json')
+THEME_SUFFIX = '.json'
+
+
+def readThemesDirectory(configFile=CONFIG_FILE):
+    """THEMES_DIRECTORY of the config file, the home directory by default"""
+    try:
+        with open(configFile) as file:
+            return os.path.expanduser(json.load(file)['THEMES_DIRECTORY'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return os.path.expanduser('~')
+
+
+def describeTheme(path):
+    """Index entry of a theme file: what browsing and searching need, without having to parse the file again"""
+    theme = AlienwareTheme(path)
+    entry = {
+        'name': os.path.basename(path)[:-len(THEME_SUFFIX)],
+        'path': path,
+        'sha256': hashlib.sha256(theme.raw).hexdigest(),
+    }
+    try:
+        t = theme.theme
+        zoneNames = set()
+        for zones in theme.zoneMaps():
+            for zoneNamesConcatenated, sequence in zones.items():
+                if sequence:
+                    zoneNames.update(name for name in zoneNamesConcatenated.split('|') if name in AC.Zones.CODES)
+        entry.update({
+            'description': t.get('DESCRIPTION', ''),
+            'tempo': t.get('TEMPO', 200),
+            'zones': sorted(zoneNames),
+            'powerStates': sorted(name for names in t.get('POWER_STATES', {}) for name in names.split('|')),
+            'random': theme.isRandom(),
+            'reactive': 'REACTIVE' in t,
+        })
+    except (ValueError, AttributeError, TypeError) as exc:
+        # Still listed, so that a broken theme can be found and fixed
+        entry['error'] = 'Invalid theme: {}'.format(exc)
+    return entry
+
+
+class ThemeLibrary:
+    """Index of the themes (*.json files) of a directory, persisted to a json file
+
+    Only files whose size or modification time changed since the last scan are parsed again.
+    Dotfiles are not themes, nor are the index, config and profiles files when they are in the directory.
+    """
+
+    VERSION = 1
+
+    def __init__(self, themesDirectory=None, indexFile=DEFAULT_INDEX_FILE):
+        self.themesDirectory = os.path.abspath(themesDirectory if themesDirectory is not None
+                                               else readThemesDirectory())
+        self.indexFile = indexFile
+        self._notThemes = {os.path.abspath(path) for path in (indexFile, CONFIG_FILE, DEFAULT_PROFILES_FILE)
+                           if path is not None}
+        # file name -> entry, entries also carry the size and mtime the file had when described
+        self.themes = {}
+
+    def load(self):
+        if self.indexFile is None:
+            return self
+        try:
+            with open(self.indexFile) as file:
+                index = json.load(file)
+            if index['version'] == self.VERSION and index['themesDirectory'] == self.themesDirectory:
+                self.themes = index['themes']
+        except (IOError, OSError, ValueError, KeyError, TypeError) as exc:
+            logging.debug('No themes index in {}: {}'.format(self.indexFile, exc))
+        return self
+
+    def save(self):
+        if self.indexFile is None:
+            return
+        index = {
+            'version': self.VERSION,
+            'themesDirectory': self.themesDirectory,
+            'themes': self.themes,
+        }
+        tmpFile = '{}.{}.tmp'.format(self.indexFile, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.indexFile), exist_ok=True)
+            with open(tmpFile, 'w') as file:
+                json.dump(index, file)
+            os.replace(tmpFile, self.indexFile)
+        except (IOError, OSError) as exc:
+            logging.debug('Could not persist themes index to {}: {}'.format(self.indexFile, exc))
+
+    def _isTheme(self, fileName):
+        return fileName.endswith(THEME_SUFFIX) and not fileName.startswith('.') and \
+            os.path.join(self.themesDirectory, fileName) not in self._notThemes
+
+    def _updateFile(self, fileName, st):
+        entry = self.themes.get(fileName)
+        if entry is not None and entry['size'] == st.st_size and entry['mtimeNs'] == st.st_mtime_ns:
+            return False
+        try:
+            entry = describeTheme(os.path.join(self.themesDirectory, fileName))
+        except (IOError, OSError) as exc:
+            logging.debug('Could not index {}: {}'.format(fileName, exc))
+            return self.themes.pop(fileName, None) is not None
+        entry['size'] = st.st_size
+        entry['mtimeNs'] = st.st_mtime_ns
+        self.themes[fileName] = entry
+        return True
+
+    def rescan(self):
+        """Brings the index up to date with the directory, returns the number of entries added, updated or removed"""
+        numChanged = 0
+        seen = set()
+        try:
+            with os.scandir(self.themesDirectory) as it:
+                for dirEntry in it:
+                    if not self._isTheme(dirEntry.name) or not dirEntry.is_file():
+                        continue
+                    seen.add(dirEntry.name)
+                    numChanged += self._updateFile(dirEntry.name, dirEntry.stat())
+        except (IOError, OSError) as exc:
+            logging.error('Could not scan themes directory {}: {}'.format(self.themesDirectory, exc))
+            return 0
+        for fileName in [fileName for fileName in self.themes if fileName not in seen]:
+            del self.themes[fileName]
+            numChanged += 1
+        if numChanged:
+            self.save()
+        logging.debug('Themes index of {} has {} themes, {} changed'.format(self.themesDirectory, len(self.themes),
+                                                                            numChanged))
+        return numChanged
+
+    def update(self, fileNames):
+        """Re-indexes only the given files of the directory (ex. as reported by inotify)"""
+        numChanged = 0
+        for fileName in fileNames:
+            if not self._isTheme(fileName):
+                continue
+            try:
+                st = os.stat(os.path.join(self.themesDirectory, fileName))
+                numChanged += self._updateFile(fileName, st)
+            except (IOError, OSError):
+                numChanged += self.themes.pop(fileName, None) is not None
+        if numChanged:
+            self.save()
+        return numChanged
+
+    def list(self):
+        return sorted(self.themes.values(), key=lambda entry: entry['name'])
+
+    def search(self, query):
+        """Themes whose name, description or zones contain query, ignoring case"""
+        query = query.lower()
+        return [entry for entry in self.list()
+                if query in entry['name'].lower() or query in entry.get('description', '').lower()
+                or any(query in zone.lower() for zone in entry.get('zones', ()))]
+
+    def find(self, name):
+        """The entry of the theme with this name (file name without .json), None if there is none"""
+        return self.themes.get(name + THEME_SUFFIX)
+
+    def select(self, query=None, name=None):
+        """The theme named name if given, else the themes matching query if given, else all themes"""
+        if name is not None:
+            entry = self.find(name)
+            return [entry] if entry is not None else []
+        if query is not None:
+            return self.search(query)
+        return self.list()
+
+
+class InotifyWatcher:
+    """Reports files created, written, moved or deleted in a directory, using inotify through libc
+
+    Raises OSError where inotify is not available.
+    The file descriptor is non blocking, poll it (ex. with select) and call readNames when it is readable.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libraryName = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libraryName, use_errno=True)
+            inotifyInit, inotifyAddWatch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError, TypeError) as exc:
+            raise OSError('inotify is not available: {}'.format(exc))
+        self.fd = inotifyInit(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        if inotifyAddWatch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, '{}: {}'.format(os.strerror(errno), directory))
+
+    def fileno(self):
+        return self.fd
+
+    def readNames(self):
+        """Names of the files changed since the last call"""
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + self.EVENT.size <= len(data):
+                _, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if name:
+                    names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
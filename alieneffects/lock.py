@@ -0,0 +1,205 @@
+import fcntl
+import json
+import logging
+import os
+import time
+
+DEFAULT_LOCK_FILE = '/run/alieneffects-13r3.lock'
+
+
+class LockTimeoutError(RuntimeError):
+    """Raised when the controller lock is not obtained in time"""
+    pass
+
+
+class LockedRequest:
+    """A request holding the controller lock, release it (or use it as a context manager) when done
+
+    superseded is True if a request for the lights made after this one is waiting or was already served,
+    in which case this one should return without touching the controller.
+    coalesced is the number of earlier requests skipped in favour of this one.
+    """
+
+    def __init__(self, controllerLock, fd, ticket, lockWait, superseded, coalesced, ticketFd=None):
+        self.controllerLock = controllerLock
+        self.fd = fd
+        self.ticket = ticket
+        # Locked for as long as the request is alive, see ControllerLock
+        self.ticketFd = ticketFd
+        self.lockWait = lockWait
+        self.superseded = superseded
+        self.coalesced = coalesced
+
+    def report(self):
+        return {'lockWait': self.lockWait, 'superseded': self.superseded, 'coalesced': self.coalesced}
+
+    def release(self):
+        if self.fd is None:
+            return
+        if self.ticket is not None and not self.superseded:
+            self.controllerLock._markServed(self.ticket)
+        self.controllerLock._dropTicket(self.ticket, self.ticketFd)
+        self.ticketFd = None
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+
+class ControllerLock:
+    """System wide lock serializing the processes that use the controller, with last-writer-wins coalescing
+
+    Requests which change the lights take a ticket before waiting for the lock. When the lock is obtained,
+    a request is superseded if a later one has been served, or is still waiting: that one will apply its own
+    theme, so applying this one would only delay it. Tickets are counted in a separate file (lockFile with a
+    .ticket suffix), under a short lock of their own. Each request also holds a lock on a file of its own
+    ticket (.ticket.<n>) until it is done, so that a request which gave up (timed out, was interrupted or died)
+    supersedes nobody.
+    With lockFile None, nothing is locked (ex. for an emulated device).
+    Requests served by the daemon are not coalesced, it applies them one after the other.
+    """
+
+    def __init__(self, lockFile=DEFAULT_LOCK_FILE, timeout=60.0, initialDelay=0.005, maxDelay=0.1, backoff=2.0):
+        self.lockFile = lockFile
+        self.ticketFile = lockFile + '.ticket' if lockFile is not None else None
+        self.timeout = timeout
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+
+    def _updateTickets(self, update):
+        """Calls update with the tickets ({'last': ..., 'served': ...}) under the ticket lock, persists them"""
+        fd = os.open(self.ticketFile, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+') as file:
+                try:
+                    tickets = json.load(file)
+                    tickets = {'last': int(tickets['last']), 'served': int(tickets['served'])}
+                except (ValueError, KeyError, TypeError):
+                    tickets = {'last': 0, 'served': 0}
+                result = update(tickets)
+                file.seek(0)
+                file.truncate()
+                json.dump(tickets, file)
+            return result
+        finally:
+            os.close(fd)
+
+    def _ticketPath(self, ticket):
+        return '{}.{}'.format(self.ticketFile, ticket)
+
+    def _isTicketAlive(self, ticket):
+        """Whether the request of a ticket is still waiting or applying, the file of a dead one is removed"""
+        path = self._ticketPath(ticket)
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except (IOError, OSError):
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        self._removeTicketFile(path)
+        return False
+
+    @staticmethod
+    def _removeTicketFile(path):
+        try:
+            os.unlink(path)
+        except (IOError, OSError):
+            pass
+
+    def takeTicket(self):
+        """Returns the ticket and the fd of its lock, which must be given back with _dropTicket"""
+        def update(tickets):
+            tickets['last'] += 1
+            # Locked before the ticket is visible, so that it is never seen as dead while alive
+            fd = os.open(self._ticketPath(tickets['last']), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return tickets['last'], fd
+        return self._updateTickets(update)
+
+    def _dropTicket(self, ticket, fd):
+        if fd is None:
+            return
+        self._removeTicketFile(self._ticketPath(ticket))
+        os.close(fd)
+
+    def _markServed(self, ticket):
+        def update(tickets):
+            tickets['served'] = max(tickets['served'], ticket)
+        try:
+            self._updateTickets(update)
+        except (IOError, OSError) as exc:
+            logging.debug('Could not mark ticket {} served: {}'.format(ticket, exc))
+
+    def _checkTicket(self, ticket):
+        """Returns whether the request of ticket is superseded, and how many live earlier requests it coalesces"""
+        def update(tickets):
+            if tickets['served'] > ticket:
+                return True, 0
+            for later in range(ticket + 1, tickets['last'] + 1):
+                if self._isTicketAlive(later):
+                    return True, 0
+            return False, sum(1 for earlier in range(tickets['served'] + 1, ticket) if self._isTicketAlive(earlier))
+        return self._updateTickets(update)
+
+    def _lock(self, fd):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        delay = self.initialDelay
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return time.monotonic() - start
+            except BlockingIOError:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise LockTimeoutError('Controller is still in use by another process after {:.1f}s'
+                                           .format(now - start))
+                time.sleep(min(delay, deadline - now))
+                delay = min(delay * self.backoff, self.maxDelay)
+
+    def acquire(self, coalesce=True):
+        """Waits for the lock, returns a LockedRequest
+
+        With coalesce, the request is one to change the lights, and may be superseded while waiting.
+        Raises LockTimeoutError if the lock is not obtained within timeout seconds.
+        """
+        if self.lockFile is None:
+            return LockedRequest(self, None, None, 0.0, False, 0)
+        ticket, ticketFd = None, None
+        try:
+            if coalesce:
+                ticket, ticketFd = self.takeTicket()
+            fd = os.open(self.lockFile, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        except (IOError, OSError) as exc:
+            # ex. not running as root, the controller can not be claimed anyway then
+            logging.debug('Not locking the controller: {}'.format(exc))
+            self._dropTicket(ticket, ticketFd)
+            return LockedRequest(self, None, None, 0.0, False, 0)
+        try:
+            lockWait = self._lock(fd)
+            superseded = False
+            coalesced = 0
+            if ticket is not None:
+                superseded, coalesced = self._checkTicket(ticket)
+        except BaseException:
+            # A request giving up withdraws its ticket
+            self._dropTicket(ticket, ticketFd)
+            os.close(fd)
+            raise
+        request = LockedRequest(self, fd, ticket, lockWait, superseded, coalesced, ticketFd)
+        if superseded:
+            logging.info('Request superseded by a later one after waiting {:.3f}s for the controller'.format(lockWait))
+        else:
+            logging.debug('Controller lock obtained after %.6fs, %s earlier requests coalesced', lockWait, coalesced)
+        return request
@@ -0,0 +1,164 @@
+"""Commands working on theme files only, without the controller
+
+    alieneffects-13r3 validate <theme-file> ...
+    alieneffects-13r3 describe <theme-file>
+    alieneffects-13r3 compile [--DRY_RUN] <theme-file>
+    alieneffects-13r3 generate <family> --COUNT <n> --OUTPUT <path>
+
+Only what they need is imported: not the daemon, the USB stack nor pyusb.
+"""
+import argparse
+import logging
+import sys
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.theme import AlienwareTheme
+
+COMMANDS = ('validate', 'describe', 'compile', 'generate')
+
+# What a broken theme file raises while being parsed, validated and compiled
+THEME_ERRORS = (IOError, OSError, ValueError, RuntimeError, AttributeError, TypeError, KeyError)
+
+
+def checkTheme(path, coalesce=True, optimize=False):
+    """Compiles the theme, with every section validated, returns the CompiledTheme"""
+    theme = AlienwareTheme(path)
+    theme.validateReactive()
+    return theme.compile(coalesce, optimize=optimize)
+
+
+def validateCommand(args):
+    numInvalid = 0
+    for path in args.THEME_FILE:
+        try:
+            compiled = checkTheme(path, not args.NO_COALESCE)
+            if args.OPTIMIZE:
+                # Validation fills missing colors in place, the optimized theme is parsed again
+                optimized = checkTheme(path, not args.NO_COALESCE, optimize=True)
+                print('{}: ok, {} packets, {} optimized'.format(path, compiled.numPackets, optimized.numPackets))
+            else:
+                print('{}: ok, {} packets'.format(path, compiled.numPackets))
+        except THEME_ERRORS as exc:
+            numInvalid += 1
+            print('{}: {}: {}'.format(path, type(exc).__name__, exc))
+    return 1 if numInvalid else 0
+
+
+def describeCommand(args):
+    compiled = checkTheme(args.THEME_FILE, not args.NO_COALESCE, args.OPTIMIZE)
+    # Nothing is sent, the controller is only used to decode packets
+    ac = AC()
+    for i, pkt in enumerate(compiled.commands):
+        print('{:4d} {} {}'.format(i, bytes(pkt).hex(), ac.pktToString(pkt)))
+    return 0
+
+
+def compileCommand(args):
+    if not args.DRY_RUN:
+        # Warms the compiled theme cache, for a later apply of the same theme
+        from alieneffects.cache import CompiledThemeCache
+        compiled = AlienwareTheme(args.THEME_FILE).compile(not args.NO_COALESCE, CompiledThemeCache(),
+                                                           optimize=args.OPTIMIZE)
+        print('{}: {} packets cached'.format(args.THEME_FILE, compiled.numPackets))
+        return 0
+
+    compiled = checkTheme(args.THEME_FILE, not args.NO_COALESCE, args.OPTIMIZE)
+    if args.OUTPUT:
+        with open(args.OUTPUT, 'wb') as file:
+            for pkt in compiled.commands:
+                file.write(bytes(pkt))
+    else:
+        for pkt in compiled.commands:
+            print(bytes(pkt).hex())
+    return 0
+
+
+def generateCommand(args):
+    # Only generating themes needs the generator
+    from alieneffects.generator import ThemeGenerator, writeThemes
+    generator = ThemeGenerator(args.SEED, args.SPACE, args.TEMPO, args.DURATION)
+    numThemes = writeThemes(generator.family(args.FAMILY, args.COUNT, args.STEPS), args.OUTPUT, args.FORMAT,
+                            not args.NO_COALESCE, args.OPTIMIZE)
+    print('{}: {} {} themes'.format(args.OUTPUT, numThemes, args.FAMILY))
+    return 0
+
+
+def _intAtLeast(minimum):
+    """argparse type of integers of at least minimum"""
+    def parse(value):
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid int value: {!r}'.format(value))
+        if number < minimum:
+            raise argparse.ArgumentTypeError('{} is less than {}'.format(number, minimum))
+        return number
+
+    return parse
+
+
+def makeParser():
+    # Options of every command, given after the command name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--LOG_LEVEL', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING')
+    common.add_argument('--NO_COALESCE', action='store_true',
+                        help='one sequence per zone instead of merging zones with identical sequences')
+    common.add_argument('--OPTIMIZE', action='store_true',
+                        help='rewrite sequences to minimal equivalent ones (validate prints both packet counts)')
+
+    parser = argparse.ArgumentParser(prog='alieneffects-13r3', description='Theme file commands, no controller needed')
+    subparsers = parser.add_subparsers(dest='COMMAND')
+
+    validateParser = subparsers.add_parser('validate', parents=[common], help='check that themes parse and compile')
+    validateParser.add_argument('THEME_FILE', nargs='+')
+    validateParser.set_defaults(run=validateCommand)
+
+    describeParser = subparsers.add_parser('describe', parents=[common], help='print the packets of a theme, decoded')
+    describeParser.add_argument('THEME_FILE')
+    describeParser.set_defaults(run=describeCommand)
+
+    compileParser = subparsers.add_parser('compile', parents=[common],
+                                          help='compile a theme into the compiled theme cache')
+    compileParser.add_argument('THEME_FILE')
+    compileParser.add_argument('--DRY_RUN', '--dry-run', action='store_true',
+                               help='print the packets (hex, one per line) instead of caching them')
+    compileParser.add_argument('--OUTPUT', help='with --DRY_RUN, write the raw packet bytes here')
+    compileParser.set_defaults(run=compileCommand)
+
+    generateParser = subparsers.add_parser('generate', parents=[common],
+                                           help='generate a family of themes (see alieneffects.generator)')
+    generateParser.add_argument('FAMILY', choices=['sweep', 'gradient', 'palette', 'morph', 'random'])
+    generateParser.add_argument('--COUNT', type=_intAtLeast(0), default=1, help='number of themes to generate')
+    generateParser.add_argument('--SEED', type=int,
+                                help='seed of the random colors, the same seed gives the same themes')
+    generateParser.add_argument('--SPACE', choices=['rgb', 'hsv'], default='rgb',
+                                help='color space gradients and morph chains are interpolated in')
+    generateParser.add_argument('--STEPS', type=_intAtLeast(1), default=4,
+                                help='colors of each palette, morph chain or random sequence')
+    generateParser.add_argument('--TEMPO', type=int, default=200)
+    generateParser.add_argument('--DURATION', type=int, default=10000)
+    generateParser.add_argument('--FORMAT', choices=['json', 'jsonl', 'packets'], default='json',
+                                help='a theme file per theme, one theme per line, or the compiled packets per theme')
+    generateParser.add_argument('--OUTPUT', required=True,
+                                help='directory to write the themes to, the file with --FORMAT jsonl')
+    generateParser.set_defaults(run=generateCommand)
+    return parser
+
+
+def main(argv=None):
+    parser = makeParser()
+    args = parser.parse_args(argv)
+    if args.COMMAND is None:
+        parser.print_help()
+        return 1
+
+    logging.basicConfig(level=getattr(logging, args.LOG_LEVEL), stream=sys.stderr)
+    try:
+        return args.run(args)
+    except THEME_ERRORS as exc:
+        logging.error('{}: {}'.format(getattr(args, 'THEME_FILE', args.COMMAND), exc))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
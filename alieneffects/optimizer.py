@@ -0,0 +1,68 @@
+import logging
+from collections import OrderedDict
+
+from alieneffects.compiler import effectKey
+from alieneffects.controller import AlienwareController as AC
+
+BLACK = (0, 0, 0)
+
+
+def _normalizeEffect(effect):
+    """The simplest effect showing the same as effect during its step"""
+    effectName = effect['EFFECT']
+    if effectName == AC.Commands.MORPH_COLOR and tuple(effect['COLOR1']) == tuple(effect['COLOR2']):
+        # A morph from a color to itself
+        return {'EFFECT': AC.Commands.SET_COLOR, 'COLOR': effect['COLOR1']}
+    if effectName == AC.Commands.BLINK_COLOR and tuple(effect['COLOR']) == BLACK:
+        # Blinking black between black
+        return {'EFFECT': AC.Commands.SET_COLOR, 'COLOR': effect['COLOR']}
+    return effect
+
+
+def optimizeSequence(sequence):
+    """A validated sequence rewritten to a minimal equivalent one
+
+    Each effect lasts one tempo step, so effects are only merged where timing cannot change:
+    - MORPH_COLOR between equal colors and BLINK_COLOR of black become SET_COLOR
+    - effects after the first LOOP_SEQUENCE are never played, they are dropped
+    - a looping sequence made of a repeated period (ex. the same SET_COLOR several times) keeps one period
+    Sequences which do not loop keep their length, as what shows after their last step is up to the firmware.
+    """
+    effects = []
+    looped = False
+    for effect in sequence:
+        if effect['EFFECT'] == AC.Commands.LOOP_SEQUENCE:
+            looped = True
+            break
+        effects.append(_normalizeEffect(effect))
+
+    if looped:
+        keys = [effectKey(effect) for effect in effects]
+        numEffects = len(keys)
+        for period in range(1, numEffects):
+            if numEffects % period == 0 and keys[period:] == keys[:-period]:
+                effects = effects[:period]
+                break
+        effects.append({'EFFECT': AC.Commands.LOOP_SEQUENCE})
+    return effects
+
+
+def optimizeZones(zoneCodeSequenceMap):
+    """Validated zone code sequence map with every sequence optimized, see optimizeSequence"""
+    return OrderedDict((zoneCode, optimizeSequence(sequence)) for zoneCode, sequence in zoneCodeSequenceMap.items())
+
+
+def countEffects(zoneCodeSequenceMap, powerStateZoneSequenceMaps=None):
+    return sum(len(sequence) for zones in [zoneCodeSequenceMap] + list((powerStateZoneSequenceMaps or {}).values())
+               for sequence in zones.values())
+
+
+def optimizeTheme(zoneCodeSequenceMap, powerStateZoneSequenceMaps):
+    """The validated zone map and power state zone maps of a theme, optimized"""
+    optimizedZones = optimizeZones(zoneCodeSequenceMap)
+    optimizedPowerStates = OrderedDict((powerStateCode, optimizeZones(zones))
+                                       for powerStateCode, zones in powerStateZoneSequenceMaps.items())
+    logging.info('Optimizer rewrote {} effects to {}'.format(
+        countEffects(zoneCodeSequenceMap, powerStateZoneSequenceMaps),
+        countEffects(optimizedZones, optimizedPowerStates)))
+    return optimizedZones, optimizedPowerStates
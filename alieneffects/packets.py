@@ -0,0 +1,84 @@
+from alieneffects.controller import AlienwareController as AC
+
+
+class PacketBatch:
+    """Builds a batch of command packets into one preallocated buffer
+
+    Packets are written in place with the controller's pack methods and handed out as memoryview slices
+    of the buffer, so no per packet object is allocated until a transfer needs one.
+    Slices handed out stay valid when the batch grows, but are overwritten once the batch is cleared and reused.
+    """
+
+    def __init__(self, capacity=32, packetLength=AC.PACKET_LENGTH):
+        self.packetLength = packetLength
+        self._buffer = bytearray(max(1, capacity) * packetLength)
+        self._view = memoryview(self._buffer)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return len(self._buffer) // self.packetLength
+
+    def clear(self):
+        self._count = 0
+
+    def _add(self, packMethod, *args):
+        if self._count == self.capacity:
+            # Outstanding slices keep the old buffer alive, so copy into a new one instead of resizing in place
+            buffer = bytearray(2 * len(self._buffer))
+            buffer[:len(self._buffer)] = self._buffer
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+        # Counted only once packed, a packet failing validation is not added
+        packMethod(self._buffer, self._count * self.packetLength, *args)
+        self._count += 1
+
+    def addGetStatusCmd(self):
+        self._add(AC.packGetStatusCmd)
+
+    def addResetCmd(self, resetCode):
+        self._add(AC.packResetCmd, resetCode)
+
+    def addMorphColorCmd(self, sequence, zoneCode, color1, color2):
+        self._add(AC.packMorphColorCmd, sequence, zoneCode, color1, color2)
+
+    def addBlinkColorCmd(self, sequence, zoneCode, color):
+        self._add(AC.packBlinkColorCmd, sequence, zoneCode, color)
+
+    def addSetColorCmd(self, sequence, zoneCode, color):
+        self._add(AC.packSetColorCmd, sequence, zoneCode, color)
+
+    def addLoopSequenceCmd(self):
+        self._add(AC.packLoopSequenceCmd)
+
+    def addSetTempoCmd(self, tempo):
+        self._add(AC.packSetTempoCmd, tempo)
+
+    def addExecuteCmd(self):
+        self._add(AC.packExecuteCmd)
+
+    def addSaveNextCmd(self, powerStateCode):
+        self._add(AC.packSaveNextCmd, powerStateCode)
+
+    def addSaveCmd(self):
+        self._add(AC.packSaveCmd)
+
+    def packet(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError('Packet index out of range')
+        offset = index * self.packetLength
+        return self._view[offset:offset + self.packetLength]
+
+    def packets(self, start=0, end=None):
+        """Zero copy slices of the packets in [start, end)"""
+        if end is None:
+            end = self._count
+        n = self.packetLength
+        view = self._view
+        return [view[i * n:(i + 1) * n] for i in range(start, end)]
+
+    def toBytes(self):
+        return bytes(self._view[:self._count * self.packetLength])
@@ -0,0 +1,133 @@
+import logging
+import random
+import time
+from collections import deque
+
+from alieneffects.state import ApplyState
+from alieneffects.theme import AlienwareTheme, sendCompiledTheme
+
+
+class PlaylistEntry:
+    """A theme of a playlist, compiled once unless it has random colors (then compiled again every cycle)
+
+    Raises RuntimeError if the theme does not compile or its DURATION is not a positive number of ms.
+    """
+
+    def __init__(self, path, coalesce=True, cache=None, optimize=False):
+        self.path = path
+        self.theme = AlienwareTheme(path)
+        self.coalesce = coalesce
+        self.optimize = optimize
+        self.isRandom = self.theme.isRandom()
+        self._compiled = None if self.isRandom else self.theme.compile(coalesce, cache, optimize=optimize)
+        # How long the theme is shown, in ms
+        if self._compiled is not None:
+            self.duration = self._compiled.duration
+        else:
+            self.duration = self.theme.theme.get('DURATION', 10000)
+        if not (isinstance(self.duration, (int, float)) and not isinstance(self.duration, bool) and
+                self.duration > 0):
+            raise RuntimeError('Invalid DURATION {} of playlist theme {}'.format(self.duration, path))
+
+    def compiled(self):
+        if self._compiled is not None:
+            return self._compiled
+        # A fresh parse, validation fills missing colors in place
+        return AlienwareTheme(self.path).compile(self.coalesce, optimize=self.optimize)
+
+    def __repr__(self):
+        return 'PlaylistEntry({})'.format(self.path)
+
+
+class PlaylistStats:
+    def __init__(self, maxLatencySamples=10000):
+        self.numSwitches = 0
+        self.numCycles = 0
+        self.numFailures = 0
+        self.elapsed = 0.0
+        # Seconds from when a switch was due to when its theme was executed, of the most recent switches
+        self.latencies = deque(maxlen=maxLatencySamples)
+
+    def latencyPercentile(self, fraction):
+        if not self.latencies:
+            return None
+        samples = sorted(self.latencies)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def summary(self):
+        return {
+            'switches': self.numSwitches,
+            'cycles': self.numCycles,
+            'failures': self.numFailures,
+            'elapsed': self.elapsed,
+            'latencyP50': self.latencyPercentile(0.5),
+            'latencyP90': self.latencyPercentile(0.9),
+            'latencyMax': max(self.latencies) if self.latencies else None,
+        }
+
+
+class PlaylistPlayer:
+    """Shows the themes of a playlist in turn, each for its DURATION, with the controller held
+
+    All themes are compiled and their DURATION checked before the first switch. Switches are due at start + the sum
+    of the durations shown so far on the monotonic clock, so a slow switch delays the next one without the schedule
+    drifting.
+    With shuffle, the order is shuffled at the start of each cycle.
+    """
+
+    def __init__(self, controller, paths, shuffle=False, coalesce=True, cache=None, state=None,
+                 clock=time.monotonic, sleep=time.sleep, optimize=False):
+        self.controller = controller
+        self.entries = [PlaylistEntry(path, coalesce, cache, optimize) for path in paths]
+        self.shuffle = shuffle
+        self.state = state if state is not None else ApplyState(stateFile=None)
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = PlaylistStats()
+
+    def _order(self, cycles):
+        """Entries in the order they are shown, cycles times (forever if None)"""
+        order = list(self.entries)
+        while cycles is None or self.stats.numCycles < cycles:
+            if self.shuffle:
+                random.shuffle(order)
+            for entry in order:
+                yield entry
+            self.stats.numCycles += 1
+
+    def run(self, cycles=None, duration=None):
+        """Plays cycles times through the playlist (forever if None), for at most duration seconds
+
+        Returns PlaylistStats.
+        """
+        ac = self.controller
+        ac.driver.acquire()
+        # What the lights show no longer matches the last apply
+        self.state.clear()
+
+        start = self.clock()
+        due = start
+        try:
+            for entry in self._order(cycles):
+                if duration is not None and due - start >= duration:
+                    break
+                compiled = entry.compiled()
+                now = self.clock()
+                if now < due:
+                    self.sleep(due - now)
+                try:
+                    sendCompiledTheme(ac, compiled)
+                    self.stats.latencies.append(self.clock() - due)
+                    self.stats.numSwitches += 1
+                except RuntimeError as exc:
+                    # ex. TransferError, ControllerNotReadyError: keep to the schedule
+                    self.stats.numFailures += 1
+                    logging.error('Could not switch to %s: %s', entry.path, exc)
+                logging.debug('Showing %s for %sms', entry.path, entry.duration)
+                due += entry.duration / 1000.0
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stats.elapsed = self.clock() - start
+        logging.info('Playlist stats: %s', self.stats.summary())
+        return self.stats
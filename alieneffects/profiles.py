@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.usbdriver import AlienwareUSBDriver
+
+DEFAULT_PROFILES_FILE = os.path.expanduser('~/.alieneffects-13r3.profiles.json')
+
+
+class DeviceProfile:
+    """A model of AlienFX controller speaking the protocol of the 13 R3: its USB ids, zones, packet length and tempos
+
+    zones maps zone names to zone codes, as AlienwareController.Zones.CODES does for the 13 R3.
+    Packets are zero padded to packetLength, which cannot be shorter than the packets of the protocol.
+    """
+
+    def __init__(self, name, vendorId, productId, zones, packetLength=AC.PACKET_LENGTH, minTempo=AC.MIN_TEMPO,
+                 maxTempo=0xffff, description=''):
+        if not (isinstance(vendorId, int) and 0 <= vendorId <= 0xffff and
+                isinstance(productId, int) and 0 <= productId <= 0xffff):
+            raise RuntimeError('Invalid USB ids for device profile {}'.format(name))
+        if not (isinstance(packetLength, int) and packetLength >= AC.PACKET_LENGTH):
+            raise RuntimeError('Invalid packet length for device profile {}, at least {} bytes are needed'
+                               .format(name, AC.PACKET_LENGTH))
+        if not (isinstance(minTempo, int) and isinstance(maxTempo, int) and AC.MIN_TEMPO <= minTempo <= maxTempo
+                <= 0xffff):
+            raise RuntimeError('Invalid tempo limits for device profile {}'.format(name))
+        for zoneName, zoneCode in zones.items():
+            if not (isinstance(zoneCode, int) and 0 < zoneCode <= 0xffff):
+                raise RuntimeError('Invalid code of zone {} for device profile {}'.format(zoneName, name))
+        self.name = name
+        self.vendorId = vendorId
+        self.productId = productId
+        self.zones = OrderedDict(zones)
+        self.packetLength = packetLength
+        self.minTempo = minTempo
+        self.maxTempo = maxTempo
+        self.description = description
+
+    @property
+    def key(self):
+        """USB ids as vid:pid, ex. for compiled theme cache keys"""
+        return '{:04x}:{:04x}'.format(self.vendorId, self.productId)
+
+    def validateTempo(self, tempo):
+        if not (isinstance(tempo, int) and self.minTempo <= tempo <= self.maxTempo):
+            raise RuntimeError('Invalid tempo {} for {}, it must be from {} to {}'.format(tempo, self.name,
+                                                                                      self.minTempo, self.maxTempo))
+
+    @classmethod
+    def fromJson(cls, name, entry):
+        """A profile from its entry of a profiles file, USB ids may be hex strings ex. "0x187c" """
+        def integer(value):
+            return int(value, 0) if isinstance(value, str) else value
+
+        return cls(name, integer(entry['VENDOR_ID']), integer(entry['PRODUCT_ID']),
+                   OrderedDict((zoneName, integer(zoneCode)) for zoneName, zoneCode in entry['ZONES'].items()),
+                   entry.get('PACKET_LENGTH', AC.PACKET_LENGTH), entry.get('MIN_TEMPO', AC.MIN_TEMPO),
+                   entry.get('MAX_TEMPO', 0xffff), entry.get('DESCRIPTION', ''))
+
+    def __repr__(self):
+        return 'DeviceProfile({}, {})'.format(self.name, self.key)
+
+
+ALIENWARE_13R3 = DeviceProfile('13r3', AlienwareUSBDriver.VENDOR_ID, AlienwareUSBDriver.PRODUCT_ID, AC.Zones.CODES,
+                               AlienwareUSBDriver.PACKET_LENGTH, AC.MIN_TEMPO, description='Alienware 13 R3')
+
+
+class ProfileRegistry:
+    """Device profiles by name, at most one per pair of USB ids"""
+
+    def __init__(self, profiles=(ALIENWARE_13R3,)):
+        self._profiles = OrderedDict()
+        for profile in profiles:
+            self.register(profile)
+
+    def register(self, profile):
+        """Adds a profile, replacing the one of the same name"""
+        for other in self._profiles.values():
+            if other.name != profile.name and (other.vendorId, other.productId) == (profile.vendorId,
+                                                                                   profile.productId):
+                raise RuntimeError('Device profiles {} and {} have the same USB ids {}'.format(other.name, profile.name,
+                                                                                              profile.key))
+        self._profiles[profile.name] = profile
+
+    def get(self, name):
+        if name not in self._profiles:
+            raise RuntimeError('Unknown device profile {}, known profiles are {}'.format(name, list(self._profiles)))
+        return self._profiles[name]
+
+    def forIds(self, vendorId, productId):
+        """The profile of a controller, None if it has none"""
+        for profile in self._profiles.values():
+            if profile.vendorId == vendorId and profile.productId == productId:
+                return profile
+        return None
+
+    def __iter__(self):
+        return iter(self._profiles.values())
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def load(self, path=DEFAULT_PROFILES_FILE):
+        """Registers the profiles of a profiles file, if it exists, returns self
+
+        The file maps profile names to VENDOR_ID, PRODUCT_ID, ZONES (zone names to zone codes) and optionally
+        PACKET_LENGTH, MIN_TEMPO, MAX_TEMPO and DESCRIPTION.
+        """
+        try:
+            with open(path) as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return self
+        except (IOError, OSError, ValueError) as exc:
+            logging.error('Could not read device profiles from {}: {}'.format(path, exc))
+            return self
+        for name, entry in entries.items():
+            try:
+                self.register(DeviceProfile.fromJson(name, entry))
+            except (KeyError, TypeError, ValueError, AttributeError, RuntimeError) as exc:
+                logging.error('Ignoring device profile {} of {}: {}'.format(name, path, exc))
+        return self
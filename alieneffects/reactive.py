@@ -0,0 +1,293 @@
+import glob
+import logging
+import os
+
+from alieneffects.animation import lerpColor
+from alieneffects.controller import AlienwareController as AC
+
+# Metrics a rule can follow
+CPU = 'CPU'
+TEMPERATURE = 'TEMPERATURE'
+BATTERY = 'BATTERY'
+AC_ONLINE = 'AC_ONLINE'
+POWER_STATE = 'POWER_STATE'
+METRICS = (CPU, TEMPERATURE, BATTERY, AC_ONLINE, POWER_STATE)
+
+DEFAULT_RATE = 1.0
+
+
+class _SysFile:
+    """A /proc or /sys file kept open, read again from its start at each sample without reopening it"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+    def read(self):
+        return os.pread(self.fd, 4096, 0).decode('ascii', 'replace').strip()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SystemMetrics:
+    """Samples the metrics named (see METRICS) from /proc and /sys
+
+    Only the files needed by those metrics are opened, once. A sample reads each of them once
+    and returns {metric: value}, value None if the metric is not available on this machine.
+    CPU is the busy percentage since the previous sample, TEMPERATURE the hottest thermal zone (degrees C),
+    BATTERY the battery charge percentage, AC_ONLINE 1 or 0, and POWER_STATE the name of
+    the AlienwareController.PowerStates slot matching the AC and battery state.
+    """
+
+    def __init__(self, metrics, procRoot='/proc', sysRoot='/sys'):
+        self.metrics = frozenset(metrics)
+        self.procRoot = procRoot
+        self.sysRoot = sysRoot
+        self._files = []
+        self._cpuStat = None
+        self._lastCpuTimes = None
+        self._temperatures = []
+        self._acOnline = None
+        self._batteryCapacity = None
+        self._batteryStatus = None
+        self._batteryLevel = None
+
+        if CPU in self.metrics:
+            self._cpuStat = self._open(os.path.join(procRoot, 'stat'))
+        if TEMPERATURE in self.metrics:
+            for path in sorted(glob.glob(os.path.join(sysRoot, 'class/thermal/thermal_zone*/temp'))):
+                sysFile = self._open(path)
+                if sysFile is not None:
+                    self._temperatures.append(sysFile)
+        if self.metrics & {BATTERY, AC_ONLINE, POWER_STATE}:
+            self._openPowerSupplies()
+
+    def _open(self, path):
+        try:
+            sysFile = _SysFile(path)
+        except (IOError, OSError) as exc:
+            logging.debug('Metric source {} not available: {}'.format(path, exc))
+            return None
+        self._files.append(sysFile)
+        return sysFile
+
+    def _openPowerSupplies(self):
+        for supply in sorted(glob.glob(os.path.join(self.sysRoot, 'class/power_supply/*'))):
+            try:
+                with open(os.path.join(supply, 'type')) as file:
+                    supplyType = file.read().strip()
+            except (IOError, OSError):
+                continue
+            if supplyType == 'Mains' and self._acOnline is None:
+                self._acOnline = self._open(os.path.join(supply, 'online'))
+            elif supplyType == 'Battery' and self._batteryCapacity is None:
+                self._batteryCapacity = self._open(os.path.join(supply, 'capacity'))
+                self._batteryStatus = self._open(os.path.join(supply, 'status'))
+                if os.path.exists(os.path.join(supply, 'capacity_level')):
+                    self._batteryLevel = self._open(os.path.join(supply, 'capacity_level'))
+
+    @staticmethod
+    def _readInt(sysFile):
+        if sysFile is None:
+            return None
+        try:
+            return int(sysFile.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _readString(sysFile):
+        if sysFile is None:
+            return None
+        try:
+            return sysFile.read()
+        except (IOError, OSError):
+            return None
+
+    def _sampleCpu(self):
+        try:
+            # cpu user nice system idle iowait irq softirq steal ...
+            times = [int(value) for value in self._cpuStat.read().split('\n', 1)[0].split()[1:9]]
+        except (IOError, OSError, ValueError):
+            return None
+        lastTimes, self._lastCpuTimes = self._lastCpuTimes, times
+        if lastTimes is None:
+            return None
+        total = sum(times) - sum(lastTimes)
+        idle = times[3] + times[4] - lastTimes[3] - lastTimes[4]
+        return 100.0 * (total - idle) / total if total > 0 else 0.0
+
+    def _powerState(self, acOnline, capacity):
+        status = self._readString(self._batteryStatus)
+        if acOnline:
+            if status in ('Full', 'Not charging'):
+                return AC.PowerStates.AC_CHARGED
+            return AC.PowerStates.AC_CHARGING
+        if acOnline is None and status is None:
+            return None
+        level = self._readString(self._batteryLevel)
+        if level == 'Critical' or (level is None and capacity is not None and capacity <= 5):
+            return AC.PowerStates.BATTERY_CRITICAL
+        return AC.PowerStates.BATTERY_ON
+
+    def sample(self):
+        values = {}
+        if self._cpuStat is not None:
+            values[CPU] = self._sampleCpu()
+        if TEMPERATURE in self.metrics:
+            temperatures = [self._readInt(sysFile) for sysFile in self._temperatures]
+            temperatures = [temperature for temperature in temperatures if temperature is not None]
+            values[TEMPERATURE] = max(temperatures) / 1000.0 if temperatures else None
+        if self.metrics & {BATTERY, AC_ONLINE, POWER_STATE}:
+            acOnline = self._readInt(self._acOnline)
+            capacity = self._readInt(self._batteryCapacity)
+            values[AC_ONLINE] = acOnline
+            values[BATTERY] = capacity
+            if POWER_STATE in self.metrics:
+                values[POWER_STATE] = self._powerState(acOnline, capacity)
+        return values
+
+    def close(self):
+        for sysFile in self._files:
+            sysFile.close()
+        self._files = []
+
+
+class ReactiveRule:
+    """Maps one metric to the color of zones
+
+    A numeric metric is scaled from RANGE to [0, 1], quantized to STEPS levels and looked up in a gradient
+    through COLORS. The level only changes once the value moves HYSTERESIS of a step past the level boundary,
+    so that a value hovering around a boundary does not make the color flicker (and cost writes).
+    POWER_STATE is looked up in STATES, a map of power state names to colors.
+    """
+
+    def __init__(self, zones, metric, low=0.0, high=100.0, colors=((0, 255, 0), (255, 0, 0)), steps=8,
+                 hysteresis=0.25, states=None):
+        self.zones = zones
+        self.metric = metric
+        self.low = low
+        self.high = high
+        self.colors = [tuple(color) for color in colors]
+        self.steps = max(2, steps)
+        self.hysteresis = hysteresis
+        self.states = {name: tuple(color) for name, color in (states or {}).items()}
+        self.level = None
+        # Colors of the levels, computed once
+        self._levelColors = [self._gradient(level / (self.steps - 1)) for level in range(self.steps)]
+
+    def _gradient(self, fraction):
+        if len(self.colors) == 1:
+            return self.colors[0]
+        position = fraction * (len(self.colors) - 1)
+        index = min(int(position), len(self.colors) - 2)
+        return lerpColor(self.colors[index], self.colors[index + 1], position - index)
+
+    def quantize(self, value):
+        """Level (0 to steps - 1) of value, with hysteresis around the current level"""
+        fraction = (value - self.low) / (self.high - self.low) if self.high != self.low else 0.0
+        position = min(1.0, max(0.0, fraction)) * (self.steps - 1)
+        level = int(round(position))
+        if self.level is not None and level != self.level and abs(position - self.level) < 0.5 + self.hysteresis:
+            return self.level
+        return level
+
+    def color(self, value):
+        """Color for the value of the metric, None to leave the zones as they are"""
+        if value is None:
+            return None
+        if self.metric == POWER_STATE:
+            return self.states.get(value)
+        self.level = self.quantize(value)
+        return self._levelColors[self.level]
+
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _validateRuleColor(color):
+    if not (isinstance(color, (list, tuple)) and len(color) == 3):
+        raise RuntimeError('Invalid color {}'.format(color))
+    AC._validateColor(color)
+    return color
+
+
+def _validateRule(rule):
+    """Validated range, colors, steps, hysteresis and power state colors of a rule, raises RuntimeError"""
+    limits = rule.get('RANGE', [0, 100])
+    if not (isinstance(limits, (list, tuple)) and len(limits) == 2 and all(_isNumber(limit) for limit in limits)):
+        raise RuntimeError('Invalid RANGE {}'.format(limits))
+    colors = rule.get('COLORS', [[0, 255, 0], [255, 0, 0]])
+    if not (isinstance(colors, list) and colors):
+        raise RuntimeError('Invalid COLORS {}'.format(colors))
+    colors = [_validateRuleColor(color) for color in colors]
+    steps = rule.get('STEPS', 8)
+    if not (isinstance(steps, int) and not isinstance(steps, bool) and steps >= 2):
+        raise RuntimeError('Invalid STEPS {}, at least 2 are needed'.format(steps))
+    hysteresis = rule.get('HYSTERESIS', 0.25)
+    if not (_isNumber(hysteresis) and hysteresis >= 0):
+        raise RuntimeError('Invalid HYSTERESIS {}'.format(hysteresis))
+    states = {}
+    for names, color in rule.get('STATES', {}).items():
+        color = _validateRuleColor(color)
+        for name in names.split('|'):
+            if name in AC.PowerStates.CODES:
+                states[name] = color
+            else:
+                logging.warning('Ignoring unknown power state {}'.format(name))
+    return limits, colors, steps, hysteresis, states
+
+
+def parseReactiveRules(reactive):
+    """Validated ReactiveRules and sampling rate (per second) of the REACTIVE section of a theme
+
+    Rules with unknown metrics, no known zones or invalid fields are ignored with a warning, like unknown
+    power states. An invalid RATE is replaced by DEFAULT_RATE.
+    """
+    rules = []
+    for rule in reactive.get('RULES', []):
+        metric = rule.get('METRIC')
+        if metric not in METRICS:
+            logging.warning('Ignoring reactive rule with unknown metric {}'.format(metric))
+            continue
+        zones = [name for name in rule.get('ZONES', '').split('|') if name in AC.Zones.CODES]
+        if not zones:
+            logging.warning('Ignoring reactive rule of {} without known zones'.format(metric))
+            continue
+        try:
+            (low, high), colors, steps, hysteresis, states = _validateRule(rule)
+        except (RuntimeError, AttributeError, TypeError) as exc:
+            logging.warning('Ignoring reactive rule of {}: {}'.format(metric, exc))
+            continue
+        rules.append(ReactiveRule(zones, metric, low, high, colors, steps, hysteresis, states))
+    rate = reactive.get('RATE', DEFAULT_RATE)
+    if not (_isNumber(rate) and rate > 0):
+        logging.warning('Invalid reactive RATE {}, sampling {} times per second'.format(rate, DEFAULT_RATE))
+        rate = DEFAULT_RATE
+    return rules, rate
+
+
+class ReactiveEffect:
+    """Effect (see alieneffects.animation) coloring zones from system metrics, sampled once per frame
+
+    Run it with an AlienwareAnimator at the sampling rate: zones whose color is unchanged are not sent.
+    """
+
+    def __init__(self, rules, metrics=None):
+        self.rules = rules
+        self.metrics = metrics if metrics is not None else SystemMetrics(rule.metric for rule in rules)
+
+    def __call__(self, t):
+        values = self.metrics.sample()
+        colors = {}
+        for rule in self.rules:
+            color = rule.color(values.get(rule.metric))
+            if color is not None:
+                for zone in rule.zones:
+                    colors[zone] = color
+        return colors
+
+    def close(self):
+        self.metrics.close()
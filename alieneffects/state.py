@@ -0,0 +1,117 @@
+import glob
+import json
+import logging
+import os
+
+DEFAULT_STATE_FILE = '/run/alieneffects-13r3.state.json'
+
+
+def _readFirstLine(path, default=None):
+    try:
+        with open(path) as file:
+            return file.readline().strip()
+    except (IOError, OSError):
+        return default
+
+
+def readPowerContext():
+    """Things which, when changed, may change what the lights show without us sending anything
+
+    The lights are reprogrammed by the firmware on boot and the active power state slot depends on AC being online.
+    """
+    acOnline = None
+    for supply in sorted(glob.glob('/sys/class/power_supply/*')):
+        if _readFirstLine(os.path.join(supply, 'type')) == 'Mains':
+            acOnline = _readFirstLine(os.path.join(supply, 'online')) == '1'
+            break
+    return {
+        'bootId': _readFirstLine('/proc/sys/kernel/random/boot_id'),
+        'acOnline': acOnline,
+    }
+
+
+def packetToHex(pkt):
+    return bytes(pkt).hex()
+
+
+class ApplyState:
+    """The packet stream of the last successful apply along with its power context, persisted to a json file
+
+    With stateFile None, the state is only kept in memory.
+    """
+
+    def __init__(self, stateFile=DEFAULT_STATE_FILE):
+        self.stateFile = stateFile
+        self.context = None
+        self.tempoPacket = None
+        self.sequences = []
+        self.powerStates = []
+
+    def load(self):
+        if self.stateFile is None:
+            return self
+        try:
+            with open(self.stateFile) as file:
+                state = json.load(file)
+            self.context = state['context']
+            self.tempoPacket = state['tempoPacket']
+            self.sequences = [(zoneCode, packets) for zoneCode, packets in state['sequences']]
+            self.powerStates = [(powerStateCode, packets) for powerStateCode, packets in state.get('powerStates', [])]
+        except (IOError, OSError, ValueError, KeyError, TypeError) as exc:
+            logging.debug('No previous apply state in {}: {}'.format(self.stateFile, exc))
+            self.clear(persist=False)
+        return self
+
+    def save(self):
+        if self.stateFile is None:
+            return
+        state = {
+            'context': self.context,
+            'tempoPacket': self.tempoPacket,
+            'sequences': self.sequences,
+            'powerStates': self.powerStates,
+        }
+        tmpFile = self.stateFile + '.tmp'
+        try:
+            with open(tmpFile, 'w') as file:
+                json.dump(state, file)
+            os.replace(tmpFile, self.stateFile)
+        except (IOError, OSError) as exc:
+            logging.debug('Could not persist apply state to {}: {}'.format(self.stateFile, exc))
+
+    def clear(self, persist=True):
+        """Forget the last apply, ex. after a reset or a failure left the lights in an unknown state"""
+        self.context = None
+        self.tempoPacket = None
+        self.sequences = []
+        self.powerStates = []
+        if persist and self.stateFile is not None:
+            try:
+                os.remove(self.stateFile)
+            except (IOError, OSError):
+                pass
+
+    def record(self, compiled, context):
+        self.context = context
+        self.tempoPacket = packetToHex(compiled.commands[0])
+        self.sequences = [[zoneCode, [packetToHex(pkt) for pkt in packets]] for zoneCode, packets in compiled.sequences]
+        self.powerStates = [[powerStateCode, [packetToHex(pkt) for pkt in packets]]
+                            for powerStateCode, packets in compiled.powerStates]
+        self.save()
+
+    def diff(self, compiled, context):
+        """Compares the compiled theme against the last apply
+
+        Returns (isIdentical, numChangedSequences)
+        """
+        if self.context is None or self.context != context:
+            return False, len(compiled.sequences)
+        previous = [(zoneCode, packets) for zoneCode, packets in self.sequences]
+        current = [(zoneCode, [packetToHex(pkt) for pkt in packets]) for zoneCode, packets in compiled.sequences]
+        numChanged = sum(1 for sequence in current if sequence not in previous)
+        numChanged += max(0, len(previous) - len(current))
+        powerStates = [(powerStateCode, [packetToHex(pkt) for pkt in packets])
+                       for powerStateCode, packets in compiled.powerStates]
+        isIdentical = previous == current and self.tempoPacket == packetToHex(compiled.commands[0]) \
+            and [tuple(powerState) for powerState in self.powerStates] == powerStates
+        return isIdentical, numChanged
@@ -0,0 +1,143 @@
+import os
+import time
+from collections import OrderedDict
+
+# Phases of an apply, in the order they happen
+PHASES = ('read', 'parse', 'cache', 'validate', 'optimize', 'build', 'acquire', 'reset', 'resetWait', 'send',
+          'executeWait', 'release')
+
+
+class _PhaseTimer:
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stats.addPhase(self.name, time.perf_counter() - self.start)
+
+
+class ApplyStats:
+    """Where the time of an apply went, and what it cost in transfers
+
+    Pass one to AlienwareTheme.apply and read it afterwards: phases holds the seconds spent in each phase
+    (see PHASES, a phase repeated ex. by a restart accumulates), transfers the driver counters
+    (see usbdriver.TransferCounters) over the apply, statusPolls the polls of both ready waits.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.transfers = {}
+        self.statusPolls = 0
+        self.numPackets = 0
+        self.retries = 0
+        self.restarts = 0
+        self.cacheHit = False
+        self.skipped = False
+        self.ok = None
+        self.timestamp = time.time()
+
+    def phase(self, name):
+        """Context manager timing a phase"""
+        return _PhaseTimer(self, name)
+
+    def addPhase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @property
+    def elapsed(self):
+        return sum(self.phases.values())
+
+    def summary(self):
+        return {
+            'ok': self.ok,
+            'skipped': self.skipped,
+            'cacheHit': self.cacheHit,
+            'elapsed': self.elapsed,
+            'phases': OrderedDict((name, self.phases[name]) for name in self._phaseNames()),
+            'transfers': self.transfers,
+            'statusPolls': self.statusPolls,
+            'packets': self.numPackets,
+            'retries': self.retries,
+            'restarts': self.restarts,
+            'timestamp': self.timestamp,
+        }
+
+    @classmethod
+    def fromSummary(cls, summary):
+        """ApplyStats back from a summary, ex. one sent by the daemon"""
+        stats = cls()
+        stats.ok = summary['ok']
+        stats.skipped = summary['skipped']
+        stats.cacheHit = summary['cacheHit']
+        stats.phases = OrderedDict(summary['phases'])
+        stats.transfers = summary['transfers']
+        stats.statusPolls = summary['statusPolls']
+        stats.numPackets = summary['packets']
+        stats.retries = summary['retries']
+        stats.restarts = summary['restarts']
+        stats.timestamp = summary['timestamp']
+        return stats
+
+    def _phaseNames(self):
+        return [name for name in PHASES if name in self.phases] + \
+               [name for name in self.phases if name not in PHASES]
+
+    def toPrometheus(self, labels=None):
+        """The stats in the Prometheus text exposition format, as gauges of the last apply"""
+        labelText = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in sorted((labels or {}).items()))
+
+        def sample(name, value, extra=''):
+            allLabels = ','.join(text for text in (labelText, extra) if text)
+            return '{}{} {}'.format(name, '{' + allLabels + '}' if allLabels else '', float(value))
+
+        lines = []
+
+        def gauge(name, helpText, samples):
+            lines.append('# HELP {} {}'.format(name, helpText))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.extend(samples)
+
+        gauge('alieneffects_apply_phase_seconds', 'Seconds spent in each phase of the last apply',
+              [sample('alieneffects_apply_phase_seconds', self.phases[name], 'phase="{}"'.format(name))
+               for name in self._phaseNames()])
+        gauge('alieneffects_apply_duration_seconds', 'Seconds spent in all phases of the last apply',
+              [sample('alieneffects_apply_duration_seconds', self.elapsed)])
+        gauge('alieneffects_apply_transfers', 'USB transfers of the last apply',
+              [sample('alieneffects_apply_transfers', self.transfers.get(key, 0), 'kind="{}"'.format(kind))
+               for kind, key in (('write', 'writes'), ('read', 'reads'), ('short', 'shortTransfers'),
+                                 ('error', 'errors'))])
+        gauge('alieneffects_apply_bytes', 'Bytes transferred over USB by the last apply',
+              [sample('alieneffects_apply_bytes', self.transfers.get(key, 0), 'direction="{}"'.format(direction))
+               for direction, key in (('out', 'bytesWritten'), ('in', 'bytesRead'))])
+        gauge('alieneffects_apply_status_polls', 'Controller status polls of the last apply',
+              [sample('alieneffects_apply_status_polls', self.statusPolls)])
+        gauge('alieneffects_apply_retries', 'Packets resent by the last apply',
+              [sample('alieneffects_apply_retries', self.retries)])
+        gauge('alieneffects_apply_restarts', 'Times the last apply restarted from the reset',
+              [sample('alieneffects_apply_restarts', self.restarts)])
+        gauge('alieneffects_apply_success', 'Whether the last apply succeeded',
+              [sample('alieneffects_apply_success', 1 if self.ok else 0)])
+        gauge('alieneffects_apply_skipped', 'Whether the last apply was skipped as already applied',
+              [sample('alieneffects_apply_skipped', 1 if self.skipped else 0)])
+        gauge('alieneffects_apply_timestamp_seconds', 'Unix time of the last apply',
+              [sample('alieneffects_apply_timestamp_seconds', self.timestamp)])
+        return '\n'.join(lines) + '\n'
+
+
+def writePrometheusTextfile(stats, path, labels=None):
+    """Writes stats for the node_exporter textfile collector
+
+    The collector reads whole files and rejects repeated series, so the file is replaced (atomically,
+    through a temporary file renamed over it) by the stats of the latest apply rather than appended to.
+    """
+    tmpFile = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmpFile, 'w') as file:
+        file.write(stats.toPrometheus(labels))
+    os.replace(tmpFile, path)
@@ -1,32 +1,105 @@
 import json
 import logging
-from random import randint
+import time
+from collections import OrderedDict
+from random import getrandbits
 
+from alieneffects.compiler import compileTheme
 from alieneffects.controller import AlienwareController as AC
+from alieneffects.optimizer import optimizeTheme
+from alieneffects.reactive import parseReactiveRules
+from alieneffects.state import ApplyState, readPowerContext
+from alieneffects.stats import ApplyStats
+from alieneffects.transaction import TransferError
 
 
 def generateRandomColor():
-    return [randint(0, 255), randint(0, 255), randint(0, 255)]
+    # One draw for the three channels
+    value = getrandbits(24)
+    return [value >> 16, (value >> 8) & 0xff, value & 0xff]
+
+
+def sendCompiledTheme(ac, compiled, stats=None):
+    """Resets the lights and sends the packets of a CompiledTheme, with the driver of ac acquired
+
+    Waits until the controller has executed them, returns the BatchResult of the theme packets.
+    Raises TransferError if packets could not be delivered, ControllerNotReadyError if the controller stays busy.
+    The reset, send and ready waits are timed in stats (an ApplyStats) if given.
+    """
+    if stats is None:
+        stats = ApplyStats()
+    def send(cmds, restart=None):
+        result = ac.sendTransaction(cmds, restart)
+        if not result.ok:
+            raise TransferError('Packet {} of {} could not be sent: {}'.format(
+                result.failedIndex, result.numPackets, result.outcomes[-1].error))
+        return result
+
+    def restart():
+        # RESET is safe to resend, so it is retried in place
+        with stats.phase('reset'):
+            send([AC.makeResetCmd(AC.Reset.CODES[AC.Reset.ALL_LIGHTS_ON])])
+        with stats.phase('resetWait'):
+            stats.statusPolls += ac.waitUntilControllerReady(AC.Commands.RESET)
+
+    def restartTime():
+        return stats.phases.get('reset', 0.0) + stats.phases.get('resetWait', 0.0)
+
+    restart()
+    # Restarts happen while sending, their time is only counted in their own phases
+    start, restartTimeBefore = time.perf_counter(), restartTime()
+    result = send(compiled.commands, restart)
+    stats.addPhase('send', time.perf_counter() - start - (restartTime() - restartTimeBefore))
+    stats.retries += result.numRetries
+    stats.restarts += result.numRestarts
+    with stats.phase('executeWait'):
+        stats.statusPolls += ac.waitUntilControllerReady(AC.Commands.EXECUTE)
+    return result
+
+
+def _zoneCodes(profile):
+    return AC.Zones.CODES if profile is None else profile.zones
 
 
 class AlienwareTheme:
     def __init__(self, filepath):
-        with open(filepath) as file:
-            jsonString = ''.join(file.readlines())
-        self.theme = json.loads(jsonString)
+        start = time.perf_counter()
+        with open(filepath, 'rb') as file:
+            self.raw = file.read()
+        self.readTime = time.perf_counter() - start
+        self._theme = None
 
-    def validate(self):
-        t = self.theme
+    @property
+    def theme(self):
+        # Parsed lazily, a compiled theme cache hit does not need it
+        if self._theme is None:
+            self._theme = json.loads(self.raw.decode('utf-8'))
+        return self._theme
 
-        validatedDescription = t.get('DESCRIPTION', '')
+    def zoneMaps(self):
+        """The ZONES of the theme and of each of its POWER_STATES"""
+        yield self.theme.get('ZONES', {})
+        for powerState in self.theme.get('POWER_STATES', {}).values():
+            yield powerState.get('ZONES', {})
 
-        # No need to further validate type for these fields
-        # That validation will be done in AlienwareController class
-        validatedTempo = t.get('TEMPO', 200)
-        validatedDuration = t.get('DURATION', 10000)
+    def isRandom(self):
+        """Whether any effect has an implicit random color, i.e. whether compiling twice can give different packets"""
+        for zones in self.zoneMaps():
+            for sequence in zones.values():
+                for effect in sequence:
+                    effectName = effect.get('EFFECT', '')
+                    if effectName == AC.Commands.SET_COLOR or effectName == AC.Commands.BLINK_COLOR:
+                        if 'COLOR' not in effect:
+                            return True
+                    elif effectName == AC.Commands.MORPH_COLOR:
+                        if 'COLOR1' not in effect or 'COLOR2' not in effect:
+                            return True
+        return False
 
+    @staticmethod
+    def _validateZones(zones, zoneCodes=AC.Zones.CODES):
+        """Validated zone code sequence map of a ZONES object, zoneCodes maps the zone names of the device to codes"""
         # Parsing multiple zones separated by |
-        zones = t.get('ZONES', {})
         expandedZones = {}
         for zoneNamesConcatenated, value in zones.items():
             zoneNames = zoneNamesConcatenated.split('|')
@@ -36,7 +109,7 @@ class AlienwareTheme:
 
         # Validating sequences
         validatedZoneCodeSequenceMap = {}
-        for name, zoneCode in AC.Zones.CODES.items():
+        for name, zoneCode in zoneCodes.items():
             sequence = zones.get(name, [])
             validatedSequence = []
             for effect in sequence:
@@ -51,53 +124,155 @@ class AlienwareTheme:
                     effect['COLOR2'] = effect.get('COLOR2', generateRandomColor())
                 validatedSequence.append(effect)
             validatedZoneCodeSequenceMap[zoneCode] = validatedSequence
+        return validatedZoneCodeSequenceMap
+
+    def validate(self, profile=None):
+        """Validated description, tempo, duration and zones, for the zones of a DeviceProfile if given"""
+        t = self.theme
+
+        validatedDescription = t.get('DESCRIPTION', '')
+
+        # No need to further validate type for these fields
+        # That validation will be done in AlienwareController class
+        validatedTempo = t.get('TEMPO', 200)
+        validatedDuration = t.get('DURATION', 10000)
+
+        validatedZoneCodeSequenceMap = self._validateZones(t.get('ZONES', {}), _zoneCodes(profile))
 
         logging.debug('Theme validation complete')
-        logging.debug('Validated tempo = {}ms, Validated duration = {}ms'.format(validatedTempo, validatedDuration))
-        logging.debug('Validated zone sequence map: {}'.format(validatedZoneCodeSequenceMap))
+        logging.debug('Validated tempo = %sms, Validated duration = %sms', validatedTempo, validatedDuration)
+        logging.debug('Validated zone sequence map: %s', validatedZoneCodeSequenceMap)
 
         return validatedDescription, validatedTempo, validatedDuration, validatedZoneCodeSequenceMap
 
-    def apply(self):
-        _, validatedTempo, validatedDuration, validatedZoneCodeSequenceMap = self.validate()
+    def validatePowerStates(self, profile=None):
+        """Validates the POWER_STATES of the theme, the zones to be saved in power state slots
+
+        Like zones, several power states can share one entry by delimiting them with '|'.
+        Returns a map of power state codes to validated zone code sequence maps.
+        """
+        validatedPowerStates = OrderedDict()
+        for powerStateNamesConcatenated, powerState in self.theme.get('POWER_STATES', {}).items():
+            zoneCodeSequenceMap = self._validateZones(powerState.get('ZONES', {}), _zoneCodes(profile))
+            for powerStateName in powerStateNamesConcatenated.split('|'):
+                if powerStateName not in AC.PowerStates.CODES:
+                    logging.warning('Ignoring unknown power state %s', powerStateName)
+                    continue
+                validatedPowerStates[AC.PowerStates.CODES[powerStateName]] = zoneCodeSequenceMap
+        return validatedPowerStates
+
+    def validateReactive(self):
+        """Validated rules and sampling rate of the REACTIVE section, see alieneffects.reactive"""
+        return parseReactiveRules(self.theme.get('REACTIVE', {}))
 
-        ac = AC()
+    def compile(self, coalesce=True, cache=None, stats=None, optimize=False, profile=None):
+        """Validate the theme and compile it to packets, see alieneffects.compiler.compileTheme
+
+        If a CompiledThemeCache is given, deterministic themes are loaded from and stored to it.
+        The phases are timed in stats (an ApplyStats) if given.
+        With optimize, sequences are rewritten to minimal equivalent ones first, see alieneffects.optimizer.
+        With a DeviceProfile (see alieneffects.profiles), the theme is compiled for its zones and tempo limits.
+        """
+        if stats is None:
+            stats = ApplyStats()
+        key = None
+        if cache is not None:
+            with stats.phase('cache'):
+                key = cache.key(self.raw, coalesce, optimize, profile)
+                compiled = cache.load(key)
+            if compiled is not None:
+                stats.cacheHit = True
+                logging.debug('Compiled theme loaded from cache, key %s', key)
+                return compiled
+
+        with stats.phase('parse'):
+            self.theme
+        if key is not None and self.isRandom():
+            key = None
+
+        with stats.phase('validate'):
+            _, validatedTempo, validatedDuration, validatedZoneCodeSequenceMap = self.validate(profile)
+            validatedPowerStates = self.validatePowerStates(profile)
+            if profile is not None:
+                profile.validateTempo(validatedTempo)
+        if optimize:
+            with stats.phase('optimize'):
+                validatedZoneCodeSequenceMap, validatedPowerStates = optimizeTheme(validatedZoneCodeSequenceMap,
+                                                                                   validatedPowerStates)
+        with stats.phase('build'):
+            compiled = compileTheme(validatedTempo, validatedDuration, validatedZoneCodeSequenceMap, coalesce,
+                                    validatedPowerStates)
+
+        if key is not None:
+            with stats.phase('cache'):
+                cache.store(key, compiled)
+        return compiled
+
+    def apply(self, ac=None, coalesce=True, state=None, force=False, cache=None, stats=None, optimize=False):
+        """Apply the theme, using the given controller if any
+
+        A controller that is passed in is expected to be managed by the caller (ex. the daemon),
+        so its USB driver is neither acquired nor released here.
+        If the compiled packets and power context match the last apply recorded in state,
+        nothing is sent unless forced.
+        If an ApplyStats is given, it is filled with the time of each phase and the transfers made.
+        With optimize, sequences are rewritten to minimal equivalent ones before being compiled.
+        Returns True if the theme was applied (or was semantically empty), False otherwise.
+        """
+        if state is None:
+            state = ApplyState().load()
+        if stats is None:
+            stats = ApplyStats()
+        stats.addPhase('read', self.readTime)
+
+        ownsController = ac is None
+        if ownsController:
+            ac = AC()
+        counters = None
         try:
-            # prepare commands
-            commands = [ac.makeSetTempoCmd(validatedTempo)]
-            sequenceId = 0
-            for zoneCode, sequence in validatedZoneCodeSequenceMap.items():
-                for effect in sequence:
-                    effectName = effect['EFFECT']
-                    if effectName == AC.Commands.SET_COLOR:
-                        commands.append(ac.makeSetColorCmd(sequenceId, zoneCode, effect['COLOR']))
-                    elif effectName == AC.Commands.BLINK_COLOR:
-                        commands.append(ac.makeBlinkColorCmd(sequenceId, zoneCode, effect['COLOR']))
-                    elif effectName == AC.Commands.MORPH_COLOR:
-                        commands.append(ac.makeMorphColorCmd(sequenceId, zoneCode, effect['COLOR1'], effect['COLOR2']))
-                    elif effectName == AC.Commands.LOOP_SEQUENCE:
-                        commands.append(ac.makeLoopSequenceCmd())
-                    else:
-                        raise RuntimeError('Invalid effect code')
-                sequenceId += 1
-            commands.append(ac.makeExecuteCmd())
+            compiled = self.compile(coalesce, cache, stats, optimize)
+            stats.numPackets = compiled.numPackets
 
             # send commands
-            if len(commands) > 2:
-                ac.driver.acquire()
-                ac.reset(AC.Reset.CODES[AC.Reset.ALL_LIGHTS_ON])
-                ac.waitUntilControllerReady()
-                ac.sendCommands(commands)
-                ac.waitUntilControllerReady()
-                logging.debug('Theme {} applied\n\twith tempo {} and duration {}'.format(validatedZoneCodeSequenceMap,
-                                                                                         validatedTempo,
-                                                                                         validatedDuration))
+            if not compiled.isEmpty():
+                context = readPowerContext()
+                isIdentical, numChangedSequences = state.diff(compiled, context)
+                if isIdentical and not force:
+                    logging.info('Theme is already applied, avoided 1 reset, %s packets and 2 ready waits',
+                                 compiled.numPackets)
+                    stats.skipped = True
+                    stats.ok = True
+                    return True
+                # A RESET is the only way to clear sequences and it clears all of them,
+                # so the smallest correct update for any change is the whole stream
+                logging.debug('%s of %s sequences changed since last apply', numChangedSequences,
+                              len(compiled.sequences))
+                counters = ac.driver.counters.snapshot()
+                with stats.phase('acquire'):
+                    ac.driver.acquire()
+                result = sendCompiledTheme(ac, compiled, stats)
+                if result.numRetries or result.numRestarts:
+                    logging.warning('Theme sent after %s retries and %s restarts', result.numRetries,
+                                    result.numRestarts)
+                state.record(compiled, context)
+                logging.debug('Theme %s applied\n\twith tempo %s and duration %s', self, compiled.tempo,
+                              compiled.duration)
             else:
-                logging.debug('Theme {} is semantically empty. So not applying it')
+                logging.debug('Theme %s is semantically empty. So not applying it', self)
+            stats.ok = True
+            return True
         except Exception as e:
             logging.error('Exception occurred', exc_info=True)
+            # Lights may be half programmed
+            state.clear()
+            stats.ok = False
+            return False
         finally:
-            ac.driver.release()
+            if ownsController:
+                with stats.phase('release'):
+                    ac.driver.release()
+            if counters is not None:
+                stats.transfers = ac.driver.counters.since(counters)
 
     def __str__(self):
         return str(self.theme)
@@ -0,0 +1,128 @@
+import logging
+import os
+import struct
+import time
+
+
+class TraceRecord:
+    WRITE = 0
+    READ = 1
+    WRITE_FAILED = 2
+    READ_FAILED = 3
+
+    NAMES = {
+        WRITE: 'WRITE',
+        READ: 'READ',
+        WRITE_FAILED: 'WRITE_FAILED',
+        READ_FAILED: 'READ_FAILED',
+    }
+
+
+class TraceRecorder:
+    """Appends timestamped raw packets and status responses to a compact binary trace file
+
+    File layout: MAGIC, then records of (monotonic timestamp in seconds as a double, kind, data length, data).
+    Timestamps are only meaningful relative to each other; a file appended to by several sessions
+    is replayed session after session.
+    Attach to a driver by setting its tracer attribute.
+    """
+
+    MAGIC = b'AETRACE1'
+    RECORD = struct.Struct('<dBB')
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(self.MAGIC)
+        self.numRecords = 0
+
+    def record(self, kind, data=b''):
+        data = bytes(data) if data is not None else b''
+        self._file.write(self.RECORD.pack(time.monotonic(), kind, len(data)))
+        self._file.write(data)
+        self.numRecords += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            logging.debug('Trace of %s records appended to %s', self.numRecords, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+
+
+def readTrace(path):
+    """Yields (timestamp, kind, data) records of a trace file"""
+    with open(path, 'rb') as file:
+        if file.read(len(TraceRecorder.MAGIC)) != TraceRecorder.MAGIC:
+            raise RuntimeError('{} is not a trace file'.format(path))
+        header = TraceRecorder.RECORD
+        while True:
+            raw = file.read(header.size)
+            if len(raw) < header.size:
+                return
+            timestamp, kind, length = header.unpack(raw)
+            data = file.read(length)
+            if len(data) < length:
+                logging.warning('Trace %s is truncated', path)
+                return
+            yield timestamp, kind, data
+
+
+class TraceReplayer:
+    """Feeds the writes of a trace back into a driver, at the original pace or as fast as possible
+
+    Reads are replayed as reads, and counted as mismatches when the status byte differs from the trace.
+    Failed transfers are not replayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def replay(self, driver, maxSpeed=False):
+        stats = {'writes': 0, 'reads': 0, 'skipped': 0, 'mismatches': 0, 'elapsed': 0.0}
+        start = time.monotonic()
+        traceStart = None
+        previousTimestamp = None
+        for timestamp, kind, data in readTrace(self.path):
+            # A timestamp going backwards is the start of another session appended to the file
+            if traceStart is None or timestamp < previousTimestamp:
+                traceStart = timestamp - (time.monotonic() - start)
+            previousTimestamp = timestamp
+            if not maxSpeed:
+                delay = (timestamp - traceStart) - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            if kind == TraceRecord.WRITE:
+                driver.writePacket(data)
+                stats['writes'] += 1
+            elif kind == TraceRecord.READ:
+                response = driver.readPacket()
+                stats['reads'] += 1
+                if not response or len(data) == 0 or response[0] != data[0]:
+                    stats['mismatches'] += 1
+            else:
+                stats['skipped'] += 1
+        stats['elapsed'] = time.monotonic() - start
+        return stats
+
+
+def dumpTrace(path):
+    """Lines describing a trace, with timestamps relative to the first record"""
+    first = None
+    for timestamp, kind, data in readTrace(path):
+        if first is None:
+            first = timestamp
+        yield '{:12.6f} {:12s} {}'.format(timestamp - first, TraceRecord.NAMES.get(kind, str(kind)), data.hex())
+
+
+def isTraceFile(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as file:
+        return file.read(len(TraceRecorder.MAGIC)) == TraceRecorder.MAGIC
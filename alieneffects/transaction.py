@@ -0,0 +1,147 @@
+import logging
+import time
+
+
+class TransferError(RuntimeError):
+    """Raised when a batch of packets could not be delivered, even after retries"""
+    pass
+
+
+class PacketOutcome:
+    """What happened to one packet of a batch: how many attempts it took and whether it got through"""
+
+    __slots__ = ('index', 'attempts', 'bytesWritten', 'error', 'elapsed')
+
+    def __init__(self, index):
+        self.index = index
+        self.attempts = 0
+        self.bytesWritten = None
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None and self.bytesWritten is not None
+
+    def toDict(self):
+        return {
+            'index': self.index,
+            'attempts': self.attempts,
+            'bytesWritten': self.bytesWritten,
+            'error': self.error,
+            'elapsed': self.elapsed,
+        }
+
+    def __repr__(self):
+        return 'PacketOutcome(index={}, attempts={}, bytesWritten={}, error={})'.format(
+            self.index, self.attempts, self.bytesWritten, self.error)
+
+
+class BatchResult:
+    """Outcome of sending a batch: one PacketOutcome per packet sent, of the last pass if the batch was restarted"""
+
+    def __init__(self, numPackets):
+        self.numPackets = numPackets
+        self.outcomes = []
+        self.numRetries = 0
+        self.numRestarts = 0
+        self.elapsed = 0.0
+        self.failedIndex = None
+
+    @property
+    def ok(self):
+        return self.failedIndex is None and len(self.outcomes) == self.numPackets
+
+    def summary(self):
+        return {
+            'ok': self.ok,
+            'packets': self.numPackets,
+            'sent': sum(1 for outcome in self.outcomes if outcome.ok),
+            'retries': self.numRetries,
+            'restarts': self.numRestarts,
+            'failedIndex': self.failedIndex,
+            'elapsed': self.elapsed,
+        }
+
+
+class BatchSender:
+    """Sends packets one by one, checking the result of every transfer
+
+    A short write is never applied by the controller, so it is retried in place.
+    A failed transfer of a packet that is safe to repeat (ex. SET_TEMPO, EXECUTE) is retried in place too.
+    A failed transfer of a color or LOOP_SEQUENCE packet is ambiguous: the controller may have appended it
+    to its sequence or not, and sending it again could duplicate it. Sequences can only be cleared
+    by a RESET, so the batch is restarted from the beginning through the restart callable if one is given,
+    up to maxRestarts times.
+    Retries wait initialDelay seconds, growing by backoff up to maxDelay, at most maxRetries times per packet.
+    retrySafeCodes are the command codes (second byte of a packet) of the packets safe to resend,
+    see AlienwareController.Commands.RETRY_SAFE.
+    """
+
+    def __init__(self, retrySafeCodes=(), maxRetries=3, initialDelay=0.001, maxDelay=0.05, backoff=2.0,
+                 maxRestarts=1):
+        self.retrySafeCodes = frozenset(retrySafeCodes)
+        self.maxRetries = maxRetries
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.maxRestarts = maxRestarts
+
+    def isRetrySafe(self, pkt):
+        return len(pkt) > 1 and pkt[1] in self.retrySafeCodes
+
+    def _sendPacket(self, driver, pkt, outcome, result):
+        """Sends pkt, retrying in place when that is safe. Returns False if the batch has to be restarted"""
+        delay = self.initialDelay
+        start = time.monotonic()
+        while True:
+            outcome.attempts += 1
+            ambiguous = False
+            try:
+                outcome.bytesWritten = driver.sendPacket(pkt)
+                if outcome.bytesWritten == len(pkt):
+                    outcome.error = None
+                    outcome.elapsed = time.monotonic() - start
+                    return True
+                outcome.error = 'short write of {} of {} bytes'.format(outcome.bytesWritten, len(pkt))
+            except OSError as exc:
+                # USBError is an IOError
+                outcome.bytesWritten = None
+                outcome.error = str(exc) or type(exc).__name__
+                ambiguous = not self.isRetrySafe(pkt)
+            outcome.elapsed = time.monotonic() - start
+            logging.debug('Packet %s, attempt %s: %s', outcome.index, outcome.attempts, outcome.error)
+
+            if ambiguous or outcome.attempts > self.maxRetries:
+                return False
+            result.numRetries += 1
+            time.sleep(delay)
+            delay = min(delay * self.backoff, self.maxDelay)
+
+    def send(self, driver, packets, restart=None):
+        """Sends packets (a list of packets, ex. CompiledTheme.commands) with driver, returns a BatchResult
+
+        restart, if given, is called without arguments to bring the controller back to the state
+        the batch starts from (ex. RESET and wait) before the batch is sent again.
+        Errors raised by restart propagate.
+        """
+        packets = list(packets)
+        result = BatchResult(len(packets))
+        start = time.monotonic()
+        while True:
+            result.outcomes = []
+            result.failedIndex = None
+            for index, pkt in enumerate(packets):
+                outcome = PacketOutcome(index)
+                result.outcomes.append(outcome)
+                if not self._sendPacket(driver, pkt, outcome, result):
+                    result.failedIndex = index
+                    break
+            if result.failedIndex is None or restart is None or result.numRestarts >= self.maxRestarts:
+                break
+            result.numRestarts += 1
+            logging.warning('Packet {} of {} failed ({}), restarting the batch'.format(
+                result.failedIndex, len(packets), result.outcomes[-1].error))
+            restart()
+        result.elapsed = time.monotonic() - start
+        return result
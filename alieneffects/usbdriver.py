@@ -1,7 +1,49 @@
 import logging
+import time
+from collections import OrderedDict
 
-import usb
-from usb import USBError
+from alieneffects.trace import TraceRecord
+
+# pyusb and its libusb backend are only loaded by loadUsb (ex. on acquire), so that what does not touch
+# the hardware (validating, describing, compiling themes) does not pay for them
+usb = None
+# usb.USBError once loaded, it is an IOError
+USBError = OSError
+
+
+def loadUsb():
+    """Imports pyusb on first use, returns the usb module"""
+    global usb, USBError
+    if usb is None:
+        import usb.core
+        import usb.util
+        USBError = usb.USBError
+    return usb
+
+
+class DeviceNotFoundError(RuntimeError):
+    """Raised when the lighting controller is not on the USB bus"""
+    pass
+
+
+class TransferCounters:
+    """Transfers made by a driver, cheap enough to be always counted"""
+
+    __slots__ = ('writes', 'reads', 'bytesWritten', 'bytesRead', 'shortTransfers', 'errors')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def snapshot(self):
+        counters = TransferCounters()
+        for name in self.__slots__:
+            setattr(counters, name, getattr(self, name))
+        return counters
+
+    def since(self, snapshot):
+        """The counts since snapshot was taken, as a dict"""
+        return {name: getattr(self, name) - getattr(snapshot, name) for name in self.__slots__}
 
 
 class AlienwareUSBDriver:
@@ -22,42 +64,132 @@ class AlienwareUSBDriver:
 
     PACKET_LENGTH = 12
 
-    def __init__(self):
+    def __init__(self, vendorId=VENDOR_ID, productId=PRODUCT_ID, packetLength=PACKET_LENGTH, device=None):
+        """vendorId, productId and packetLength are those of the controller model (see alieneffects.profiles)
+
+        Given a device (ex. one found by discover), the driver is bound to it: acquire does not look for
+        another controller if it goes away.
+        """
+        self.vendorId = vendorId
+        self.productId = productId
+        # Packets shorter than this are zero padded
+        self.packetLength = packetLength
         self._control_taken = False
-        self._device = None
+        self._device = device
+        self._bound = device is not None
+        # Whether acquire detached the kernel driver, so that release only re-attaches what it detached
+        self._detached = False
+        # Timeout of each control transfer in ms, 0 waits forever
+        self.timeout = 0
+        # An optional trace.TraceRecorder, recording every transfer
+        self.tracer = None
+        # Seconds spent in each step of the last acquire
+        self.acquireTimings = OrderedDict()
+        self.counters = TransferCounters()
+
+    @classmethod
+    def discover(cls, profiles):
+        """Drivers bound to every controller on the bus matching one of profiles (see alieneffects.profiles)
+
+        All controllers are found in one bus scan. Returns a list of (profile, driver), in bus order.
+        """
+        loadUsb()
+        profilesByIds = {(profile.vendorId, profile.productId): profile for profile in profiles}
+        devices = usb.core.find(find_all=True,
+                                custom_match=lambda d: (d.idVendor, d.idProduct) in profilesByIds)
+        found = []
+        for device in sorted(devices, key=lambda d: (d.bus, d.address)):
+            profile = profilesByIds[(device.idVendor, device.idProduct)]
+            found.append((profile, cls(vendorId=profile.vendorId, productId=profile.productId,
+                                       packetLength=profile.packetLength, device=device)))
+        return found
+
+    @property
+    def deviceAddress(self):
+        """bus:address of the controller, None until it is found"""
+        if self._device is None:
+            return None
+        return '{}:{}'.format(self._device.bus, self._device.address)
+
+    def _isSameDevice(self, device):
+        """Cheaply checks that a device found earlier is still there"""
+        try:
+            device.is_kernel_driver_active(0)
+            return True
+        except (USBError, NotImplementedError):
+            return False
+
+    def _findDevice(self, timings):
+        """The controller, reusing the device of the previous acquire if it is still there, else scanning the bus"""
+        start = time.perf_counter()
+        if self._device is not None and self._isSameDevice(self._device):
+            timings['find'] = time.perf_counter() - start
+            return self._device
+        if self._bound:
+            timings['find'] = time.perf_counter() - start
+            return None
+
+        device = usb.core.find(idVendor=self.vendorId, idProduct=self.productId)
+        timings['find'] = time.perf_counter() - start
+        return device
 
     def acquire(self):
-        """ Acquire control of the USB controller."""
+        """ Acquire control of the USB controller.
+
+        Raises DeviceNotFoundError if there is no controller on the bus.
+        The kernel driver is only detached if bound, and the configuration only set if none is active,
+        since setting it can reset the device.
+        """
         if self._control_taken:
             return
 
-        self._device = usb.core.find(idVendor=AlienwareUSBDriver.VENDOR_ID, idProduct=AlienwareUSBDriver.PRODUCT_ID)
-
+        timings = OrderedDict()
+        start = time.perf_counter()
+        loadUsb()
+        timings['import'] = time.perf_counter() - start
+        self._device = self._findDevice(timings)
         if self._device is None:
-            logging.error("ERROR: No AlienFX USB controller found; tried VID {}, PID {}"
-                          .format(AlienwareUSBDriver.VENDOR_ID, AlienwareUSBDriver.PRODUCT_ID))
+            raise DeviceNotFoundError("No AlienFX USB controller found; tried VID {}, PID {}"
+                                      .format(hex(self.vendorId), hex(self.productId)))
 
+        stepStart = time.perf_counter()
         try:
-            self._device.detach_kernel_driver(0)
+            if self._device.is_kernel_driver_active(0):
+                self._device.detach_kernel_driver(0)
+                self._detached = True
         except USBError as exc:
             logging.error("Cant detach kernel driver. Error : {}".format(exc.strerror))
+        timings['detach'] = time.perf_counter() - stepStart
 
+        stepStart = time.perf_counter()
         try:
-            self._device.set_configuration()
-        except USBError as exc:
-            logging.error("Cant set configuration. Error : {}".format(exc.strerror))
+            self._device.get_active_configuration()
+        except USBError:
+            try:
+                self._device.set_configuration()
+            except USBError as exc:
+                logging.error("Cant set configuration. Error : {}".format(exc.strerror))
+        timings['configure'] = time.perf_counter() - stepStart
 
+        stepStart = time.perf_counter()
         try:
             usb.util.claim_interface(self._device, 0)
         except USBError as exc:
             logging.error("Cant claim interface. Error : {}".format(exc.strerror))
+        timings['claim'] = time.perf_counter() - stepStart
+        timings['total'] = time.perf_counter() - start
+        self.acquireTimings = timings
 
         self._control_taken = True
-        logging.debug("USB device acquired, VID={}, PID={}".format(hex(AlienwareUSBDriver.VENDOR_ID),
-                                                                   hex(AlienwareUSBDriver.PRODUCT_ID)))
+        logging.debug("USB device acquired, VID={}, PID={}, timings {}".format(
+            hex(self.vendorId), hex(self.productId),
+            ', '.join('{}={:.6f}s'.format(step, seconds) for step, seconds in timings.items())))
 
     def release(self):
-        """ Release control of the USB controller."""
+        """ Release control of the USB controller.
+
+        The device is kept, so that acquiring it again skips the bus scan.
+        """
         if not self._control_taken:
             return
 
@@ -66,31 +198,67 @@ class AlienwareUSBDriver:
         except USBError as exc:
             logging.error("Cant release interface. Error : {}".format(exc.strerror))
 
-        try:
-            self._device.attach_kernel_driver(0)
-        except USBError as exc:
-            logging.error("Cant re-attach. Error : {}".format(exc.strerror))
+        if self._detached:
+            try:
+                self._device.attach_kernel_driver(0)
+            except USBError as exc:
+                logging.error("Cant re-attach. Error : {}".format(exc.strerror))
+            self._detached = False
 
         self._control_taken = False
-        logging.debug("USB device released, VID={}, PID={}".format(hex(AlienwareUSBDriver.VENDOR_ID),
-                                                                   hex(AlienwareUSBDriver.PRODUCT_ID)))
+        logging.debug("USB device released, VID={}, PID={}".format(hex(self.vendorId), hex(self.productId)))
 
-    def writePacket(self, pkt):
-        """ Write the given packet over USB"""
+    def sendPacket(self, pkt):
+        """ Write the given packet (any sequence of byte values, ex. a memoryview slice) over USB
+
+        Returns the number of bytes written, which is less than the packet length on a short write.
+        Packets are zero padded to packetLength, the padding is not counted in what is returned.
+        Raises USBError if the transfer failed, and RuntimeError if control is not taken.
+        """
         if not self._control_taken:
-            return
+            raise RuntimeError('sendPacket: control not taken')
+        padding = self.packetLength - len(pkt)
+        if padding > 0:
+            pkt = bytes(pkt) + bytes(padding)
 
         try:
             numBytesSent = self._device.ctrl_transfer(
                 self.OUT_BM_REQUEST_TYPE, self.OUT_B_REQUEST,
                 self.OUT_W_VALUE, self.OUT_W_INDEX,
-                pkt, 0)
+                pkt, self.timeout)
+        except USBError:
+            self.counters.errors += 1
+            if self.tracer is not None:
+                self.tracer.record(TraceRecord.WRITE_FAILED, pkt)
+            raise
+
+        counters = self.counters
+        counters.writes += 1
+        counters.bytesWritten += numBytesSent
+        if numBytesSent != len(pkt):
+            counters.shortTransfers += 1
+        if self.tracer is not None:
+            self.tracer.record(TraceRecord.WRITE, pkt)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("wrote: %s, %s bytes", list(pkt), len(pkt))
+        if padding > 0:
+            return max(0, numBytesSent - padding)
+        return numBytesSent
 
-            logging.debug("wrote: {}, {} bytes".format(pkt, len(pkt)))
+    def writePacket(self, pkt):
+        """ Write the given packet over USB, logging failures instead of raising them
+
+        Returns the number of bytes written, None if the transfer failed.
+        See alieneffects.transaction for sending packets with checks and retries.
+        """
+        if not self._control_taken:
+            return
+
+        try:
+            numBytesSent = self.sendPacket(pkt)
             if len(pkt) != numBytesSent:
                 logging.error("writePacket: intended to write {} of {} bytes but wrote {} bytes"
-                              .format(pkt, len(pkt), numBytesSent))
-
+                              .format(list(pkt), len(pkt), numBytesSent))
             return numBytesSent
         except USBError as exc:
             logging.error("writePacket: {}".format(exc))
@@ -105,13 +273,24 @@ class AlienwareUSBDriver:
             pkt = self._device.ctrl_transfer(
                 self.IN_BM_REQUEST_TYPE, self.IN_B_REQUEST,
                 self.IN_W_VALUE, self.IN_W_INDEX,
-                AlienwareUSBDriver.PACKET_LENGTH, 0)
+                self.packetLength, self.timeout)
 
-            logging.debug("read: {}, {} bytes".format(pkt, len(pkt)))
-            if len(pkt) != AlienwareUSBDriver.PACKET_LENGTH:
+            counters = self.counters
+            counters.reads += 1
+            counters.bytesRead += len(pkt)
+            if len(pkt) != self.packetLength:
+                counters.shortTransfers += 1
+            if self.tracer is not None:
+                self.tracer.record(TraceRecord.READ, pkt)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("read: %s, %s bytes", list(pkt), len(pkt))
+            if len(pkt) != self.packetLength:
                 logging.error("readPacket: intended to read {} of {} bytes but read {} bytes"
-                              .format(pkt, AlienwareUSBDriver.PACKET_LENGTH, len(pkt)))
+                              .format(pkt, self.packetLength, len(pkt)))
 
             return pkt
         except USBError as exc:
+            self.counters.errors += 1
+            if self.tracer is not None:
+                self.tracer.record(TraceRecord.READ_FAILED)
             logging.error("read_packet: {}".format(exc))
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+
+# BUSY durations are those of the controller on the bus, like the contents of /run they are kept until reboot
+DEFAULT_STATS_FILE = '/run/alieneffects-13r3.waits.json'
+
+
+class ControllerNotReadyError(RuntimeError):
+    """Raised when the controller does not become ready in time, or its status cannot be read at all"""
+    pass
+
+
+class ReadyWaitStats:
+    """Recent BUSY durations, per reason for waiting (ex. after a RESET or an EXECUTE)
+
+    With a statsFile, load and save persist them to a json file, so that a process applying a single theme
+    adapts its waits to what earlier ones measured. With statsFile None, they are only kept in memory.
+    """
+
+    def __init__(self, maxSamples=64, statsFile=None):
+        self.maxSamples = maxSamples
+        self.statsFile = statsFile
+        self._busyDurations = {}
+        self._polls = {}
+        # Whether samples were recorded since load
+        self._changed = False
+
+    def record(self, reason, busyDuration, polls):
+        self._busyDurations.setdefault(reason, deque(maxlen=self.maxSamples)).append(busyDuration)
+        self._polls.setdefault(reason, deque(maxlen=self.maxSamples)).append(polls)
+        self._changed = True
+
+    def load(self):
+        if self.statsFile is None:
+            return self
+        try:
+            with open(self.statsFile) as file:
+                samples = json.load(file)
+            for reason, (busyDurations, polls) in samples.items():
+                self._busyDurations[reason] = deque(busyDurations, maxlen=self.maxSamples)
+                self._polls[reason] = deque(polls, maxlen=self.maxSamples)
+        except (IOError, OSError, ValueError, TypeError, AttributeError) as exc:
+            logging.debug('No previous ready wait stats in {}: {}'.format(self.statsFile, exc))
+            self._busyDurations = {}
+            self._polls = {}
+        return self
+
+    def save(self):
+        if self.statsFile is None or not self._changed:
+            return
+        samples = {reason: [list(durations), list(self._polls[reason])]
+                   for reason, durations in self._busyDurations.items()}
+        tmpFile = self.statsFile + '.tmp'
+        try:
+            with open(tmpFile, 'w') as file:
+                json.dump(samples, file)
+            os.replace(tmpFile, self.statsFile)
+            self._changed = False
+        except (IOError, OSError) as exc:
+            logging.debug('Could not persist ready wait stats to {}: {}'.format(self.statsFile, exc))
+
+    def numSamples(self, reason):
+        return len(self._busyDurations.get(reason, ()))
+
+    def percentile(self, reason, fraction):
+        samples = sorted(self._busyDurations.get(reason, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def summary(self):
+        summary = {}
+        for reason, durations in self._busyDurations.items():
+            polls = self._polls[reason]
+            summary[reason] = {
+                'samples': len(durations),
+                'minBusy': min(durations),
+                'medianBusy': self.percentile(reason, 0.5),
+                'maxBusy': max(durations),
+                'meanPolls': sum(polls) / len(polls),
+            }
+        return summary
+
+
+class ReadyWaitStrategy:
+    """Polls the controller status until it is ready
+
+    Polls back to back for spinPolls times, then sleeps between polls starting at initialDelay
+    and growing by backoff up to maxDelay, until timeout seconds have passed.
+    If adaptive, once minSamples BUSY durations are known for a reason, the wait starts by sleeping
+    a fraction of the shortest recent one, so that long waits (ex. after RESET) do not spin
+    while short ones (ex. after EXECUTE) are not delayed.
+    """
+
+    def __init__(self, spinPolls=3, initialDelay=0.0005, maxDelay=0.02, backoff=2.0, timeout=5.0,
+                 maxFailures=50, adaptive=True, minSamples=4, adaptiveFraction=0.8, stats=None):
+        self.spinPolls = spinPolls
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.maxFailures = maxFailures
+        self.adaptive = adaptive
+        self.minSamples = minSamples
+        self.adaptiveFraction = adaptiveFraction
+        self.stats = stats if stats is not None else ReadyWaitStats()
+
+    def initialSleep(self, reason):
+        if not self.adaptive or reason is None or self.stats.numSamples(reason) < self.minSamples:
+            return 0.0
+        return self.adaptiveFraction * self.stats.percentile(reason, 0.0)
+
+    def wait(self, getStatus, reason=None):
+        """Calls getStatus until it returns True, returns the number of polls made
+
+        getStatus raising TypeError or IndexError (no or an empty response read) or OSError (ex. a USBError)
+        counts as a failure.
+        Raises ControllerNotReadyError on timeout or after maxFailures failures.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        polls = 0
+        failures = 0
+        delay = self.initialDelay
+
+        initialSleep = self.initialSleep(reason)
+        if initialSleep > 0:
+            time.sleep(initialSleep)
+
+        while True:
+            polls += 1
+            try:
+                if getStatus():
+                    break
+            except (TypeError, IndexError, OSError):
+                failures += 1
+                logging.debug("No Status received yet... Num failed tries=%s", failures)
+                if failures > self.maxFailures:
+                    raise ControllerNotReadyError('Controller status could not be retrieved. '
+                                                  'Is the device already in use?')
+
+            now = time.monotonic()
+            if now >= deadline:
+                raise ControllerNotReadyError('Controller not ready after {:.3f}s and {} polls'
+                                              .format(now - start, polls))
+            if polls > self.spinPolls:
+                time.sleep(min(delay, deadline - now))
+                delay = min(delay * self.backoff, self.maxDelay)
+
+        busyDuration = time.monotonic() - start
+        if reason is not None:
+            self.stats.record(reason, busyDuration, polls)
+        logging.debug('Controller ready after %.6fs and %s polls (%s)', busyDuration, polls, reason)
+        return polls
@@ -0,0 +1,258 @@
+"""Benchmarks of the theme compile and send pipeline
+
+Run from the repository root:
+    python -m benchmarks.bench                          # print results as json
+    python -m benchmarks.bench --SAVE_BASELINE          # store results as the baseline
+    python -m benchmarks.bench --COMPARE                # fail if slower than the baseline beyond the threshold
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from alieneffects import __version__
+from alieneffects.backends import discoverDrivers, makeDriver
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.packets import PacketBatch
+from alieneffects.profiles import ProfileRegistry
+from alieneffects.state import ApplyState
+from alieneffects.theme import AlienwareTheme
+from alieneffects.decoder import JsonLinesWriter, PacketDecoder, controllerPackets, readCapture
+from alieneffects.fanout import FanOutApplier
+from alieneffects.generator import FAMILIES, ThemeGenerator
+from benchmarks.synthetic import writeSyntheticThemes, writeSyntheticUsbmonCapture
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIRECTORY = os.path.dirname(BENCHMARKS_DIRECTORY)
+DEFAULT_THEMES_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'themes')
+SCRIPT = os.path.join(ROOT_DIRECTORY, 'alieneffects', 'alieneffects-13r3')
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIRECTORY, 'baseline.json')
+
+
+def measure(fn, setup=None, minTime=0.2, minOps=5):
+    """Calls fn(setup()) until minTime seconds and minOps calls have passed, only fn is timed
+
+    Returns ops per second and latency statistics in seconds.
+    """
+    latencies = []
+    total = 0.0
+    while total < minTime or len(latencies) < minOps:
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg)
+        latency = time.perf_counter() - start
+        latencies.append(latency)
+        total += latency
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'opsPerSec': len(latencies) / total,
+        'meanLatency': total / len(latencies),
+        'p50Latency': latencies[len(latencies) // 2],
+        'p95Latency': latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+    }
+
+
+def themeBenchmarks(path):
+    name = os.path.basename(path)
+
+    def parsedTheme():
+        theme = AlienwareTheme(path)
+        theme.theme
+        return theme
+
+    benchmarks = {
+        'parse/' + name: (lambda _: AlienwareTheme(path).theme, None),
+        'validate/' + name: (lambda theme: theme.validate(), parsedTheme),
+        'compile/' + name: (lambda theme: theme.compile(), parsedTheme),
+        'compileOptimized/' + name: (lambda theme: theme.compile(optimize=True), parsedTheme),
+    }
+
+    ac = AC(driver=makeDriver('emulator'))
+    state = ApplyState(stateFile=None)
+    benchmarks['apply/' + name] = (lambda theme: theme.apply(ac, state=state, force=True), parsedTheme)
+
+    # Decoding every packet of the compiled (uncoalesced, i.e. worst case) theme
+    packets = [list(bytes(pkt)) for pkt in AlienwareTheme(path).compile(coalesce=False).commands]
+    benchmarks['pktToString/' + name] = (lambda _: [ac.pktToString(pkt) for pkt in packets], None)
+    return benchmarks
+
+
+def packetBenchmarks(numPackets=1000):
+    colors = [[i % 256, (7 * i) % 256, (13 * i) % 256] for i in range(numPackets)]
+
+    def makeCmds(_):
+        for i, color in enumerate(colors):
+            AC.makeSetColorCmd(i, 0x8, color)
+            AC.makeMorphColorCmd(i, 0x8, color, color)
+
+    batch = PacketBatch(2 * numPackets)
+
+    def packBatch(_):
+        batch.clear()
+        for i, color in enumerate(colors):
+            batch.addSetColorCmd(i, 0x8, color)
+            batch.addMorphColorCmd(i, 0x8, color, color)
+
+    return {
+        'makeCmd/{}x2'.format(numPackets): (makeCmds, None),
+        'packetBatch/{}x2'.format(numPackets): (packBatch, None),
+    }
+
+
+def decoderBenchmarks(directory, numPackets=20000):
+    """Decoding a usbmon capture to json lines, with themes applied over and over and with every packet distinct"""
+    benchmarks = {}
+    for name, numThemes in (('themes', 64), ('distinct', None)):
+        path = writeSyntheticUsbmonCapture(os.path.join(directory, 'usbmon-{}.txt'.format(name)), numPackets,
+                                           numThemes=numThemes)
+
+        def decode(_, path=path):
+            decoder = PacketDecoder()
+            writer = JsonLinesWriter(io.StringIO())
+            for i, (timestamp, bus, device, direction, data) in enumerate(controllerPackets(readCapture(path))):
+                writer.write(i, timestamp, bus, device, decoder.decode(data, direction))
+
+        benchmarks['decoder/usbmon-{}-{}'.format(name, numPackets)] = (decode, None)
+    return benchmarks
+
+
+def generatorBenchmarks(numThemes=1000):
+    """Generating a family of themes, and compiling them straight to packets"""
+    benchmarks = {}
+    for family in FAMILIES:
+        def generate(_, family=family):
+            for theme in ThemeGenerator(0, 'hsv').family(family, numThemes):
+                theme.toJson()
+
+        def generateAndCompile(_, family=family):
+            for theme in ThemeGenerator(0, 'hsv').family(family, numThemes):
+                theme.compile()
+
+        benchmarks['generate/{}-{}'.format(family, numThemes)] = (generate, None)
+        benchmarks['generateCompiled/{}-{}'.format(family, numThemes)] = (generateAndCompile, None)
+    return benchmarks
+
+
+def fanOutBenchmarks(path, numDevices=4, latency=0.002):
+    """Applying a theme to several emulated controllers taking latency seconds to reset and execute,
+    one after the other and concurrently"""
+    name = os.path.basename(path)
+    drivers = discoverDrivers('emulator', ProfileRegistry(), devicesPerProfile=numDevices, resetLatency=latency,
+                              executeLatency=latency)
+    return {
+        'fanOut/serial-{}x-{}'.format(numDevices, name):
+            (lambda _: FanOutApplier(drivers, maxWorkers=1).apply(AlienwareTheme(path)), None),
+        'fanOut/parallel-{}x-{}'.format(numDevices, name):
+            (lambda _: FanOutApplier(drivers).apply(AlienwareTheme(path)), None),
+    }
+
+
+def coldStartBenchmarks(paths):
+    """Fresh interpreters: bare startup for reference, importing the cli, and validating every theme"""
+    env = dict(os.environ, PYTHONPATH=ROOT_DIRECTORY)
+
+    def run(argv):
+        return lambda _: subprocess.run([sys.executable] + argv, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    return {
+        'coldstart/python': (run(['-c', 'pass']), None),
+        'coldstart/import-cli': (run(['-c', 'import alieneffects.cli']), None),
+        'coldstart/validate-{}-themes'.format(len(paths)): (run([SCRIPT, 'validate'] + paths), None),
+    }
+
+
+def runBenchmarks(themesDirectory=DEFAULT_THEMES_DIRECTORY, minTime=0.2, only=None, repeat=3):
+    """Runs every benchmark repeat times, keeping the fastest round to damp noise from other processes"""
+    results = {}
+    with tempfile.TemporaryDirectory() as syntheticDirectory:
+        paths = sorted(glob.glob(os.path.join(themesDirectory, '*.json')))
+        paths += writeSyntheticThemes(syntheticDirectory)
+
+        benchmarks = packetBenchmarks()
+        benchmarks.update(decoderBenchmarks(syntheticDirectory))
+        benchmarks.update(generatorBenchmarks())
+        benchmarks.update(fanOutBenchmarks(paths[0]))
+        benchmarks.update(coldStartBenchmarks(paths))
+        for path in paths:
+            benchmarks.update(themeBenchmarks(path))
+
+        for name, (fn, setup) in sorted(benchmarks.items()):
+            if only is not None and only not in name:
+                continue
+            rounds = [measure(fn, setup, minTime / repeat) for _ in range(repeat)]
+            results[name] = max(rounds, key=lambda result: result['opsPerSec'])
+            print('{:60s} {:12.1f} ops/s'.format(name, results[name]['opsPerSec']), file=sys.stderr)
+    return {
+        'meta': {
+            'version': __version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': time.time(),
+        },
+        'results': results,
+    }
+
+
+def compareResults(results, baseline, threshold):
+    """Returns the regressions of results against baseline, as messages
+
+    A benchmark regresses when its throughput drops, or its median latency grows, by more than threshold (a fraction).
+    """
+    regressions = []
+    for name, base in sorted(baseline['results'].items()):
+        current = results['results'].get(name)
+        if current is None:
+            continue
+        if current['opsPerSec'] < base['opsPerSec'] * (1.0 - threshold):
+            regressions.append('{}: throughput {:.1f} ops/s, baseline {:.1f} ops/s'
+                               .format(name, current['opsPerSec'], base['opsPerSec']))
+        if current['p50Latency'] > base['p50Latency'] * (1.0 + threshold):
+            regressions.append('{}: median latency {:.6f}s, baseline {:.6f}s'
+                               .format(name, current['p50Latency'], base['p50Latency']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the theme compile and send pipeline')
+    parser.add_argument('--THEMES_DIRECTORY', default=DEFAULT_THEMES_DIRECTORY)
+    parser.add_argument('--MIN_TIME', type=float, default=0.2, help='seconds to run each benchmark for, over all rounds')
+    parser.add_argument('--REPEAT', type=int, default=3, help='rounds per benchmark, the fastest is kept')
+    parser.add_argument('--ONLY', help='run only benchmarks whose name contains this')
+    parser.add_argument('--OUTPUT', help='write results json here instead of stdout')
+    parser.add_argument('--BASELINE', default=DEFAULT_BASELINE)
+    parser.add_argument('--SAVE_BASELINE', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--COMPARE', action='store_true', help='exit with 1 if regressed against the baseline')
+    parser.add_argument('--THRESHOLD', type=float, default=0.25, help='allowed regression, as a fraction')
+    args = parser.parse_args(argv)
+
+    results = runBenchmarks(args.THEMES_DIRECTORY, args.MIN_TIME, args.ONLY, args.REPEAT)
+
+    if args.OUTPUT:
+        with open(args.OUTPUT, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.SAVE_BASELINE:
+        with open(args.BASELINE, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.COMPARE:
+        with open(args.BASELINE) as file:
+            baseline = json.load(file)
+        regressions = compareResults(results, baseline, args.THRESHOLD)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
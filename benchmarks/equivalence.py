@@ -0,0 +1,185 @@
+"""Checks that optimized themes show the same as unoptimized ones
+
+Every theme of the corpus (the themes directory, the synthetic benchmark themes and generated edge cases)
+is compiled with and without --OPTIMIZE and sent to an emulated controller, the timelines each zone shows
+are then compared step by step. Run from the repository root:
+    python -m benchmarks.equivalence            # exit status 1 on any mismatch
+"""
+import argparse
+import copy
+import glob
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+
+from alieneffects.backends import makeDriver
+from alieneffects.compiler import compileTheme
+from alieneffects.controller import AlienwareController as AC
+from alieneffects.optimizer import optimizeTheme
+from alieneffects.theme import AlienwareTheme
+from benchmarks.bench import DEFAULT_THEMES_DIRECTORY
+from benchmarks.synthetic import ZONE_NAMES, writeSyntheticThemes
+
+BLACK = (0, 0, 0)
+ZONE_NAMES_BY_CODE = {code: name for name, code in AC.Zones.CODES.items()}
+
+# Few colors, so that generated sequences repeat themselves
+PALETTE = [[0, 0, 0], [255, 0, 0], [0, 0, 255], [255, 255, 255]]
+
+
+def _edgeCaseEffect(rng):
+    effectName = rng.choice([AC.Commands.SET_COLOR, AC.Commands.BLINK_COLOR, AC.Commands.MORPH_COLOR])
+    if effectName == AC.Commands.MORPH_COLOR:
+        color1 = rng.choice(PALETTE)
+        # Morphing from a color to itself half of the time
+        return {'EFFECT': effectName, 'COLOR1': color1, 'COLOR2': color1 if rng.random() < 0.5 else rng.choice(PALETTE)}
+    return {'EFFECT': effectName, 'COLOR': rng.choice(PALETTE)}
+
+
+def _edgeCaseSequence(rng):
+    shape = rng.choice(['repeated', 'afterLoop', 'sameSet', 'random', 'noLoop'])
+    if shape == 'repeated':
+        period = [_edgeCaseEffect(rng) for _ in range(rng.randint(1, 3))]
+        return period * rng.randint(2, 4) + [{'EFFECT': AC.Commands.LOOP_SEQUENCE}]
+    if shape == 'afterLoop':
+        return [_edgeCaseEffect(rng) for _ in range(rng.randint(1, 4))] + [{'EFFECT': AC.Commands.LOOP_SEQUENCE}] + \
+               [_edgeCaseEffect(rng) for _ in range(rng.randint(1, 3))]
+    if shape == 'sameSet':
+        effects = [{'EFFECT': AC.Commands.SET_COLOR, 'COLOR': rng.choice(PALETTE)}] * rng.randint(2, 5)
+        return effects + [{'EFFECT': AC.Commands.LOOP_SEQUENCE}] if rng.random() < 0.5 else effects
+    if shape == 'noLoop':
+        return [_edgeCaseEffect(rng) for _ in range(rng.randint(1, 5))]
+    return [_edgeCaseEffect(rng) for _ in range(rng.randint(1, 6))] + [{'EFFECT': AC.Commands.LOOP_SEQUENCE}]
+
+
+def writeEdgeCaseThemes(directory, numThemes=50, seed=0):
+    """Writes themes made of sequences the optimizer rewrites, returns their paths"""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(numThemes):
+        zones = {zoneName: _edgeCaseSequence(rng) for zoneName in rng.sample(ZONE_NAMES, rng.randint(1, 8))}
+        theme = {'DESCRIPTION': 'edge cases {}'.format(i), 'TEMPO': rng.choice([100, 200, 500]), 'ZONES': zones}
+        if rng.random() < 0.3:
+            theme['POWER_STATES'] = {'AC_SLEEP|BATTERY_SLEEP': {'ZONES': {rng.choice(ZONE_NAMES):
+                                                                              _edgeCaseSequence(rng)}}}
+        path = os.path.join(directory, 'edge-case-{:03d}.json'.format(i))
+        with open(path, 'w') as file:
+            json.dump(theme, file)
+        paths.append(path)
+    return paths
+
+
+def _step(effect):
+    """What a zone shows during the step of an emulated effect"""
+    if effect[0] == AC.Commands.SET_COLOR:
+        return 'steady', effect[1]
+    if effect[0] == AC.Commands.BLINK_COLOR:
+        return ('steady', effect[1]) if effect[1] == BLACK else ('blink', effect[1])
+    return ('steady', effect[1]) if effect[1] == effect[2] else ('morph', effect[1], effect[2])
+
+
+def _timelines(device):
+    """zone code -> (looped, steps) of what an emulated controller shows once executed"""
+    return {zoneCode: (state.looped, [_step(effect) for effect in state.effects])
+            for zoneCode, state in device.zones.items()}
+
+
+def _sameTimeline(timeline, otherTimeline):
+    looped, steps = timeline
+    otherLooped, otherSteps = otherTimeline
+    if looped != otherLooped:
+        return False
+    if not looped or not steps or not otherSteps:
+        return steps == otherSteps
+    # Both repeat forever: equal over a common multiple of their periods means equal at every step
+    numSteps = len(steps) * len(otherSteps) // math.gcd(len(steps), len(otherSteps))
+    return all(steps[i % len(steps)] == otherSteps[i % len(otherSteps)] for i in range(numSteps))
+
+
+def _slotTimelines(device):
+    """power state code -> timelines of the packets saved in its slot, replayed on a fresh controller"""
+    slots = {}
+    for powerStateCode, packets in device.savedSlots.items():
+        driver = makeDriver('emulator')
+        for pkt in packets + [AC.makeExecuteCmd()]:
+            driver.device.ctrl_transfer(driver.OUT_BM_REQUEST_TYPE, driver.OUT_B_REQUEST, data_or_wLength=pkt)
+        slots[powerStateCode] = _timelines(driver.device)
+    return slots
+
+
+def emulate(compiled):
+    """The emulated controller, after compiled was sent to it"""
+    ac = AC(driver=makeDriver('emulator'))
+    ac.driver.acquire()
+    ac.sendCommands(compiled.commands)
+    ac.driver.release()
+    return ac.driver.device
+
+
+def _compareTimelines(timelines, optimizedTimelines, where):
+    mismatches = []
+    for zoneCode in sorted(set(timelines) | set(optimizedTimelines)):
+        if zoneCode not in timelines or zoneCode not in optimizedTimelines or \
+                not _sameTimeline(timelines[zoneCode], optimizedTimelines[zoneCode]):
+            mismatches.append('{}zone {}: {} != {}'.format(where, ZONE_NAMES_BY_CODE.get(zoneCode, hex(zoneCode)),
+                                                             timelines.get(zoneCode),
+                                                             optimizedTimelines.get(zoneCode)))
+    return mismatches
+
+
+def checkEquivalence(path):
+    """Compiles the theme with and without optimization, returns (packets, optimized packets, mismatches)"""
+    # Validated once so that both compile the same random colors
+    _, tempo, duration, zones = AlienwareTheme(path).validate()
+    powerStates = AlienwareTheme(path).validatePowerStates()
+    compiled = compileTheme(tempo, duration, zones, True, powerStates)
+    optimizedZones, optimizedPowerStates = optimizeTheme(copy.deepcopy(zones), copy.deepcopy(powerStates))
+    optimized = compileTheme(tempo, duration, optimizedZones, True, optimizedPowerStates)
+
+    device = emulate(compiled)
+    optimizedDevice = emulate(optimized)
+    mismatches = []
+    if device.tempo != optimizedDevice.tempo:
+        mismatches.append('tempo: {} != {}'.format(device.tempo, optimizedDevice.tempo))
+    mismatches.extend(_compareTimelines(_timelines(device), _timelines(optimizedDevice), ''))
+    slots = _slotTimelines(device)
+    optimizedSlots = _slotTimelines(optimizedDevice)
+    for powerStateCode in sorted(set(slots) | set(optimizedSlots)):
+        mismatches.extend(_compareTimelines(slots.get(powerStateCode, {}), optimizedSlots.get(powerStateCode, {}),
+                                            'power state {} '.format(powerStateCode)))
+    return compiled.numPackets, optimized.numPackets, mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--THEMES_DIRECTORY', default=DEFAULT_THEMES_DIRECTORY)
+    parser.add_argument('--NUM_EDGE_CASES', type=int, default=200)
+    parser.add_argument('--SEED', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    numMismatched = 0
+    totalPackets = totalOptimizedPackets = 0
+    with tempfile.TemporaryDirectory() as directory:
+        paths = sorted(glob.glob(os.path.join(args.THEMES_DIRECTORY, '*.json')))
+        paths += writeSyntheticThemes(directory, args.SEED)
+        paths += writeEdgeCaseThemes(directory, args.NUM_EDGE_CASES, args.SEED)
+        for path in paths:
+            numPackets, numOptimizedPackets, mismatches = checkEquivalence(path)
+            totalPackets += numPackets
+            totalOptimizedPackets += numOptimizedPackets
+            print('{}: {} packets, {} optimized{}'.format(os.path.basename(path), numPackets, numOptimizedPackets,
+                                                          ', MISMATCH' if mismatches else ''))
+            for mismatch in mismatches:
+                print('    ' + mismatch)
+            numMismatched += bool(mismatches)
+
+    print('{} themes, {} packets, {} optimized, {} mismatched'.format(len(paths), totalPackets,
+                                                                        totalOptimizedPackets, numMismatched))
+    return 1 if numMismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
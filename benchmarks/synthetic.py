@@ -0,0 +1,132 @@
+import itertools
+import json
+import os
+import random
+
+from alieneffects.controller import AlienwareController as AC
+
+ZONE_NAMES = list(AC.Zones.CODES.keys())
+
+
+def _randomEffect(rng):
+    effectName = rng.choice([AC.Commands.SET_COLOR, AC.Commands.BLINK_COLOR, AC.Commands.MORPH_COLOR])
+    color = [rng.randint(0, 255) for _ in range(3)]
+    if effectName == AC.Commands.MORPH_COLOR:
+        return {'EFFECT': effectName, 'COLOR1': color, 'COLOR2': [rng.randint(0, 255) for _ in range(3)]}
+    return {'EFFECT': effectName, 'COLOR': color}
+
+
+def _sequence(rng, length):
+    return [_randomEffect(rng) for _ in range(length)] + [{'EFFECT': AC.Commands.LOOP_SEQUENCE}]
+
+
+def allZonesTheme(rng):
+    """Every zone with its own short sequence, nothing coalesces"""
+    return {
+        'DESCRIPTION': 'synthetic: all 8 zones, distinct sequences',
+        'TEMPO': 200,
+        'ZONES': {zoneName: _sequence(rng, 3) for zoneName in ZONE_NAMES},
+    }
+
+
+def longSequencesTheme(rng):
+    """Every zone with a long sequence"""
+    return {
+        'DESCRIPTION': 'synthetic: all 8 zones, 64 effects each',
+        'TEMPO': 200,
+        'ZONES': {zoneName: _sequence(rng, 64) for zoneName in ZONE_NAMES},
+    }
+
+
+def manyKeysTheme(rng):
+    """Lots of '|' joined keys, every permutation of 5 zones overriding the previous ones"""
+    zones = {}
+    for permutation in itertools.islice(itertools.permutations(ZONE_NAMES, 5), 512):
+        zones['|'.join(permutation)] = _sequence(rng, 2)
+    return {
+        'DESCRIPTION': 'synthetic: 512 keys of 5 | joined zones',
+        'TEMPO': 200,
+        'ZONES': zones,
+    }
+
+
+SYNTHETIC_THEMES = {
+    'synthetic-all-zones.json': allZonesTheme,
+    'synthetic-long-sequences.json': longSequencesTheme,
+    'synthetic-many-keys.json': manyKeysTheme,
+}
+
+
+def writeSyntheticThemes(directory, seed=0):
+    """Writes the synthetic themes to directory, returns their paths"""
+    rng = random.Random(seed)
+    paths = []
+    for name, makeTheme in sorted(SYNTHETIC_THEMES.items()):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as file:
+            json.dump(makeTheme(rng), file)
+        paths.append(path)
+    return paths
+
+
+def _usbmonWords(data):
+    return ' '.join(data[i:i + 4].hex() for i in range(0, len(data), 4))
+
+
+def _randomPacket(rng, sequenceId):
+    command = rng.choice([AC.Commands.SET_COLOR, AC.Commands.BLINK_COLOR, AC.Commands.MORPH_COLOR])
+    color = [rng.randint(0, 255) for _ in range(3)]
+    zoneCode = rng.choice(list(AC.Zones.CODES.values()))
+    if command == AC.Commands.MORPH_COLOR:
+        return bytes(AC.makeMorphColorCmd(sequenceId, zoneCode, color, [rng.randint(0, 255) for _ in range(3)]))
+    elif command == AC.Commands.BLINK_COLOR:
+        return bytes(AC.makeBlinkColorCmd(sequenceId, zoneCode, color))
+    return bytes(AC.makeSetColorCmd(sequenceId, zoneCode, color))
+
+
+def writeSyntheticUsbmonCapture(path, numPackets, seed=0, numThemes=64, bus=1, device=5):
+    """Writes a usbmon text capture of about numPackets packets sent to and read from the controller
+
+    Like a capture of a lighting tool: the controller's device descriptor, then applies of numThemes
+    random themes over and over (reset, status polls, tempo, 32 color packets of which one has an unknown
+    command, execute, status polls), among traffic of another device.
+    With numThemes None every packet is random instead.
+    """
+    rng = random.Random(seed)
+    address = '{}:{:03d}'.format(bus, device)
+    descriptor = bytes([18, 1, 0, 2, 0, 0, 0, 8, 0x7c, 0x18, 0x29, 0x05, 0, 0, 1, 2, 0, 1])
+    lines = [
+        'a0 0 S Ci:{}:0 s 80 06 0100 0000 0012 18 <'.format(address),
+        'a0 1 C Ci:{}:0 0 18 = {}'.format(address, _usbmonWords(descriptor)),
+    ]
+
+    def makeTheme():
+        packets = [bytes(AC.makeResetCmd(AC.Reset.CODES[AC.Reset.ALL_LIGHTS_ON])), None, None,
+                   bytes(AC.makeSetTempoCmd(200))]
+        packets += [_randomPacket(rng, i // 4) for i in range(31)]
+        packets += [bytes([0x02, 0x0a] + [0] * 10), bytes(AC.makeExecuteCmd()), None, None]
+        return packets
+
+    themes = [makeTheme() for _ in range(numThemes or 1)]
+    timestamp = 2
+    count = 0
+    while count < numPackets:
+        theme = rng.choice(themes) if numThemes else makeTheme()
+        for pkt in theme:
+            if pkt is None:
+                status = 'c0'
+                lines.append('{} {} S Ci:{}:0 s a1 01 0101 0000 000c 12 <'.format(status, timestamp, address))
+                lines.append('{} {} C Ci:{}:0 0 12 = {}'.format(status, timestamp + 1, address,
+                                                               '11000000 00000000 00000000' if rng.random() < 0.5
+                                                               else '10000000 00000000 00000000'))
+                lines.append('d0 {} C Ii:1:002:1 0:8 4 = 00010000'.format(timestamp + 2))
+            else:
+                tag = 'b{}'.format(count % 64)
+                lines.append('{} {} S Co:{}:0 s 21 09 0202 0000 000c 12 = {}'.format(tag, timestamp, address,
+                                                                                    _usbmonWords(pkt)))
+                lines.append('{} {} C Co:{}:0 0 12 >'.format(tag, timestamp + 1, address))
+            timestamp += 10
+            count += 1
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    return path